@@ -92,6 +92,10 @@ class CategoryAdmin(admin.ModelAdmin):
     list_display = ('name', 'parent')
 
 
+class SubscriberAdmin(admin.ModelAdmin):
+    filter_horizontal = ('tags', 'categories')
+
+
 class ItemReportsAdmin(admin.ModelAdmin):
     list_display = ('item', 'is_send')
 
@@ -122,5 +126,5 @@ admin.site.register(CategoryModel, CategoryAdmin)
 admin.site.register(TagModel)
 admin.site.register(SellerModel, SellerAdmin)
 admin.site.register(CurrencyModel, CurrencyAdmin)
-admin.site.register(Subscriber)
+admin.site.register(Subscriber, SubscriberAdmin)
 admin.site.register(ItemReports, ItemReportsAdmin)
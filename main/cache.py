@@ -0,0 +1,243 @@
+"""Cache
+
+Versioned cache of the item listings.
+
+Every listing (all items, items of a tag) belongs to scopes with a version number
+kept in the cache. The version is stored with every cached page of the listing,
+so bumping it on item or tag changes makes all the cached pages of the
+listing outdated at once and they can live in the cache for hours.
+"""
+import hashlib
+import math
+import random
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, Iterable, List
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpRequest, HttpResponse
+from django.utils.cache import get_cache_key, learn_cache_key
+
+from py_dev_user.metrics import collector
+
+KEY_PREFIX = 'listing'
+VERSION_KEY = 'listing:version:{scope}'
+LOCK_KEY = 'listing:lock:{url}'
+STATS_KEY = 'listing:stats:{result}'
+CATEGORY_TREE_KEY = 'category:tree'
+
+HIT = 'hit'
+MISS = 'miss'
+STALE = 'stale'
+STATS = (HIT, MISS, STALE)
+
+ALL_ITEMS = 'all'
+ALL_TAGS = 'tags'
+
+
+def tag_scope(tag_name: str) -> str:
+    return f'tag:{tag_name}'
+
+
+def listing_scopes(view_kwargs: dict) -> List[str]:
+    """Scopes of the listing by the arguments of the URL
+
+    :param view_kwargs: keyword arguments of the view
+    :type view_kwargs: dict
+    :return: list of scopes
+    """
+    if 'tag_name' in view_kwargs:
+        return [ALL_TAGS, tag_scope(view_kwargs['tag_name'])]
+
+    return [ALL_ITEMS]
+
+
+def _initial_version() -> int:
+    # an evicted version must not restart from a number some old page was cached with
+    return int(time.time() * 1000)
+
+
+def get_listing_version(scopes: Iterable[str]) -> str:
+    """Current version of the listing
+
+    :param scopes: scopes of the listing
+    :type scopes: list
+    :return: version string
+    """
+    keys = [VERSION_KEY.format(scope=scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _initial_version(), timeout=None)
+            versions[key] = cache.get(key)
+
+    return '.'.join(str(versions[key]) for key in keys)
+
+
+def _bump(scopes: Iterable[str]) -> None:
+    for scope in scopes:
+        key = VERSION_KEY.format(scope=scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), timeout=None)
+
+
+def bump_listing_version(*scopes: str) -> None:
+    """Invalidate all the cached pages of the scopes when the transaction commits
+
+    A page rebuilt before the commit is built from the old rows, it must be
+    cached under the old version.
+    :param scopes: scopes to invalidate
+    :type scopes: str
+    :return: None
+    """
+    scopes_set = set(scopes)
+    transaction.on_commit(lambda: _bump(scopes_set))
+
+
+def invalidate_item_listings(tag_names: Iterable[str] = ()) -> None:
+    """Invalidate the list of all items and the lists of the given tags
+
+    :param tag_names: names of the tags of the changed items
+    :type tag_names: list
+    :return: None
+    """
+    bump_listing_version(ALL_ITEMS, *(tag_scope(name) for name in tag_names))
+
+
+def listing_etag(request: HttpRequest, *args: Any, **kwargs: Any) -> str:
+    """ETag of a listing page for `condition`
+
+    The listing version changes with any item of the listing, the page also
+    depends on the user it is rendered for. Parameters of the query string are
+    a part of the URL the ETag belongs to.
+    :param request: request
+    :type request: HttpRequest
+    :return: ETag without quotes
+    """
+    user = request.user.pk if request.user.is_authenticated else 'anonymous'
+    return f'listing-{get_listing_version(listing_scopes(kwargs))}-{user}'
+
+
+def invalidate_category_tree() -> None:
+    """Drop the cached category tree when the transaction commits, it is rebuilt by the next request
+
+    A tree rebuilt before the commit is built from the old rows.
+    :return: None
+    """
+    transaction.on_commit(lambda: cache.delete(CATEGORY_TREE_KEY))
+
+
+def _count(result: str) -> None:
+    key = STATS_KEY.format(result=result)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def get_listing_stats() -> Dict[str, int]:
+    """Counters of the listing cache shared by all the workers
+
+    :return: dict result -> amount of requests
+    """
+    keys = {result: STATS_KEY.format(result=result) for result in STATS}
+    values = cache.get_many(keys.values())
+    return {result: int(values.get(key, 0)) for result, key in keys.items()}
+
+
+@collector
+def listing_metrics() -> List[str]:
+    """Counters of the listing cache in `/metrics`"""
+    lines = [
+        '# HELP listing_cache_requests_total Requests to the cached item listings by result',
+        '# TYPE listing_cache_requests_total counter',
+    ]
+    lines += [f'listing_cache_requests_total{{result="{result}"}} {amount}'
+              for result, amount in get_listing_stats().items()]
+    return lines
+
+
+def _is_fresh(entry: dict, version: str, beta: float) -> bool:
+    """Check the entry, expire it a bit earlier at random
+
+    Probabilistic early expiration (XFetch): the longer the page takes to build,
+    the earlier one of the requests decides to rebuild it before it expires.
+    """
+    if entry['version'] != version:
+        return False
+
+    return time.time() - entry['delta'] * beta * math.log(random.random() or 1e-12) < entry['expires']
+
+
+def cache_listing(timeout: int) -> Callable[..., Any]:
+    """Decorator of the listing views, versioned replacement of `cache_page`
+
+    Every page has a single cache entry with the version of the listing it was
+    built for. When the entry expires or the listing version changes, only the
+    worker that takes a short lock (SET NX on Redis) rebuilds the page, the
+    others serve the stale copy in the meantime. Without any copy the page is
+    built as usual.
+
+    Pages are cached for anonymous users only, the navigation bar of logged in
+    users is personal. Browsers get no max-age, the page may change any moment.
+    :param timeout: cache timeout in seconds
+    :type timeout: int
+    :return: decorator
+    """
+    stale_ttl = getattr(settings, 'LISTING_CACHE_STALE_TTL', 60 * 60)
+    lock_timeout = getattr(settings, 'LISTING_CACHE_LOCK_TIMEOUT', 10)
+    beta = getattr(settings, 'LISTING_CACHE_BETA', 1.0)
+
+    def decorator(view_func: Callable[..., HttpResponse]) -> Callable[..., HttpResponse]:
+        @wraps(view_func)
+        def wrapper(request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+            if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+                return view_func(request, *args, **kwargs)
+
+            version = get_listing_version(listing_scopes(kwargs))
+
+            entry = None
+            cache_key = get_cache_key(request, KEY_PREFIX, 'GET', cache=cache)
+            if cache_key is not None:
+                entry = cache.get(cache_key)
+                if entry is not None and _is_fresh(entry, version, beta):
+                    _count(HIT)
+                    return entry['response']
+
+            lock_key = LOCK_KEY.format(url=hashlib.md5(request.build_absolute_uri().encode()).hexdigest())
+            locked = cache.add(lock_key, 1, timeout=lock_timeout)
+            if entry is not None and not locked:
+                _count(STALE)
+                return entry['response']
+
+            _count(MISS)
+            started = time.time()
+            response = view_func(request, *args, **kwargs)
+            if response.streaming or response.status_code != 200:
+                if locked:
+                    cache.delete(lock_key)
+                return response
+
+            def store(response: HttpResponse) -> None:
+                now = time.time()
+                entry = {'response': response, 'version': version, 'delta': now - started, 'expires': now + timeout}
+                key = learn_cache_key(request, response, timeout + stale_ttl, KEY_PREFIX, cache=cache)
+                cache.set(key, entry, timeout + stale_ttl)
+                if locked:
+                    cache.delete(lock_key)
+
+            if hasattr(response, 'render') and callable(response.render):
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+
+            return response
+
+        return wrapper
+
+    return decorator
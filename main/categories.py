@@ -0,0 +1,63 @@
+"""Categories
+
+The tree of the published categories, loaded by one query and kept in the
+cache as a whole. Receivers of the category signals drop it (see models), so
+the category menu and the category listings cost no queries.
+"""
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache import CATEGORY_TREE_KEY
+from .models import CategoryModel
+
+# seconds, the tree is dropped on every change, the timeout only bounds a missed invalidation
+CATEGORY_TREE_TTL = getattr(settings, 'CATEGORY_TREE_TTL', 60 * 60)
+
+
+def _build_tree() -> List[CategoryModel]:
+    roots: List[CategoryModel] = []
+    nodes: Dict[int, CategoryModel] = {}
+    for category in CategoryModel.objects.filter(published=True).order_by('tree_id', 'lft'):
+        category.subcategories = []
+        if category.parent_id is None:
+            roots.append(category)
+        elif category.parent_id in nodes:
+            nodes[category.parent_id].subcategories.append(category)
+        else:
+            # a parent is not published, the whole branch is hidden
+            continue
+        nodes[category.id] = category
+
+    return roots
+
+
+def category_tree() -> List[CategoryModel]:
+    """Published categories
+
+    :return: list of root categories, subcategories are in the `subcategories` lists
+    """
+    tree = cache.get(CATEGORY_TREE_KEY)
+    if tree is None:
+        tree = _build_tree()
+        cache.set(CATEGORY_TREE_KEY, tree, CATEGORY_TREE_TTL)
+
+    return tree
+
+
+def find_category(category_id: int) -> Optional[CategoryModel]:
+    """Published category from the cached tree
+
+    :param category_id: category id
+    :type category_id: int
+    :return: category with `subcategories` or None
+    """
+    nodes = list(category_tree())
+    while nodes:
+        node = nodes.pop()
+        if node.id == category_id:
+            return node
+        nodes.extend(node.subcategories)
+
+    return None
@@ -0,0 +1,277 @@
+"""Circular messages
+
+The recipients of a `CircularMessage` are split by id into `CircularChunk`
+rows, every chunk is sent by its own `send_circular_chunk` task over one
+connection of the mail backend. The position of a chunk is saved after every
+batch of letters, so a chunk interrupted by a crash goes on after the last
+batch sent and the message goes on from the chunks not done yet.
+
+A worker takes a chunk with a lease of `CIRCULAR_LEASE` seconds, renewed
+after every batch. A chunk leased by another worker is skipped, so resuming a
+message does not send a chunk twice; the lease of a crashed worker expires.
+
+All the workers share a token bucket in Redis which keeps the letters within
+`CIRCULAR_RATE` per second with bursts up to `CIRCULAR_BURST`.
+"""
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import get_connection
+from django.db.models import F, Q, QuerySet
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from py_dev_user.utilities import get_sender_email, send_batch
+
+from .models import CircularChunk, CircularMessage, SellerModel
+
+RATE_KEY = 'circular:rate'
+
+CIRCULAR_CHUNK_SIZE = getattr(settings, 'CIRCULAR_CHUNK_SIZE', 500)
+CIRCULAR_BATCH_SIZE = getattr(settings, 'CIRCULAR_BATCH_SIZE', 50)
+CIRCULAR_RATE = getattr(settings, 'CIRCULAR_RATE', 10)
+CIRCULAR_BURST = getattr(settings, 'CIRCULAR_BURST', 100)
+CIRCULAR_RETRIES = getattr(settings, 'CIRCULAR_RETRIES', 3)
+# seconds a chunk is kept by the worker sending it after its last batch
+CIRCULAR_LEASE = getattr(settings, 'CIRCULAR_LEASE', 5 * 60)
+
+logger = logging.getLogger(__name__)
+
+# tokens are added with the time passed since the last call, the script returns
+# the seconds to wait before the tokens are available, as a string not to be rounded
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """Rate limit shared by all the processes through Redis
+
+    :param key: Redis key of the bucket
+    :type key: str
+    :param rate: tokens added per second
+    :type rate: float
+    :param burst: capacity of the bucket
+    :type burst: int
+    """
+
+    def __init__(self, key: str = RATE_KEY, rate: float = CIRCULAR_RATE, burst: int = CIRCULAR_BURST) -> None:
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.script = get_redis_connection('default').register_script(TOKEN_BUCKET)
+
+    def try_acquire(self, tokens: int) -> float:
+        """Take the tokens if the bucket has them
+
+        :param tokens: amount of tokens, not more than `burst`
+        :type tokens: int
+        :return: 0 if the tokens are taken, seconds to wait for them otherwise
+        """
+        if tokens > self.burst:
+            raise ValueError(f'{tokens} tokens are more than the burst of {self.burst}')
+        return float(self.script(keys=[self.key], args=[self.rate, self.burst, time.time(), tokens]))
+
+    def acquire(self, tokens: int, sleep: Callable[[float], Any] = time.sleep) -> None:
+        """Wait for the tokens and take them, more than `burst` are taken by parts
+
+        :param tokens: amount of tokens
+        :type tokens: int
+        :param sleep: waiting function
+        :type sleep: callable
+        :return: None
+        """
+        while tokens > 0:
+            part = min(tokens, self.burst)
+            wait = self.try_acquire(part)
+            if wait:
+                sleep(wait)
+            else:
+                tokens -= part
+
+
+def recipients(message: CircularMessage) -> QuerySet:
+    """Active users with emails the message is sent to, staff excluded"""
+    if message.is_seller:
+        return SellerModel.objects.filter(is_active=True).exclude(email='')
+
+    return User.objects.filter(is_active=True).exclude(email='').exclude(is_staff=True)
+
+
+def plan_chunks(message: CircularMessage, chunk_size: int = CIRCULAR_CHUNK_SIZE) -> int:
+    """Split the recipients into chunks by ranges of ids
+
+    Recipients are read with keyset pagination, only their ids. Planning a
+    message twice does nothing.
+    :param message: circular message
+    :type message: CircularMessage
+    :param chunk_size: recipients per chunk
+    :type chunk_size: int
+    :return: amount of the chunks
+    """
+    if message.chunks.exists():
+        return message.chunks.count()
+
+    ids = recipients(message).order_by('pk').values_list('pk', flat=True)
+    chunks: List[CircularChunk] = []
+    last_id = 0
+    while True:
+        chunk = list(ids.filter(pk__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+
+        chunks.append(CircularChunk(message=message, number=len(chunks), first_id=chunk[0], last_id=chunk[-1],
+                                    size=len(chunk)))
+        last_id = chunk[-1]
+
+    CircularChunk.objects.bulk_create(chunks, ignore_conflicts=True)
+    return len(chunks)
+
+
+def free() -> Q:
+    """Condition of the chunks not leased by a worker"""
+    return Q(leased_until=None) | Q(leased_until__lt=timezone.now())
+
+
+def pending_chunks(message: CircularMessage) -> List[int]:
+    """Ids of the chunks not done yet and not sent by a worker now"""
+    return list(message.chunks.filter(free(), is_done=False).order_by('number').values_list('id', flat=True))
+
+
+def lease_until() -> datetime:
+    """End of a lease taken or renewed now"""
+    return timezone.now() + timedelta(seconds=CIRCULAR_LEASE)
+
+
+def lease_chunk(chunk_id: int, lease: str) -> bool:
+    """Take the chunk not done yet for `CIRCULAR_LEASE` seconds unless another worker holds it
+
+    :param chunk_id: chunk id
+    :type chunk_id: int
+    :param lease: token of the worker
+    :type lease: str
+    :return: True if the chunk is taken
+    """
+    return bool(CircularChunk.objects.filter(free(), id=chunk_id, is_done=False)
+                .update(lease=lease, leased_until=lease_until()))
+
+
+def finish(message: CircularMessage) -> bool:
+    """Mark the message finished if all its chunks are done
+
+    :param message: circular message
+    :type message: CircularMessage
+    :return: True if the message is finished now
+    """
+    if message.chunks.filter(is_done=False).exists():
+        return False
+
+    return bool(CircularMessage.objects.filter(id=message.id, finished=None).update(finished=timezone.now()))
+
+
+def _letters(message: CircularMessage, batch: List[Tuple[int, str]],
+             taken: List[str]) -> Iterator[Tuple[str, str, List[str]]]:
+    """Letters of the batch for `send_batch`, the addresses are added to `taken` as the letters are taken"""
+    for _, email in batch:
+        taken.append(email)
+        yield message.subject, message.body, [email]
+
+
+def send_chunk(chunk_id: int, give_up: bool = False, bucket: Optional[TokenBucket] = None,
+               batch_size: int = CIRCULAR_BATCH_SIZE) -> Optional[CircularChunk]:
+    """Send the letters of a chunk after its position
+
+    An error of the mail backend is raised after the letters sent before it are
+    counted, unless `give_up` is set: then the rest of the batch is counted
+    failed and the sending goes on. The chunk is leased while it
+    is sent; the sending stops if the lease is lost to another worker.
+    :param chunk_id: chunk id
+    :type chunk_id: int
+    :param give_up: count the failed batches instead of raising
+    :type give_up: bool
+    :param bucket: rate limit, the shared one by default
+    :type bucket: TokenBucket
+    :param batch_size: letters per batch
+    :type batch_size: int
+    :return: the chunk or None if it is done already or sent by another worker
+    """
+    lease = uuid.uuid4().hex
+    if not lease_chunk(chunk_id, lease):
+        return None
+
+    try:
+        return _send_chunk(chunk_id, lease, give_up, bucket or TokenBucket(), batch_size)
+    finally:
+        # a chunk left unfinished is free for the retry at once
+        CircularChunk.objects.filter(id=chunk_id, lease=lease).update(lease='', leased_until=None)
+
+
+def _send_chunk(chunk_id: int, lease: str, give_up: bool, bucket: TokenBucket,
+                batch_size: int) -> Optional[CircularChunk]:
+    chunk = CircularChunk.objects.select_related('message').get(id=chunk_id)
+
+    message = chunk.message
+    from_email = get_sender_email()
+    if from_email is None:
+        logger.warning('Circular message %s is not sent, the sender is not configured', message.id)
+        return chunk
+
+    emails = recipients(message).filter(pk__lte=chunk.last_id).order_by('pk').values_list('pk', 'email')
+    with get_connection(fail_silently=False) as connection:
+        while True:
+            batch = list(emails.filter(pk__gt=max(chunk.position, chunk.first_id - 1))[:batch_size])
+            if not batch:
+                break
+
+            bucket.acquire(len(batch))
+            taken: List[str] = []
+            error = None
+            try:
+                sent = send_batch(_letters(message, batch, taken), from_email=from_email, connection=connection,
+                                  batch_size=1)
+            except (SMTPException, OSError) as exc:
+                # letters are passed to the backend one by one, the last one taken has failed
+                sent, error = max(len(taken) - 1, 0), exc
+
+            if error is not None and give_up:
+                logger.warning('Circular message %s: %s letters given up', message.id, len(batch) - sent,
+                               exc_info=error)
+            # the letters sent before the error are not sent again by the retry
+            done = batch[:sent] if error is not None and not give_up else batch
+            if done:
+                chunk.position = done[-1][0]
+                # the lease is renewed with the position
+                if not CircularChunk.objects.filter(id=chunk.id, lease=lease).update(
+                        position=chunk.position, sent=F('sent') + sent, failed=F('failed') + len(done) - sent,
+                        leased_until=lease_until()):
+                    logger.warning('Circular chunk %s is taken by another worker', chunk.id)
+                    return None
+            if error is not None and not give_up:
+                raise error
+
+    # recipients gone since the planning are not counted
+    CircularChunk.objects.filter(id=chunk.id).update(size=F('sent') + F('failed'), is_done=True)
+    finish(message)
+    return chunk
@@ -0,0 +1,212 @@
+"""Counters
+
+Item views are counted in a Redis hash with atomic HINCRBY and written into
+`ItemModel.views` in batches by the `flush_item_views` task.
+
+Trending items are kept in hourly Redis sorted sets, the last `TRENDING_HOURS`
+of them are merged with decaying weights into a rolling window.
+"""
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import models, transaction
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+from .models import ItemModel, ViewsFlush
+
+PENDING_KEY = 'item-views:pending'
+FLUSHING_KEY = 'item-views:flushing'
+FLUSH_ID_KEY = 'item-views:flush-id'
+FLUSH_LOCK_KEY = 'item-views:flush-lock'
+TRENDING_BUCKET_KEY = 'item-trending:{hour}'
+TRENDING_KEY = 'item-trending:window'
+# set with the window, ZUNIONSTORE of empty buckets leaves no window key
+TRENDING_MERGED_KEY = 'item-trending:merged'
+
+TRENDING_HOURS = getattr(settings, 'TRENDING_HOURS', 24)
+TRENDING_HALF_LIFE = getattr(settings, 'TRENDING_HALF_LIFE', 6)
+TRENDING_WINDOW_TTL = 60
+# seconds, longer than any flush
+FLUSH_LOCK_TIMEOUT = getattr(settings, 'FLUSH_LOCK_TIMEOUT', 300)
+
+
+def _redis() -> Any:
+    return get_redis_connection('default')
+
+
+def _current_hour() -> int:
+    return int(time.time() // 3600)
+
+
+def record_view(item_id: int) -> int:
+    """Count one view of the item
+
+    :param item_id: item id
+    :type item_id: int
+    :return: views of the item not written into the database yet, this one included
+    """
+    bucket = TRENDING_BUCKET_KEY.format(hour=_current_hour())
+    pipe = _redis().pipeline()
+    pipe.hincrby(PENDING_KEY, item_id, 1)
+    pipe.hget(FLUSHING_KEY, item_id)
+    pipe.zincrby(bucket, 1, item_id)
+    pipe.expire(bucket, (TRENDING_HOURS + 1) * 3600)
+    pending, flushing, *_ = pipe.execute()
+
+    return int(pending) + int(flushing or 0)
+
+
+def pending_views() -> Dict[int, int]:
+    """Views not written into the database yet
+
+    :return: dict item id -> amount of views
+    """
+    pipe = _redis().pipeline()
+    pipe.hgetall(PENDING_KEY)
+    pipe.hgetall(FLUSHING_KEY)
+    views: Dict[int, int] = {}
+    for counters in pipe.execute():
+        for item_id, amount in counters.items():
+            views[int(item_id)] = views.get(int(item_id), 0) + int(amount)
+
+    return views
+
+
+def flush_views(batch_size: int = 1000) -> int:
+    """Add the counted views to `ItemModel.views`
+
+    Pending counters are renamed at once, new views keep being counted into a
+    new hash meanwhile. Counters left by a failed flush are written first.
+
+    Only one flush runs at a time, under a Redis lock. The renamed counters get
+    an id written with the views in one transaction, so the counters of a
+    flush failed after the commit are dropped instead of added again.
+    :param batch_size: amount of items per UPDATE
+    :type batch_size: int
+    :return: amount of the updated items
+    """
+    connection = _redis()
+    lock = connection.lock(FLUSH_LOCK_KEY, timeout=FLUSH_LOCK_TIMEOUT, blocking_timeout=0)
+    if not lock.acquire():
+        # another flush is running
+        return 0
+
+    try:
+        return _flush(connection, batch_size)
+    finally:
+        lock.release()
+
+
+def _flush(connection: Any, batch_size: int) -> int:
+    if not connection.exists(FLUSHING_KEY):
+        if not connection.exists(PENDING_KEY):
+            return 0
+        try:
+            connection.pipeline().rename(PENDING_KEY, FLUSHING_KEY).set(FLUSH_ID_KEY, uuid.uuid4().hex).execute()
+        except ResponseError:
+            return 0
+
+    flush_id = connection.get(FLUSH_ID_KEY)
+    if flush_id is None:
+        # counters renamed before the flush ids
+        flush_id = uuid.uuid4().hex.encode()
+        connection.set(FLUSH_ID_KEY, flush_id)
+
+    deltas = [(int(item_id), int(amount)) for item_id, amount in connection.hgetall(FLUSHING_KEY).items()]
+    with transaction.atomic():
+        if ViewsFlush.objects.filter(flush_id=flush_id.decode()).exists():
+            deltas = []
+        else:
+            ViewsFlush.objects.all().delete()
+            ViewsFlush.objects.create(flush_id=flush_id.decode())
+
+        for start in range(0, len(deltas), batch_size):
+            batch = deltas[start:start + batch_size]
+            delta = models.Case(
+                *(models.When(pk=item_id, then=models.Value(amount)) for item_id, amount in batch),
+                default=models.Value(0),
+                output_field=models.PositiveIntegerField(),
+            )
+            ItemModel.objects.filter(pk__in=[item_id for item_id, _ in batch]).update(views=models.F('views') + delta)
+
+    connection.delete(FLUSHING_KEY, FLUSH_ID_KEY)
+    return len(deltas)
+
+
+def merge_trending() -> None:
+    """Merge the hourly buckets into the rolling window
+
+    Views of every hour weigh half as much as views `TRENDING_HALF_LIFE` hours later.
+    :return: None
+    """
+    hour = _current_hour()
+    weights = {
+        TRENDING_BUCKET_KEY.format(hour=hour - age): 0.5 ** (age / TRENDING_HALF_LIFE)
+        for age in range(TRENDING_HOURS)
+    }
+    pipe = _redis().pipeline()
+    pipe.zunionstore(TRENDING_KEY, weights, aggregate='SUM')
+    pipe.expire(TRENDING_KEY, TRENDING_WINDOW_TTL)
+    pipe.set(TRENDING_MERGED_KEY, 1, ex=TRENDING_WINDOW_TTL)
+    pipe.execute()
+
+
+def trending_ids(limit: int) -> List[int]:
+    """Ids of the most viewed items of the window
+
+    :param limit: amount of ids
+    :type limit: int
+    :return: list of ids, most viewed first
+    """
+    connection = _redis()
+    if not connection.exists(TRENDING_MERGED_KEY):
+        merge_trending()
+
+    return [int(item_id) for item_id in connection.zrevrange(TRENDING_KEY, 0, limit - 1)]
+
+
+def trending_items(limit: int) -> List[ItemModel]:
+    """Most viewed published items, loaded by one `id__in` query
+
+    :param limit: amount of items
+    :type limit: int
+    :return: list of items, most viewed first
+    """
+    ids = trending_ids(limit)
+    items = ItemModel.objects.listing().in_bulk(ids)
+    return [items[item_id] for item_id in ids if item_id in items]
+
+
+def rebuild_trending(views: Iterable[Tuple[int, int]], batch_size: int = 1000) -> int:
+    """Replace the buckets of the window with the given amounts of views in the current one
+
+    :param views: pairs of item id and amount of views
+    :type views: iterable
+    :param batch_size: amount of items per ZADD
+    :type batch_size: int
+    :return: amount of items
+    """
+    hour = _current_hour()
+    bucket = TRENDING_BUCKET_KEY.format(hour=hour)
+    connection = _redis()
+    connection.delete(TRENDING_KEY, TRENDING_MERGED_KEY,
+                      *(TRENDING_BUCKET_KEY.format(hour=hour - age) for age in range(TRENDING_HOURS)))
+
+    total = 0
+    batch: Dict[int, int] = {}
+    for item_id, amount in views:
+        batch[item_id] = amount
+        if len(batch) == batch_size:
+            connection.zadd(bucket, batch)
+            total += len(batch)
+            batch.clear()
+
+    if batch:
+        connection.zadd(bucket, batch)
+        total += len(batch)
+
+    connection.expire(bucket, (TRENDING_HOURS + 1) * 3600)
+    return total
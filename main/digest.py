@@ -0,0 +1,150 @@
+"""Digests
+
+Subscribers follow tags and category subtrees, a subscriber following nothing
+gets every new item. `DigestIndex` keeps the followers of every tag and
+category as sorted arrays of subscriber ids and is built once per run.
+
+New items are matched against the index in memory, by ranges of subscriber
+ids: the matches held at once are bounded by the size of the range and the
+amount of the items, whatever the amount of the subscribers. Subscribers of a
+range with the same matching items are grouped, so a digest is rendered once
+per distinct set of items.
+"""
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db.models import Count, Exists, Max, OuterRef
+
+from .models import CategoryModel, ItemModel, Subscriber
+
+DIGEST_SHARD_SIZE = getattr(settings, 'DIGEST_SHARD_SIZE', 10000)
+# items listed in a digest, the rest is linked
+DIGEST_SIZE = getattr(settings, 'DIGEST_SIZE', 100)
+
+# item id, ids of its tags, id of its category
+Item = Tuple[int, Sequence[int], Optional[int]]
+
+
+def _followers(rows: Iterable[Tuple[int, int]]) -> Dict[int, array]:
+    followers: Dict[int, array] = defaultdict(lambda: array('L'))
+    for key, subscriber_id in rows:
+        followers[key].append(subscriber_id)
+
+    return dict(followers)
+
+
+def _slice(followers: array, start: int, stop: int) -> array:
+    return followers[bisect_left(followers, start):bisect_left(followers, stop)]
+
+
+class DigestIndex:
+    """Subscribers by the tags and categories they follow
+
+    :param tags: dict tag id -> sorted array of subscriber ids
+    :type tags: dict
+    :param categories: dict category id -> sorted array of subscriber ids
+    :type categories: dict
+    :param everyone: sorted array of ids of the subscribers following nothing
+    :type everyone: array
+    :param parents: dict category id -> parent id
+    :type parents: dict
+    :param last_id: the greatest subscriber id
+    :type last_id: int
+    :param size: amount of the subscribers
+    :type size: int
+    """
+
+    def __init__(self, tags: Dict[int, array], categories: Dict[int, array], everyone: array,
+                 parents: Dict[int, Optional[int]], last_id: int, size: int) -> None:
+        self.tags = tags
+        self.categories = categories
+        self.everyone = everyone
+        self.parents = parents
+        self.last_id = last_id
+        self.size = size
+
+    @classmethod
+    def build(cls, batch_size: int = 10000) -> 'DigestIndex':
+        """Read the follows of all the subscribers, ordered by subscriber id
+
+        :param batch_size: rows fetched at once
+        :type batch_size: int
+        :return: index
+        """
+        tags = Subscriber.tags.through.objects.order_by('subscriber_id', 'tagmodel_id')
+        categories = Subscriber.categories.through.objects.order_by('subscriber_id', 'categorymodel_id')
+        everyone = (Subscriber.objects
+                    .filter(~Exists(tags.filter(subscriber_id=OuterRef('pk'))),
+                            ~Exists(categories.filter(subscriber_id=OuterRef('pk'))))
+                    .order_by('pk').values_list('pk', flat=True))
+        stats = Subscriber.objects.aggregate(last_id=Max('id'), size=Count('id'))
+
+        return cls(
+            tags=_followers(tags.values_list('tagmodel_id', 'subscriber_id').iterator(chunk_size=batch_size)),
+            categories=_followers(
+                categories.values_list('categorymodel_id', 'subscriber_id').iterator(chunk_size=batch_size)),
+            everyone=array('L', everyone.iterator(chunk_size=batch_size)),
+            parents=dict(CategoryModel.objects.values_list('id', 'parent_id')),
+            last_id=stats['last_id'] or 0,
+            size=stats['size'],
+        )
+
+    def shards(self, size: int = DIGEST_SHARD_SIZE) -> Iterator[Tuple[int, int]]:
+        """Ranges of subscriber ids, the end excluded"""
+        for start in range(0, self.last_id + 1, size):
+            yield start, start + size
+
+    def _ancestors(self, category_id: Optional[int]) -> Iterator[int]:
+        while category_id is not None:
+            yield category_id
+            category_id = self.parents.get(category_id)
+
+    def match(self, items: Sequence[Item], start: int, stop: int) -> Dict[Tuple[int, ...], List[int]]:
+        """Group the subscribers of a range by the items they get
+
+        :param items: new items
+        :type items: list of tuples of item id, tag ids and category id
+        :param start: the first subscriber id of the range
+        :type start: int
+        :param stop: subscriber id after the range
+        :type stop: int
+        :return: dict tuple of item ids, in the order of `items` -> list of subscriber ids
+        """
+        matches: Dict[int, List[int]] = defaultdict(list)
+        for item_id, tag_ids, category_id in items:
+            lists = [self.tags.get(tag_id) for tag_id in tag_ids]
+            lists += [self.categories.get(ancestor) for ancestor in self._ancestors(category_id)]
+            matched = set()
+            for followers in lists:
+                if followers:
+                    matched.update(_slice(followers, start, stop))
+            for subscriber_id in matched:
+                matches[subscriber_id].append(item_id)
+
+        groups: Dict[Tuple[int, ...], List[int]] = defaultdict(list)
+        for subscriber_id, item_ids in matches.items():
+            groups[tuple(item_ids)].append(subscriber_id)
+
+        everyone = _slice(self.everyone, start, stop)
+        if everyone and items:
+            groups[tuple(item_id for item_id, _, _ in items)].extend(everyone)
+
+        return dict(groups)
+
+
+def item_tags(item_ids: Iterable[int]) -> Dict[int, List[int]]:
+    """Tag ids of the items, one query
+
+    :param item_ids: item ids
+    :type item_ids: iterable
+    :return: dict item id -> list of tag ids
+    """
+    tags: Dict[int, List[int]] = defaultdict(list)
+    for item_id, tag_id in (ItemModel.tag.through.objects.filter(itemmodel_id__in=list(item_ids))
+                            .values_list('itemmodel_id', 'tagmodel_id')):
+        tags[item_id].append(tag_id)
+
+    return tags
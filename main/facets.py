@@ -0,0 +1,212 @@
+"""Facets
+
+Filters of the item list by price range, currency, category subtree, seller
+and availability, with the amount of items next to every value.
+
+All the counts come from one query: a UNION ALL of one GROUP BY per facet,
+each filtered by the other facets. The counts of a facet ignore its own filter,
+so the other values of the facet stay visible with the amounts they would give.
+Categories are grouped by their position in the tree and rolled up over the
+cached category tree. The result is cached per filter combination and listing
+version.
+"""
+import hashlib
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import CharField, Count, F, IntegerField, Value
+from django.db.models.functions import Cast
+from django.http import QueryDict
+
+from .categories import category_tree, find_category
+from .models import CategoryModel, ItemQuerySet
+
+FACETS_KEY = 'facets:{digest}'
+
+FACET_SIZE = getattr(settings, 'FACET_SIZE', 10)
+FACETS_CACHE_TTL = getattr(settings, 'FACETS_CACHE_TTL', 60 * 60)
+
+FACETS = ('currency', 'category', 'seller', 'in_stock')
+RANGES = ('price_min', 'price_max')
+
+
+class ItemFilter:
+    """Filters of the item list from the query parameters
+
+    Unknown or malformed values are ignored.
+    """
+
+    def __init__(self, params: QueryDict) -> None:
+        self.values: Dict[str, Any] = {}
+        for facet in ('currency', 'category', 'seller'):
+            try:
+                self.values[facet] = int(params.get(facet, ''))
+            except ValueError:
+                pass
+
+        if params.get('in_stock') in ('0', '1'):
+            self.values['in_stock'] = params['in_stock'] == '1'
+
+        for name in RANGES:
+            try:
+                self.values[name] = float(params.get(name, ''))
+            except ValueError:
+                pass
+
+        self.category: Optional[CategoryModel] = None
+        if 'category' in self.values:
+            self.category = find_category(self.values['category'])
+            if self.category is None:
+                del self.values['category']
+
+    def digest(self) -> str:
+        return hashlib.md5(repr(sorted(self.values.items())).encode()).hexdigest()
+
+    def apply(self, queryset: ItemQuerySet, facets: bool = True, skip: Optional[str] = None) -> ItemQuerySet:
+        """Filter the items
+
+        :param queryset: items
+        :type queryset: ItemQuerySet
+        :param facets: apply the facet filters too, not only the price range
+        :type facets: bool
+        :param skip: facet whose filter is not applied
+        :type skip: str
+        :return: filtered queryset
+        """
+        if 'price_min' in self.values:
+            queryset = queryset.filter(price__gte=self.values['price_min'])
+        if 'price_max' in self.values:
+            queryset = queryset.filter(price__lte=self.values['price_max'])
+        if not facets:
+            return queryset
+
+        for facet in ('currency', 'seller', 'in_stock'):
+            if facet != skip and facet in self.values:
+                queryset = queryset.filter(**{facet: self.values[facet]})
+        if skip != 'category' and self.category is not None:
+            queryset = queryset.in_category(self.category)
+
+        return queryset
+
+
+def _facet_counts(queryset: ItemQuerySet, item_filter: ItemFilter, facet: str, value: Any, label: Any,
+                  position: Any = Value(0)) -> ItemQuerySet:
+    # rows of the union: facet, value, label, position in the category tree, amount
+    rows = (item_filter.apply(queryset, skip=facet)
+            .filter(**{f'{facet}__isnull': False})
+            .values(facet_name=Value(facet, output_field=CharField()), value=value, label=label,
+                    position=Cast(position, IntegerField()))
+            .annotate(amount=Count('id'))
+            .order_by())
+    if facet == 'category':
+        return rows
+
+    return rows.order_by('-amount', 'value')[:FACET_SIZE]
+
+
+def _categories(rows: List[dict], item_filter: ItemFilter) -> List[dict]:
+    # subcategories of the chosen category, or the root categories, with the items of their subtrees;
+    # rows are grouped by tree id and left edge, every row goes to the category whose subtree holds it
+    selected = item_filter.category
+    categories = list(selected.subcategories if selected is not None else category_tree())
+    starts = [(category.tree_id, category.lft) for category in categories]
+    counts = [0] * len(categories)
+    for row in rows:
+        idx = bisect_right(starts, (row['value'], row['position'])) - 1
+        if idx >= 0 and categories[idx].tree_id == row['value'] and row['position'] <= categories[idx].rght:
+            counts[idx] += row['amount']
+
+    return [{'value': category.id, 'label': category.name, 'count': count}
+            for category, count in zip(categories, counts) if count]
+
+
+def count_facets(queryset: ItemQuerySet, item_filter: ItemFilter) -> dict:
+    """Amounts of items per facet value
+
+    :param queryset: items of the list, without the filters
+    :type queryset: ItemQuerySet
+    :param item_filter: filters chosen by the user
+    :type item_filter: ItemFilter
+    :return: dict facet -> list of dicts with `value`, `label` and `count`
+    """
+    no_label = Value('', output_field=CharField())
+    counts = [
+        _facet_counts(queryset, item_filter, 'currency', F('currency'), F('currency__short_name')),
+        _facet_counts(queryset, item_filter, 'seller', F('seller'), F('seller__username')),
+        _facet_counts(queryset, item_filter, 'in_stock', Cast('in_stock', IntegerField()), no_label),
+        _facet_counts(queryset, item_filter, 'category', F('category__tree_id'), no_label, F('category__lft')),
+    ]
+    rows: Dict[str, List[dict]] = {facet: [] for facet in FACETS}
+    for row in counts[0].union(*counts[1:], all=True):
+        rows[row['facet_name']].append(row)
+
+    def values(facet: str) -> List[dict]:
+        ordered = sorted(rows[facet], key=lambda row: (-row['amount'], row['value']))
+        return [{'value': row['value'], 'label': row['label'], 'count': row['amount']} for row in ordered]
+
+    in_stock = {1: 'In stock', 0: 'Out of stock'}
+    facets = {
+        'currency': values('currency'),
+        'category': _categories(rows['category'], item_filter),
+        'seller': values('seller'),
+        'in_stock': [dict(value, label=in_stock[value['value']]) for value in values('in_stock')],
+    }
+
+    return facets
+
+
+def link_facets(facets: dict, item_filter: ItemFilter, params: QueryDict) -> List[dict]:
+    """Facets ready for rendering
+
+    Every value gets the query string toggling it, a chosen value is marked active.
+    Pagination parameters are dropped, the filtered list starts from its first page.
+    :param facets: result of `get_facets`
+    :type facets: dict
+    :param item_filter: filters chosen by the user
+    :type item_filter: ItemFilter
+    :param params: query parameters of the request
+    :type params: QueryDict
+    :return: list of dicts with `name`, `title` and `values`
+    """
+    titles = {'currency': 'Currency', 'category': 'Category', 'seller': 'Seller', 'in_stock': 'Availability'}
+    linked = []
+    for facet in FACETS:
+        values = []
+        for value in facets[facet]:
+            query = params.copy()
+            for name in ('page', 'cursor'):
+                query.pop(name, None)
+            active = item_filter.values.get(facet) == value['value'] and facet != 'category'
+            if active:
+                query.pop(facet, None)
+            else:
+                query[facet] = value['value']
+            values.append(dict(value, active=active, query=query.urlencode()))
+
+        linked.append({'name': facet, 'title': titles[facet], 'values': values})
+
+    return linked
+
+
+def get_facets(queryset: ItemQuerySet, item_filter: ItemFilter, scope: str, version: str) -> dict:
+    """Cached `count_facets`
+
+    :param queryset: items of the list, without the filters
+    :type queryset: ItemQuerySet
+    :param item_filter: filters chosen by the user
+    :type item_filter: ItemFilter
+    :param scope: name of the list, e.g. the tag
+    :type scope: str
+    :param version: version of the listing, see main.cache
+    :type version: str
+    :return: dict facet -> list of values
+    """
+    key = FACETS_KEY.format(digest=hashlib.md5(f'{scope}:{version}:{item_filter.digest()}'.encode()).hexdigest())
+    facets = cache.get(key)
+    if facets is None:
+        facets = count_facets(queryset, item_filter)
+        cache.set(key, facets, FACETS_CACHE_TTL)
+
+    return facets
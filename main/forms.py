@@ -1,7 +1,9 @@
 from django import forms
+from django.db import transaction
 
 from ckeditor.widgets import CKEditorWidget
 
+from .models import CircularMessage
 from .tasks import send_circular_message
 
 # class UserForm(forms.ModelForm):
@@ -32,9 +34,20 @@ class SendMessage(forms.Form):
     body = forms.CharField(widget=CKEditorWidget, label='Message')
     is_seller = forms.BooleanField(label='Seller only', required=False)
 
-    def send_messages(self):
+    def send_messages(self, author):
+        """Save the message and queue its sending
+
+        :param author: staff user who submitted the message
+        :type author: User
+        :return: the message or None if it is empty
+        """
         if len(self.cleaned_data['subject']) and len(self.cleaned_data['body']):
-            subj = self.cleaned_data['subject']
-            body = self.cleaned_data['body']
-            is_seller = bool(self.cleaned_data['is_seller'])
-            send_circular_message.delay(subj, body, is_seller)
+            message = CircularMessage.objects.create(
+                author=author,
+                subject=self.cleaned_data['subject'],
+                body=self.cleaned_data['body'],
+                is_seller=bool(self.cleaned_data['is_seller']),
+            )
+            transaction.on_commit(lambda: send_circular_message.delay(message.id))
+
+            return message
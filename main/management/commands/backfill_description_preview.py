@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from main.models import ItemModel, preview_expression
+
+
+class Command(BaseCommand):
+    """Filling the stored description previews of the items saved before they appeared
+
+    The previews are computed by the database in batches of ids, descriptions
+    are not loaded. Items with a preview are skipped, so the command may be
+    interrupted and run again.
+
+    example:
+    python manage.py backfill_description_preview --batch 5000
+    """
+    help = 'Fill ItemModel.description_preview of the existing items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=5000, help='Range of ids per UPDATE')
+
+    def handle(self, *args, **options):
+        missing = ItemModel.objects.filter(description_preview='').exclude(description='')
+        bounds = missing.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            self.stdout.write('Nothing to do')
+            return
+
+        total = 0
+        for start in range(bounds['first'], bounds['last'] + 1, options['batch']):
+            total += missing.filter(id__gte=start, id__lt=start + options['batch']).update(
+                description_preview=preview_expression())
+
+        self.stdout.write(f'Previews of {total} items filled')
@@ -0,0 +1,198 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, QueryDict
+from django.test import RequestFactory
+from django.urls import resolve, reverse
+
+from main.facets import ItemFilter, count_facets
+from main.models import CategoryModel, CurrencyModel, ItemModel, SellerModel, cut_description
+from main.paginators import CursorPaginator
+from main.search import _suggest, search_items, suggest_names
+from main.sms import FakeClient, send_sms
+from py_dev_user.middleware import metric_middleware
+
+WORDS = (
+    'socks', 'hat', 'scarf', 'gloves', 'jacket', 'boots', 'shirt', 'sweater', 'wool', 'cotton', 'warm', 'summer',
+    'winter', 'sport', 'classic', 'kids', 'leather', 'knitted', 'red', 'black', 'striped', 'waterproof', 'light',
+)
+
+
+class Command(BaseCommand):
+    """Measuring latency of the catalog hot paths on synthetic data
+
+    example:
+    python manage.py benchmark pagination --items 1000000 --page 1000
+    python manage.py benchmark search --items 1000000 --query "warm socks" --query model42
+    python manage.py benchmark autocomplete --query wa --query "warm so" --query sokcs
+    python manage.py benchmark facets --sizes 10000 100000 1000000
+    python manage.py benchmark sms --texts 1000 --latency 100 --workers 1 8 32
+    python manage.py benchmark metrics --repeat 100000
+    """
+    help = 'Benchmark catalog queries'
+    scenarios = ('pagination', 'search', 'autocomplete', 'facets', 'sms', 'metrics')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=self.scenarios)
+        parser.add_argument('--items', type=int, default=0, help='Make sure the catalog has at least so many items')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--page', type=int, default=1000)
+        parser.add_argument('--per_page', type=int, default=5)
+        parser.add_argument('--query', action='append', help='Search string, may be repeated')
+        parser.add_argument('--sizes', type=int, nargs='*', default=[], help='Catalog sizes to measure one by one')
+        parser.add_argument('--texts', type=int, default=1000, help='Amount of SMS to send')
+        parser.add_argument('--latency', type=float, default=100, help='Milliseconds per fake SMS send')
+        parser.add_argument('--workers', type=int, nargs='*', default=[1, 8, 32], help='Pool sizes to measure')
+
+    def handle(self, *args, **options):
+        if options['items']:
+            self.populate(options['items'])
+
+        getattr(self, 'bench_' + options['scenario'])(**options)
+
+    def populate(self, amount, batch_size=10000):
+        """Top up the catalog with synthetic items"""
+        missing = amount - ItemModel.objects.count()
+        if missing <= 0:
+            return
+
+        sellers = [SellerModel.objects.get_or_create(username=f'benchmark{idx}')[0] for idx in range(20)]
+        currencies = [CurrencyModel.objects.get_or_create(short_name=name, defaults={'full_name': name})[0]
+                      for name in ('грн.', '$', '€')]
+        categories = self.categories()
+        words = random.Random(missing)
+        started = time.perf_counter()
+        while missing > 0:
+            size = min(batch_size, missing)
+            descriptions = ['<p>{} model{}</p><hr /><p>{}</p>'.format(
+                ' '.join(words.sample(WORDS, 5)), idx % 1000, ' '.join(words.sample(WORDS, 10))) for idx in range(size)]
+            ItemModel.objects.bulk_create(
+                ItemModel(short_name=' '.join(words.sample(WORDS, 2)) + f' {idx}',
+                          description=description, description_preview=cut_description(description),
+                          seller=sellers[idx % len(sellers)], price=idx % 1000,
+                          currency=currencies[idx % len(currencies)], category=categories[idx % len(categories)],
+                          in_stock=idx % 7 != 0)
+                for idx, description in enumerate(descriptions)
+            )
+            missing -= size
+
+        self.stdout.write(f'Populated {amount} items in {time.perf_counter() - started:.1f}s')
+
+    def categories(self):
+        """Two levels of benchmark categories, leaves only"""
+        leaves = []
+        for root_idx in range(5):
+            root, _ = CategoryModel.objects.get_or_create(name=f'benchmark {root_idx}', parent=None)
+            leaves += [CategoryModel.objects.get_or_create(name=f'benchmark {root_idx}.{idx}', parent=root)[0]
+                       for idx in range(4)]
+
+        return leaves
+
+    def measure(self, title, func, repeat):
+        func()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+
+        timings.sort()
+        p95, p99 = (timings[min(len(timings) - 1, int(len(timings) * q))] for q in (0.95, 0.99))
+        self.stdout.write(f'{title:<30} median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms   '
+                          f'p99 {p99:8.2f} ms')
+
+    def bench_pagination(self, page, per_page, repeat, **options):
+        queryset = ItemModel.objects.listing()
+        paginator = CursorPaginator(queryset, per_page)
+
+        # cursor of the requested page is taken from the last row of the page before it
+        offset = (page - 1) * per_page
+        previous = queryset.order_by(*paginator.ordering)[offset - 1:offset].first() if offset else None
+        cursor = paginator.encode_cursor(previous, False) if previous else None
+
+        def offset_page():
+            list(Paginator(queryset, per_page).page(page).object_list)
+
+        def cursor_page():
+            list(CursorPaginator(queryset, per_page).page(cursor).object_list)
+
+        self.measure(f'offset, page {page}', offset_page, repeat)
+        self.measure(f'cursor, page {page}', cursor_page, repeat)
+
+    def bench_search(self, query, per_page, repeat, **options):
+        for text in query or ['warm socks', 'model42']:
+            def full_text():
+                list(CursorPaginator(search_items(text), per_page, ordering=('-rank', '-id')).page().object_list)
+
+            def icontains():
+                words = Q()
+                for word in text.split():
+                    words &= Q(short_name__icontains=word) | Q(description__icontains=word)
+                list(ItemModel.objects.listing().filter(words).order_by('-item_create', '-id')[:per_page])
+
+            self.measure(f'full-text, "{text}"', full_text, repeat)
+            self.measure(f'icontains, "{text}"', icontains, repeat)
+
+    def bench_autocomplete(self, query, repeat, **options):
+        for text in query or ['wa', 'warm so', 'sokcs']:
+            def database():
+                _suggest.cache_clear()
+                suggest_names(text)
+
+            self.measure(f'autocomplete db, "{text}"', database, repeat)
+            self.measure(f'autocomplete lru, "{text}"', lambda: suggest_names(text), repeat)
+
+    def bench_facets(self, sizes, per_page, repeat, **options):
+        for size in sizes or [ItemModel.objects.count()]:
+            self.populate(size)
+            root = CategoryModel.objects.filter(name='benchmark 0').first()
+            filters = {
+                'no filters': QueryDict(),
+                'category, in stock': QueryDict(f'category={root.pk if root else 0}&in_stock=1'),
+                'price range': QueryDict('price_min=100&price_max=200'),
+            }
+            for title, params in filters.items():
+                def facet_page():
+                    item_filter = ItemFilter(params)
+                    count_facets(ItemModel.objects.published(), item_filter)
+                    list(item_filter.apply(ItemModel.objects.listing())[:per_page])
+
+                self.measure(f'{size} items, {title}', facet_page, repeat)
+
+    def bench_sms(self, texts, latency, workers, **options):
+        user, _ = User.objects.get_or_create(username='benchmark sms')
+        messages = [(user.id, f'+1555{idx:07d}', '1234') for idx in range(texts)]
+        for amount in workers:
+            # the log rows are not kept
+            with transaction.atomic():
+                started = time.perf_counter()
+                send_sms(messages, client=FakeClient(latency / 1000), workers=amount)
+                elapsed = time.perf_counter() - started
+                transaction.set_rollback(True)
+
+            title = f'{texts} texts, {amount} workers'
+            self.stdout.write(f'{title:<30} {elapsed:8.2f} s    {texts / elapsed:8.1f} texts/s')
+
+    def bench_metrics(self, repeat, **options):
+        request = RequestFactory().get(reverse('item_list'))
+        request.resolver_match = resolve(request.path)
+        response = HttpResponse()
+
+        def view(request):
+            return response
+
+        timings = {}
+        for title, handler in (('bare view', view), ('metric_middleware', metric_middleware(view))):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                handler(request)
+            timings[title] = (time.perf_counter() - started) / repeat * 1e6
+            self.stdout.write(f'{title:<30} {timings[title]:8.2f} us per request')
+
+        self.stdout.write(f'{"overhead":<30} {timings["metric_middleware"] - timings["bare view"]:8.2f} us per request')
@@ -1,38 +1,266 @@
-from django.core.management.base import BaseCommand
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, models
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+# seconds the watermark is moved back by, longer than the transactions saving the rows
+DUMP_WATERMARK_MARGIN = getattr(settings, 'DUMP_WATERMARK_MARGIN', 5 * 60)
+
+
+def open_dump(path: str, compress: str = None) -> IO[str]:
+    """Text file, compressed or not
+
+    :param path: file name without the extension of the compression
+    :type path: str
+    :param compress: None, 'gzip' or 'zstd'
+    :type compress: str
+    :return: file opened for writing
+    """
+    if compress == 'gzip':
+        return gzip.open(path + EXTENSIONS['gzip'], 'wt', encoding='utf-8', compresslevel=6)
+    if compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandError('zstd compression requires the zstandard package')
+        return zstandard.open(path + EXTENSIONS['zstd'], 'wt', encoding='utf-8')
+
+    return open(path, 'w', encoding='utf-8')
+
+
+def _escape(value) -> str:
+    """Value in the text format of COPY"""
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return 't' if value else 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def updated_field(model) -> Optional[models.DateTimeField]:
+    """auto_now field of the model, the watermark of the incremental dumps"""
+    for field in model._meta.concrete_fields:
+        if isinstance(field, models.DateTimeField) and field.auto_now:
+            return field
+
+    return None
+
+
+def dump_queryset(queryset: models.QuerySet, fields: List[models.Field], path: str, compress: str = None,
+                  chunk_size: int = 10000, use_copy: bool = True) -> int:
+    """Write the fields of the rows as tab separated values, the first line is the field names
+
+    Rows are streamed: on PostgreSQL by COPY (SELECT ...) TO STDOUT, elsewhere by
+    a server-side cursor of `chunk_size` rows. Both write the text format of COPY:
+    NULL is \\N, booleans are t and f, tabs and new lines are escaped.
+
+    :param queryset: rows
+    :type queryset: QuerySet
+    :param fields: concrete fields of the rows
+    :type fields: list
+    :param path: output file
+    :type path: str
+    :param compress: None, 'gzip' or 'zstd'
+    :type compress: str
+    :param chunk_size: rows fetched at once without COPY
+    :type chunk_size: int
+    :param use_copy: use COPY on PostgreSQL
+    :type use_copy: bool
+    :return: amount of the rows
+    """
+    values = queryset.order_by().values_list(*(field.attname for field in fields))
+    connection = connections[queryset.db]
+
+    with open_dump(path, compress) as file:
+        file.write('\t'.join(field.name for field in fields) + '\n')
+        if use_copy and connection.vendor == 'postgresql':
+            sql, params = values.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.copy_expert(f'COPY ({cursor.mogrify(sql, params).decode()}) TO STDOUT', file)
+                return cursor.rowcount
+
+        rows = 0
+        lines = []
+        for row in values.iterator(chunk_size=chunk_size):
+            lines.append('\t'.join(map(_escape, row)) + '\n')
+            if len(lines) == chunk_size:
+                file.writelines(lines)
+                rows += len(lines)
+                lines.clear()
+        file.writelines(lines)
+
+        return rows + len(lines)
+
+
+def dump_model(label: str, directory: str, output_file: str, since: datetime = None, m2m: bool = False,
+               **options: Any) -> List[Tuple[str, int, float]]:
+    """Dump a model to `<ModelName>_<output_file>`, its M2M links to `<ModelName>_<field>_<output_file>`
+
+    :param label: app_label.ModelName
+    :type label: str
+    :param directory: directory of the files
+    :type directory: str
+    :param output_file: suffix of the file names
+    :type output_file: str
+    :param since: dump only the rows updated since then, the links of these rows
+    :type since: datetime
+    :param m2m: dump the rows of the through tables of the M2M fields
+    :type m2m: bool
+    :param options: compress, chunk_size and use_copy of `dump_queryset`
+    :type options: dict
+    :return: list of label, amount of the rows and seconds of every file
+    """
+    model = apps.get_model(label)
+    queryset = model._base_manager.all()
+    if since is not None:
+        queryset = queryset.filter(**{f'{updated_field(model).name}__gte': since})
+
+    dumps = [(label, queryset, model._meta.concrete_fields, f'{model.__name__}_{output_file}')]
+    if m2m:
+        for field in model._meta.many_to_many:
+            through = field.remote_field.through
+            links = through._base_manager.all()
+            if since is not None:
+                # all the links of the changed rows: a consumer replaces the links of these rows
+                links = links.filter(**{f'{field.m2m_field_name()}__in': queryset.values('pk')})
+            dumps.append((f'{label}.{field.name}', links, through._meta.concrete_fields,
+                          f'{model.__name__}_{field.name}_{output_file}'))
+
+    results = []
+    for name, rows, fields, file_name in dumps:
+        started = time.perf_counter()
+        amount = dump_queryset(rows, fields, os.path.join(directory, file_name), **options)
+        results.append((name, amount, time.perf_counter() - started))
+
+    return results
 
 
 class Command(BaseCommand):
-    """Creating dump files in CSV format
+    """Creating dump files in the tab separated text format of COPY
+
+    Every model goes to its own file, `<ModelName>_<output_file>`, with the
+    extension of the compression. Rows are streamed from the database, so the
+    memory does not grow with the table. Several models are dumped in
+    parallel by `--workers` processes.
+
+    With `--since` or `--state_file` only the rows whose auto_now field
+    (`ItemModel.item_update`) is not older than the watermark are dumped. The
+    state file keeps the watermark of every model, the start of its last dump
+    less `--margin` seconds, so the nightly export reads only the rows changed
+    since the previous one. The auto_now value is set before the row is
+    committed: the margin catches the rows of the transactions committed after
+    the dump started, so it must be longer than the transactions saving the
+    rows. The rows changed within the margin are dumped again by the next run,
+    the consumers must tolerate the overlap and upsert the rows by id.
+    Models without an auto_now field are dumped in full. Deleted rows are not
+    in the incremental dumps.
+
+    `--m2m` also dumps the through tables of the M2M fields, like
+    `ItemModel_tag_<output_file>`. Incremental dumps have all the links of the
+    dumped rows.
 
     example:
-    python manage.py createdump main.ItemModel main.SellerModel main.CategoryModel main.CurrencyModel
+    python manage.py createdump main.ItemModel main.SellerModel main.CategoryModel main.CurrencyModel --compress gzip
+    python manage.py createdump main.ItemModel --m2m --state_file exports/state.json --output_file exports/dump.tsv
     """
     help = "Creating model's dump file"
 
     def add_arguments(self, parser):
         parser.add_argument('models', nargs='+', type=str)
         parser.add_argument('--output_file', type=str)
+        parser.add_argument('--compress', choices=sorted(EXTENSIONS), help='Compression of the files')
+        parser.add_argument('--workers', type=int, default=1, help='Amount of processes dumping the models')
+        parser.add_argument('--chunk_size', type=int, default=10000, help='Rows fetched at once without COPY')
+        parser.add_argument('--no_copy', action='store_true', help='Do not use COPY on PostgreSQL')
+        parser.add_argument('--since', type=str, help='Dump only the rows updated since the date or date and time')
+        parser.add_argument('--state_file', type=str, help='JSON file with the watermarks of the incremental dumps')
+        parser.add_argument('--m2m', action='store_true', help='Dump the through tables of the M2M fields')
+        parser.add_argument('--margin', type=int, default=DUMP_WATERMARK_MARGIN,
+                            help='Seconds the watermark of the state file is moved back by')
 
     def handle(self, *args, **options):
-        models = options['models']
-        output_file = options['output_file']
-        output_file = output_file if output_file else 'dump.csv'
-
-        for model in models:
-            app = model.split('.')
-            model_obj = getattr(__import__(app[0] + '.models', fromlist=['']), app[1])
-            file_name = app[1] + '_' + output_file
-            with open(file_name, 'w') as file:
-                rows = model_obj.objects.all()
-                all_fields = model_obj._meta.fields
-                line = []
-                for field in all_fields:
-                    line.append(field.name)
-
-                file.write('\t'.join(line) + '\n')
-
-                for row in rows:
-                    line.clear()
-                    for field in all_fields:
-                        line.append(getattr(row, field.attname))
-                    file.write('\t'.join(str(value) for value in line) + '\n')
+        directory, output_file = os.path.split(options['output_file'] or 'dump.csv')
+        since = self.parse_since(options['since'])
+        state = self.read_state(options['state_file'])
+        # rows updated during the dump or saved before it by transactions committed later
+        # are dumped again by the next run
+        watermark = timezone.now() - timedelta(seconds=options['margin'])
+
+        jobs = []
+        for label in options['models']:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError) as error:
+                raise CommandError(f'{label}: {error}')
+            if updated_field(model) is not None:
+                model_since = since or self.parse_since(state.get(model._meta.label))
+            elif since is not None:
+                raise CommandError(f'{label} has no auto_now field, it can be dumped only in full')
+            else:
+                # always in full, with the state file too
+                model_since = None
+            jobs.append((model._meta.label, {
+                'directory': directory, 'output_file': output_file, 'since': model_since, 'm2m': options['m2m'],
+                'compress': options['compress'], 'chunk_size': options['chunk_size'],
+                'use_copy': not options['no_copy'],
+            }))
+
+        started = time.perf_counter()
+        total = 0
+        if options['workers'] > 1 and len(jobs) > 1:
+            # the forked workers must not share the connections of this process
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=min(options['workers'], len(jobs))) as pool:
+                futures = [pool.submit(dump_model, label, **kwargs) for label, kwargs in jobs]
+                for future in as_completed(futures):
+                    total += sum(self.report(*result) for result in future.result())
+        else:
+            for label, kwargs in jobs:
+                total += sum(self.report(*result) for result in dump_model(label, **kwargs))
+
+        if len(jobs) > 1 or options['m2m']:
+            self.report('total', total, time.perf_counter() - started)
+
+        if options['state_file']:
+            state.update((label, watermark.isoformat()) for label, _ in jobs)
+            self.write_state(options['state_file'], state)
+
+    def parse_since(self, value):
+        if not value:
+            return None
+
+        since = parse_datetime(value)
+        if since is None and parse_date(value) is not None:
+            since = datetime.combine(parse_date(value), datetime.min.time())
+        if since is None:
+            raise CommandError(f'{value} is not a date and time')
+        return timezone.make_aware(since) if timezone.is_naive(since) else since
+
+    def read_state(self, path) -> Dict[str, str]:
+        if not path or not os.path.exists(path):
+            return {}
+
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def write_state(self, path, state):
+        # a dump interrupted while writing the state keeps the previous one
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(state, file, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def report(self, label, rows, elapsed):
+        self.stdout.write(f'{label}: {rows} rows in {elapsed:.1f}s, {rows / elapsed if elapsed else 0:.0f} rows/s')
+        return rows
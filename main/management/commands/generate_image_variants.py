@@ -0,0 +1,82 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main.models import AdditionalImage, ItemModel
+from main.thumbnails import VARIANTS_KEY, refresh_pages, render_variants, store_variants
+
+
+class Command(BaseCommand):
+    """Generating the thumbnail variants (1x/2x, WebP) of the whole media library
+
+    Images with variants in the cache are skipped, so an interrupted run goes on
+    where it stopped.
+
+    example:
+    python manage.py generate_image_variants --workers 8
+    """
+    help = 'Generate WebP and 1x/2x thumbnails of all the item images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Amount of processes')
+        parser.add_argument('--batch', type=int, default=500, help='Images per progress report')
+        parser.add_argument('--force', action='store_true', help='Regenerate the images processed already')
+
+    def handle(self, *args, **options):
+        names = sorted(
+            set(ItemModel.objects.exclude(image='').exclude(image=None).values_list('image', flat=True))
+            | set(AdditionalImage.objects.exclude(image='').values_list('image', flat=True))
+        )
+        if not options['force']:
+            names = self.pending(names)
+        if not names:
+            self.stdout.write('Nothing to do')
+            return
+
+        self.stdout.write(f'{len(names)} images, {options["workers"]} workers')
+        # the forked workers must not share the connections of this process
+        connections.close_all()
+
+        done, failed, batch = 0, 0, []
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {pool.submit(render_variants, name): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    store_variants(name, future.result())
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(f'{name}: {error}')
+                    continue
+
+                done += 1
+                batch.append(name)
+                if len(batch) == options['batch']:
+                    refresh_pages(batch)
+                    batch = []
+                    self.report(done, len(names), started)
+
+        if batch:
+            refresh_pages(batch)
+        self.report(done, len(names), started)
+        if failed:
+            self.stderr.write(f'{failed} images failed, run the command again to retry them')
+
+    def pending(self, names):
+        """Names of the images without variants in the cache"""
+        pending = []
+        for start in range(0, len(names), 1000):
+            chunk = names[start:start + 1000]
+            ready = cache.get_many([VARIANTS_KEY.format(name=name) for name in chunk])
+            pending += [name for name in chunk if VARIANTS_KEY.format(name=name) not in ready]
+
+        return pending
+
+    def report(self, done, total, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{done}/{total} images in {elapsed:.1f}s, {done / elapsed if elapsed else 0:.1f} images/s')
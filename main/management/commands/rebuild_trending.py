@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from main.counters import pending_views, rebuild_trending
+from main.models import ItemModel
+
+
+class Command(BaseCommand):
+    """Rebuilding the trending items from the persisted views, e.g. after Redis was flushed
+
+    example:
+    python manage.py rebuild_trending
+    """
+    help = 'Rebuild trending items from the persisted views'
+
+    def handle(self, *args, **options):
+        pending = pending_views()
+
+        def views():
+            rows = ItemModel.objects.published().filter(views__gt=0).values_list('id', 'views')
+            for item_id, amount in rows.iterator(chunk_size=2000):
+                yield item_id, amount + pending.pop(item_id, 0)
+
+            # views of the items not counted above, only of the published ones
+            published = ItemModel.objects.published().filter(pk__in=list(pending)).values_list('id', flat=True)
+            for item_id in published.iterator(chunk_size=2000):
+                yield item_id, pending[item_id]
+
+        total = rebuild_trending(views())
+        self.stdout.write(f'Trending items rebuilt from {total} items')
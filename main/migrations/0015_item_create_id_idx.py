@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_smslog'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='itemmodel',
+            index=models.Index(fields=['-item_create', '-id'], name='item_create_id_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_item_create_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itemmodel',
+            name='views',
+            field=models.PositiveIntegerField(default=0, verbose_name='Views'),
+        ),
+    ]
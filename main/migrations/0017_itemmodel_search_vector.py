@@ -0,0 +1,47 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:06
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_VECTOR_TRIGGER = """
+CREATE FUNCTION main_itemmodel_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('russian', coalesce(NEW.short_name, '')), 'A') ||
+        setweight(to_tsvector('russian', regexp_replace(coalesce(NEW.description, ''), '<[^>]*>', ' ', 'g')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER main_itemmodel_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF short_name, description ON main_itemmodel
+    FOR EACH ROW EXECUTE PROCEDURE main_itemmodel_search_vector_update();
+
+UPDATE main_itemmodel SET short_name = short_name;
+"""
+
+DROP_SEARCH_VECTOR_TRIGGER = """
+DROP TRIGGER main_itemmodel_search_vector_trigger ON main_itemmodel;
+DROP FUNCTION main_itemmodel_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_itemmodel_views'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itemmodel',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='itemmodel',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='item_search_vector_idx'),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_TRIGGER, DROP_SEARCH_VECTOR_TRIGGER),
+    ]
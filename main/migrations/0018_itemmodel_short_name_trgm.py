@@ -0,0 +1,21 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:20
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_itemmodel_search_vector'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='itemmodel',
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=['short_name'], name='item_short_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_itemmodel_short_name_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itemmodel',
+            name='description_preview',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='Preview'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0019_itemmodel_description_preview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CircularMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField()),
+                ('is_seller', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Circular message',
+            },
+        ),
+        migrations.CreateModel(
+            name='CircularChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('first_id', models.PositiveIntegerField()),
+                ('last_id', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('is_done', models.BooleanField(default=False)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='main.circularmessage')),
+            ],
+            options={
+                'verbose_name': 'Circular chunk',
+                'unique_together': {('message', 'number')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_circularmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriber',
+            name='categories',
+            field=models.ManyToManyField(blank=True, related_name='subscribers', to='main.CategoryModel'),
+        ),
+        migrations.AddField(
+            model_name='subscriber',
+            name='tags',
+            field=models.ManyToManyField(blank=True, related_name='subscribers', to='main.TagModel'),
+        ),
+    ]
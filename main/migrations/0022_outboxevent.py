@@ -0,0 +1,30 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0021_subscriber_follows'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated')], max_length=10)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.itemmodel')),
+            ],
+            options={
+                'verbose_name': 'Outbox event',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='outboxevent',
+            constraint=models.UniqueConstraint(fields=('item', 'kind'), name='outbox_event_item_kind_uniq'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 15:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0022_outboxevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='itemmodel',
+            index=models.Index(fields=['item_update'], name='item_update_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.7 on 2026-10-18 16:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0023_item_update_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewsFlush',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('flush_id', models.CharField(max_length=32, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Views flush',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.7 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0024_viewsflush'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='circularchunk',
+            name='lease',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='circularchunk',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0025_circularchunk_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxevent',
+            name='seq',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -2,19 +2,26 @@
 
 Contain classes describe DB models.
 """
-from typing import Optional, Any
+from typing import Any, List, Optional
 
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connections, models, router, transaction
+from django.utils import timezone
+from django.db.models.functions import Concat, StrIndex, Substr
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 
 from mptt.models import MPTTModel, TreeForeignKey
+from mptt.signals import node_moved
 from ckeditor.fields import RichTextField
 
 from py_dev_user.utilities import get_timestamp_path
 
+from .cache import ALL_ITEMS, ALL_TAGS, bump_listing_version, invalidate_category_tree, invalidate_item_listings
+
 
 class CategoryModel(MPTTModel):
     """Category model
@@ -34,10 +41,33 @@ class CategoryModel(MPTTModel):
     def __str__(self) -> str:
         return self.name
 
+    def get_absolute_url(self) -> str:
+        return reverse('category_items', args=[str(self.id)])
+
     class Meta:
         verbose_name = 'Category'
 
 
+class TagQuerySet(models.QuerySet):
+    """Tag query set"""
+
+    def update(self, **kwargs: Any) -> int:
+        """Bulk update, invalidates the cached listings of the updated tags under the old and the new names
+
+        Signals are not sent on bulk updates.
+        """
+        pks = list(self.values_list('pk', flat=True))
+        tag_names = set(TagModel.objects.filter(pk__in=pks).values_list('tag', flat=True))
+        rows = super().update(**kwargs)
+        if rows:
+            tag_names.update(TagModel.objects.filter(pk__in=pks).values_list('tag', flat=True))
+            invalidate_item_listings(tag_names)
+            # tag names are shown on the item cards of the other tags too
+            bump_listing_version(ALL_TAGS)
+
+        return rows
+
+
 class TagModel(models.Model):
     """Tag model
 
@@ -49,6 +79,8 @@ class TagModel(models.Model):
     tag = models.CharField(max_length=50, verbose_name='Tag')
     published = models.BooleanField(verbose_name='Published', default=True)
 
+    objects = TagQuerySet.as_manager()
+
     def __str__(self) -> str:
         return self.tag
 
@@ -87,6 +119,126 @@ class SellerModel(User):
         verbose_name = 'Seller'
 
 
+# the part of the description before it is shown on the item cards
+PREVIEW_CUT = '<hr />'
+PREVIEW_ELLIPSIS = '<span class="h3">&#8230;</span>'
+
+
+def cut_description(description: str) -> str:
+    """Preview of the description for the item cards
+
+    :param description: item description
+    :type description: str
+    :return: the part before `PREVIEW_CUT` with an ellipsis, the whole description without it
+    """
+    idx = description.find(PREVIEW_CUT)
+    if idx < 0:
+        return description
+
+    return description[:idx] + PREVIEW_ELLIPSIS
+
+
+class _Found(models.Func):
+    """`position > 0`, the position of `StrIndex` is 0 if the substring is not found"""
+    template = '%(expressions)s > 0'
+    output_field = models.BooleanField()
+
+
+def preview_expression(description: Any = None) -> models.Case:
+    """`cut_description` in SQL, for the bulk updates of the stored previews
+
+    UPDATE computes every column from the old row, so an update of the
+    description passes its new value to get the preview of it.
+    :param description: expression of the description, the stored one by default
+    :type description: Expression
+    :return: expression of the preview
+    """
+    if description is None:
+        description = models.F('description')
+    position = StrIndex(description, models.Value(PREVIEW_CUT))
+    return models.Case(
+        models.When(_Found(position), then=Concat(
+            Substr(description, 1, position - 1),
+            models.Value(PREVIEW_ELLIPSIS),
+        )),
+        default=description,
+        output_field=models.TextField(),
+    )
+
+
+# fields not shown in the item listings, their updates keep the cache
+LISTING_NEUTRAL_FIELDS = frozenset({'views', 'search_vector', 'item_update'})
+
+
+class ItemQuerySet(models.QuerySet):
+    """Item query set
+
+    Reusable filters and loading strategies for items.
+    """
+
+    def published(self) -> 'ItemQuerySet':
+        return self.filter(published=True)
+
+    def update(self, **kwargs: Any) -> int:
+        """Bulk update, invalidates the cached listings of the updated items
+
+        Signals are not sent on bulk updates, e.g. by the admin actions, so the
+        `OutboxEvent` of every updated item is recorded here, in the transaction
+        of the update.
+        """
+        if set(kwargs) <= LISTING_NEUTRAL_FIELDS:
+            return super().update(**kwargs)
+        # auto_now is not applied by UPDATE, the incremental dumps need the change
+        kwargs.setdefault('item_update', timezone.now())
+        if isinstance(kwargs.get('description'), str):
+            kwargs['description_preview'] = cut_description(kwargs['description'])
+        elif 'description' in kwargs:
+            kwargs['description_preview'] = preview_expression(kwargs['description'])
+
+        with transaction.atomic():
+            # locked, so the events are recorded for exactly the updated rows
+            pks = list(self.select_for_update().values_list('pk', flat=True))
+            if not pks:
+                return 0
+            tag_names = list(TagModel.objects.filter(itemmodel__in=pks).values_list('tag', flat=True).distinct())
+            rows = models.QuerySet.update(self.model._base_manager.filter(pk__in=pks), **kwargs)
+            OutboxEvent.record_many(pks, OutboxEvent.UPDATED)
+
+        invalidate_item_listings(tag_names)
+        return rows
+
+    def in_category(self, category: CategoryModel) -> 'ItemQuerySet':
+        """Items of the category and all its subcategories
+
+        :param category: category
+        :type category: CategoryModel
+        :return: filtered queryset
+        """
+        return self.filter(category__tree_id=category.tree_id,
+                           category__lft__gte=category.lft, category__lft__lte=category.rght)
+
+    def listing(self) -> 'ItemQuerySet':
+        """Queryset for the item cards
+
+        Joins currency, category and seller, prefetches tags with one query and
+        leaves out the description, cards show the stored `description_preview`.
+        :return: published items ready for rendering in a list
+        """
+        return (self.published()
+                .select_related('currency', 'category', 'seller')
+                .prefetch_related(models.Prefetch('tag', queryset=TagModel.objects.only('id', 'tag')))
+                .defer('description', 'search_vector'))
+
+    def detail(self) -> 'ItemQuerySet':
+        """Queryset for the item page
+
+        :return: items with related objects and additional images
+        """
+        return (self.select_related('currency', 'category', 'seller')
+                .prefetch_related('additionalimage_set')
+                .defer('search_vector'))
+
+
 class ItemModel(models.Model):
     """Item model
 
@@ -95,6 +247,8 @@ class ItemModel(models.Model):
     :type short_name: str
     :param description: item description
     :type description: RichText object
+    :param description_preview: part of the description for the item cards, computed on save
+    :type description_preview: str
     :param image: avatar
     :type image: Image object
     :param tag: Tag
@@ -115,9 +269,14 @@ class ItemModel(models.Model):
     :type item_create: datetime, defaults on auto add now
     :param item_update: when item was updated
     :type item_update: datetime, defaults on auto now
+    :param views: amount of views written from the counters
+    :type views: int, defaults to 0
+    :param search_vector: full-text search document, maintained by a database trigger
+    :type search_vector: tsvector
     """
     short_name = models.CharField(max_length=100, verbose_name='Object name', db_index=True)
     description = RichTextField()
+    description_preview = models.TextField(verbose_name='Preview', blank=True, default='', editable=False)
     image = models.ImageField(verbose_name='Image', blank=True, null=True, upload_to=get_timestamp_path)
     tag = models.ManyToManyField(TagModel, blank=True)
     seller = models.ForeignKey(SellerModel, on_delete=models.CASCADE)
@@ -128,10 +287,30 @@ class ItemModel(models.Model):
     in_stock = models.BooleanField(verbose_name='In stock', default=True)
     item_create = models.DateTimeField(auto_now_add=True, verbose_name='created')
     item_update = models.DateTimeField(auto_now=True, verbose_name='updated')
+    views = models.PositiveIntegerField(verbose_name='Views', default=0)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ItemQuerySet.as_manager()
 
     def __str__(self) -> str:
         return self.short_name
 
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        self.description_preview = cut_description(self.description)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'description' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'description_preview'}
+
+        kind = OutboxEvent.CREATED if self._state.adding else OutboxEvent.UPDATED
+        if kind == OutboxEvent.UPDATED and update_fields is not None and set(update_fields) <= LISTING_NEUTRAL_FIELDS:
+            # not a change for the consumers of the outbox
+            super().save(*args, **kwargs)
+            return
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            OutboxEvent.record(self.id, kind)
+
     def delete(self, *args: tuple, **kwargs: dict) -> None:
         for ai in self.additionalimage_set.all():
             ai.delete()
@@ -144,6 +323,14 @@ class ItemModel(models.Model):
     class Meta:
         verbose_name = 'Item'
         ordering = ['-item_create']
+        indexes = [
+            models.Index(fields=['-item_create', '-id'], name='item_create_id_idx'),
+            # watermark of the incremental dumps, see the createdump command
+            models.Index(fields=['item_update'], name='item_update_idx'),
+            GinIndex(fields=['search_vector'], name='item_search_vector_idx'),
+            # prefix (ILIKE 'abc%') and similarity (%) lookups of the autocomplete, see main.search
+            GinIndex(fields=['short_name'], name='item_short_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
 
 
 class AdditionalImage(models.Model):
@@ -168,10 +355,17 @@ class AdditionalImage(models.Model):
 class Subscriber(models.Model):
     """Subscriber model
 
+    A subscriber following no tags and no categories gets all the new items.
     :param user: subscriber
     :type user: ref to User model
+    :param tags: tags followed
+    :type tags: refs to Tag model
+    :param categories: categories followed with their subcategories
+    :type categories: refs to Category model
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    tags = models.ManyToManyField(TagModel, blank=True, related_name='subscribers')
+    categories = models.ManyToManyField(CategoryModel, blank=True, related_name='subscribers')
 
     def __str__(self) -> str:
         return self.user.username
@@ -196,6 +390,83 @@ class ItemReports(models.Model):
         ordering = ['-is_send']
 
 
+class OutboxEvent(models.Model):
+    """Pending change of an item, see main.outbox
+
+    Written in the transaction of the change, an event is kept once per item
+    and kind until it is drained, so repeated edits of an item coalesce. Every
+    edit increments `seq`: a drainer deletes the event only if `seq` is still
+    the one it has read, an edit recorded meanwhile stays for the next batch.
+    :param item: changed item
+    :type item: ref to Item model
+    :param kind: `created` or `updated`
+    :type kind: str
+    :param seq: amount of the edits coalesced
+    :type seq: int, defaults on 1
+    :param created: when the event was recorded
+    :type created: datetime, defaults on auto add now
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    KINDS = ((CREATED, 'Created'), (UPDATED, 'Updated'))
+
+    item = models.ForeignKey(ItemModel, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KINDS)
+    seq = models.PositiveIntegerField(default=1)
+    created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def record(cls, item_id: int, kind: str) -> None:
+        """Add the event or increment `seq` of the pending one, one INSERT ... ON CONFLICT DO UPDATE
+
+        Unlike DO NOTHING, the update waits for a drainer holding the event
+        locked and then inserts it anew if the drainer has deleted it.
+        """
+        cls.record_many([item_id], kind)
+
+    @classmethod
+    def record_many(cls, item_ids: List[int], kind: str) -> None:
+        """`record` of the events of many items by one INSERT ... ON CONFLICT DO UPDATE
+
+        :param item_ids: ids of the changed items, without repeats
+        :type item_ids: list
+        :param kind: `created` or `updated`
+        :type kind: str
+        :return: None
+        """
+        connection = connections[router.db_for_write(cls)]
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (item_id, kind, seq, created) '
+                f'SELECT item_id, %s, 1, %s FROM unnest(%s::integer[]) AS item_id '
+                f'ON CONFLICT (item_id, kind) DO UPDATE SET seq = {table}.seq + 1',
+                [kind, timezone.now(), list(item_ids)])
+
+    class Meta:
+        verbose_name = 'Outbox event'
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'kind'], name='outbox_event_item_kind_uniq'),
+        ]
+
+
+class ViewsFlush(models.Model):
+    """The last flush of the view counters written into `ItemModel.views`, see main.counters
+
+    Written in the transaction of the flush, a flush repeated after a crash
+    finds its id and does not add the views twice.
+    :param flush_id: id of the flushed counters
+    :type flush_id: str
+    :param created: when the counters were written
+    :type created: datetime, defaults on auto add now
+    """
+    flush_id = models.CharField(max_length=32, unique=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Views flush'
+
+
 class SMSLog(models.Model):
     """SMS log model
 
@@ -216,6 +487,96 @@ class SMSLog(models.Model):
     class Meta:
         verbose_name = 'SMS Log'
 
+
+class CircularMessage(models.Model):
+    """Circular message to the users or the sellers
+
+    Recipients are split into chunks of `CircularChunk` sent in parallel, the
+    progress is summed up from them.
+    :param author: staff user who submitted the message
+    :type author: ref to User model
+    :param subject: subject
+    :type subject: str
+    :param body: HTML body
+    :type body: str
+    :param is_seller: the message is for the sellers only
+    :type is_seller: bool, defaults on False
+    :param created: when the message was submitted
+    :type created: datetime, defaults on auto add now
+    :param finished: when the last chunk was sent
+    :type finished: datetime, optional
+    """
+    author = models.ForeignKey(User, on_delete=models.CASCADE)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    is_seller = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return self.subject
+
+    def get_absolute_url(self) -> str:
+        return reverse('circular_message', args=[str(self.id)])
+
+    def progress(self) -> dict:
+        """Amounts of the sent, failed and remaining letters
+
+        :return: dict with `total`, `sent`, `failed` and `remaining`
+        """
+        progress = self.chunks.aggregate(total=models.Sum('size'), sent=models.Sum('sent'),
+                                         failed=models.Sum('failed'))
+        progress = {key: value or 0 for key, value in progress.items()}
+        progress['remaining'] = progress['total'] - progress['sent'] - progress['failed']
+
+        return progress
+
+    class Meta:
+        verbose_name = 'Circular message'
+
+
+class CircularChunk(models.Model):
+    """Recipients of a circular message with ids from `first_id` to `last_id`
+
+    :param message: circular message
+    :type message: ref to CircularMessage model
+    :param number: number of the chunk in the message
+    :type number: int
+    :param first_id: id of the first recipient
+    :type first_id: int
+    :param last_id: id of the last recipient
+    :type last_id: int
+    :param size: amount of the recipients
+    :type size: int
+    :param position: id of the last recipient processed, the sending goes on after it
+    :type position: int, defaults on 0
+    :param sent: amount of the sent letters
+    :type sent: int, defaults on 0
+    :param failed: amount of the letters given up
+    :type failed: int, defaults on 0
+    :param is_done: all the recipients are processed
+    :type is_done: bool, defaults on False
+    :param lease: token of the worker sending the chunk
+    :type lease: str, defaults on ''
+    :param leased_until: the chunk is not taken by another worker till then
+    :type leased_until: datetime, optional
+    """
+    message = models.ForeignKey(CircularMessage, on_delete=models.CASCADE, related_name='chunks')
+    number = models.PositiveIntegerField()
+    first_id = models.PositiveIntegerField()
+    last_id = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    position = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    is_done = models.BooleanField(default=False)
+    lease = models.CharField(max_length=32, blank=True, default='')
+    leased_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Circular chunk'
+        unique_together = ('message', 'number')
+
 # class Profile(models.Model):
 #     user = models.OneToOneField(User, on_delete=models.CASCADE)
 #     avatar = models.ImageField(verbose_name='Avatar', blank=True, null=True, upload_to=get_timestamp_path)
@@ -237,16 +598,165 @@ class SMSLog(models.Model):
 
 
 @receiver(post_save, sender=ItemModel)
-def create_item_dispatcher(sender: Any, **kwargs: dict) -> None:
-    """Executor of POST_SAVE signal
+@receiver(post_delete, sender=ItemModel)
+def invalidate_item_cache(sender: Any, instance: ItemModel, **kwargs: dict) -> None:
+    """Executor of POST_SAVE and POST_DELETE signals of items
 
+    Tags of a deleted item are gone already, all the tag listings are invalidated then.
     :param sender: sender
     :type sender: some object
+    :param instance: saved or deleted item
+    :type instance: ItemModel
     :param kwargs: keyword arguments
     :type kwargs: dict
     :return: None
     """
-    item = kwargs['instance']
-    item_reports = ItemReports()
-    item_reports.item = item
-    item_reports.save()
+    if 'created' in kwargs:
+        invalidate_item_listings(instance.tag.values_list('tag', flat=True))
+    else:
+        bump_listing_version(ALL_ITEMS, ALL_TAGS)
+
+
+@receiver(m2m_changed, sender=ItemModel.tag.through)
+def invalidate_item_tags_cache(sender: Any, instance: Any, action: str, reverse: bool, pk_set: Any,
+                               **kwargs: dict) -> None:
+    """Executor of M2M_CHANGED signal of item tags
+
+    :param sender: sender
+    :type sender: some object
+    :param instance: item or tag, depends on the side of relation
+    :type instance: ItemModel or TagModel
+    :param action: kind of change
+    :type action: str
+    :param reverse: True if tag is changed
+    :type reverse: bool
+    :param pk_set: primary keys of the added or removed objects
+    :type pk_set: set or None
+    :param kwargs: keyword arguments
+    :type kwargs: dict
+    :return: None
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        invalidate_item_listings([instance.tag])
+    elif action == 'pre_clear':
+        invalidate_item_listings(instance.tag.values_list('tag', flat=True))
+    else:
+        invalidate_item_listings(TagModel.objects.filter(pk__in=pk_set).values_list('tag', flat=True))
+
+
+@receiver(m2m_changed, sender=ItemModel.tag.through)
+def touch_item_tags(sender: Any, instance: Any, action: str, reverse: bool, pk_set: Any, **kwargs: dict) -> None:
+    """Executor of M2M_CHANGED signal of item tags
+
+    Tags of an item are a change of the item: its `item_update` is moved, so
+    the incremental dumps have the new links.
+    :param sender: sender
+    :type sender: some object
+    :param instance: item or tag, depends on the side of relation
+    :type instance: ItemModel or TagModel
+    :param action: kind of change
+    :type action: str
+    :param reverse: True if tag is changed
+    :type reverse: bool
+    :param pk_set: primary keys of the added or removed objects
+    :type pk_set: set or None
+    :param kwargs: keyword arguments
+    :type kwargs: dict
+    :return: None
+    """
+    if reverse and action == 'pre_clear':
+        items = ItemModel.objects.filter(tag=instance)
+    elif reverse and action in ('post_add', 'post_remove'):
+        items = ItemModel.objects.filter(pk__in=pk_set)
+    elif not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        items = ItemModel.objects.filter(pk=instance.pk)
+    else:
+        return
+
+    items.update(item_update=timezone.now())
+
+
+@receiver(post_save, sender=TagModel)
+@receiver(post_delete, sender=TagModel)
+def invalidate_tag_cache(sender: Any, **kwargs: dict) -> None:
+    """Executor of POST_SAVE and POST_DELETE signals of tags
+
+    Tag names are shown on every item card and are parts of the URLs.
+    :param sender: sender
+    :type sender: some object
+    :param kwargs: keyword arguments
+    :type kwargs: dict
+    :return: None
+    """
+    bump_listing_version(ALL_ITEMS, ALL_TAGS)
+
+
+@receiver(post_save, sender=CategoryModel)
+@receiver(post_delete, sender=CategoryModel)
+@receiver(node_moved, sender=CategoryModel)
+def invalidate_category_cache(sender: Any, **kwargs: dict) -> None:
+    """Executor of POST_SAVE, POST_DELETE and NODE_MOVED signals of categories
+
+    Categories are shown in the menu and the facets, their subtrees make the category listings.
+    :param sender: sender
+    :type sender: some object
+    :param kwargs: keyword arguments
+    :type kwargs: dict
+    :return: None
+    """
+    invalidate_category_tree()
+    bump_listing_version(ALL_ITEMS, ALL_TAGS)
+
+
+@receiver(post_save, sender=CurrencyModel)
+@receiver(post_delete, sender=CurrencyModel)
+def invalidate_currency_cache(sender: Any, **kwargs: dict) -> None:
+    """Executor of POST_SAVE and POST_DELETE signals of currencies
+
+    Currency names are shown on every item card and in the facets.
+    :param sender: sender
+    :type sender: some object
+    :param kwargs: keyword arguments
+    :type kwargs: dict
+    :return: None
+    """
+    bump_listing_version(ALL_ITEMS, ALL_TAGS)
+
+
+@receiver(post_save, sender=AdditionalImage)
+@receiver(post_delete, sender=AdditionalImage)
+def touch_item_of_image(sender: Any, instance: AdditionalImage, **kwargs: dict) -> None:
+    """Executor of POST_SAVE and POST_DELETE signals of additional images
+
+    The images are shown on the item page only, its validators come from `item_update`.
+    :param sender: sender
+    :type sender: some object
+    :param instance: saved or deleted image
+    :type instance: AdditionalImage
+    :param kwargs: keyword arguments
+    :type kwargs: dict
+    :return: None
+    """
+    ItemModel.objects.filter(pk=instance.item_id).update(item_update=timezone.now())
+
+
+@receiver(post_save, sender=ItemModel)
+@receiver(post_save, sender=AdditionalImage)
+def schedule_image_thumbnails(sender: Any, instance: Any, **kwargs: dict) -> None:
+    """Executor of POST_SAVE signals of items and additional images
+
+    Thumbnails of a new image are generated by a task after the commit.
+    :param sender: sender
+    :type sender: some object
+    :param instance: saved item or image
+    :type instance: ItemModel or AdditionalImage
+    :param kwargs: keyword arguments
+    :type kwargs: dict
+    :return: None
+    """
+    from .thumbnails import schedule_thumbnails
+
+    schedule_thumbnails(instance.image.name)
@@ -0,0 +1,95 @@
+"""Outbox
+
+Item changes are recorded as `OutboxEvent` rows in the transaction of the
+change (see `ItemModel.save`) and consumed later by `drain_outbox`.
+
+Events are taken by batches with SELECT ... FOR UPDATE SKIP LOCKED, so several
+workers drain the outbox in parallel without waiting for each other. A batch
+is passed to the consumers of its kinds and deleted in the same transaction:
+if a consumer fails, the batch stays for the next run. An event is deleted
+only with the `seq` read by the batch, so an edit recorded after the read is
+consumed by the next batch.
+"""
+import logging
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+from typing import Callable, Dict, List
+
+from django.db import transaction
+from django.db.models import Q
+
+from .models import ItemReports, OutboxEvent
+
+Consumer = Callable[[List[int]], None]
+
+logger = logging.getLogger(__name__)
+
+_consumers: Dict[str, List[Consumer]] = defaultdict(list)
+
+
+def consumer(kind: str) -> Callable[[Consumer], Consumer]:
+    """Register a function taking the item ids of a batch of events of the kind
+
+    :param kind: `OutboxEvent.CREATED` or `OutboxEvent.UPDATED`
+    :type kind: str
+    :return: decorator
+    """
+    def register(func: Consumer) -> Consumer:
+        _consumers[kind].append(func)
+        return func
+
+    return register
+
+
+@consumer(OutboxEvent.CREATED)
+def queue_item_reports(item_ids: List[int]) -> None:
+    """New items go to the report of the subscribers"""
+    ItemReports.objects.bulk_create([ItemReports(item_id=item_id) for item_id in item_ids], ignore_conflicts=True)
+
+
+def drain_batch(batch_size: int = 1000) -> int:
+    """Consume a batch of events not locked by other workers
+
+    :param batch_size: amount of events
+    :type batch_size: int
+    :return: amount of the consumed events
+    """
+    with transaction.atomic():
+        events = list(OutboxEvent.objects.select_for_update(skip_locked=True).order_by('id')
+                      .values_list('id', 'item_id', 'kind', 'seq')[:batch_size])
+        if not events:
+            return 0
+
+        items: Dict[str, List[int]] = defaultdict(list)
+        for _, item_id, kind, _ in events:
+            items[kind].append(item_id)
+        for kind, item_ids in items.items():
+            for func in _consumers[kind]:
+                func(item_ids)
+
+        # events edited after the read keep a greater seq and stay
+        by_seq: Dict[int, List[int]] = defaultdict(list)
+        for event_id, _, _, seq in events:
+            by_seq[seq].append(event_id)
+        OutboxEvent.objects.filter(reduce(or_, (Q(seq=seq, id__in=ids) for seq, ids in by_seq.items()))).delete()
+
+    return len(events)
+
+
+def drain_outbox(batch_size: int = 1000) -> int:
+    """Consume the events until the outbox is empty or locked by other workers
+
+    :param batch_size: events per transaction
+    :type batch_size: int
+    :return: amount of the consumed events
+    """
+    drained = 0
+    while True:
+        amount = drain_batch(batch_size)
+        drained += amount
+        if amount < batch_size:
+            break
+
+    logger.info('outbox: %s events drained', drained)
+    return drained
@@ -0,0 +1,178 @@
+"""Paginators
+
+Keyset (cursor) pagination for big querysets.
+"""
+import json
+from typing import Any, List, Optional, Sequence, Tuple
+
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q, QuerySet
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorPage:
+    """Page of the cursor paginator
+
+    :param object_list: objects of the page
+    :type object_list: list
+    :param paginator: paginator the page belongs to
+    :type paginator: CursorPaginator
+    :param next_cursor: token of the next page
+    :type next_cursor: str or None
+    :param previous_cursor: token of the previous page
+    :type previous_cursor: str or None
+    """
+    is_cursor = True
+
+    def __init__(self, object_list: List[Any], paginator: 'CursorPaginator',
+                 next_cursor: Optional[str], previous_cursor: Optional[str]) -> None:
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self) -> str:
+        return f'<CursorPage of {len(self.object_list)} objects>'
+
+    def __len__(self) -> int:
+        return len(self.object_list)
+
+    def __iter__(self) -> Any:
+        return iter(self.object_list)
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def has_other_pages(self) -> bool:
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """Keyset paginator
+
+    Instead of OFFSET the page starts right after the ordering values of the last
+    row of the previous page, so a deep page costs the same as the first one.
+    The exact number of rows is never counted, `count` is the planner estimate.
+
+    :param queryset: queryset to paginate
+    :type queryset: QuerySet
+    :param per_page: amount of objects per page
+    :type per_page: int
+    :param ordering: ordering fields or JSON serializable annotations, the last one must be unique
+    :type ordering: tuple, defaults to ('-item_create', '-id')
+    """
+    salt = 'main.paginators.CursorPaginator'
+
+    def __init__(self, queryset: QuerySet, per_page: int,
+                 ordering: Sequence[str] = ('-item_create', '-id')) -> None:
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.fields = [name.lstrip('-') for name in self.ordering]
+
+    def page(self, cursor: Optional[str] = None) -> CursorPage:
+        """Return the page the cursor points to
+
+        :param cursor: token from `next_cursor` or `previous_cursor` of some page
+        :type cursor: str or None, the first page if None
+        :return: page
+        :raises InvalidCursor: if the token is broken or forged
+        """
+        backwards, position = self.decode_cursor(cursor) if cursor else (False, None)
+
+        queryset = self.queryset
+        if position is not None:
+            queryset = queryset.filter(self._after(position, backwards))
+
+        ordering = [self._invert(name) for name in self.ordering] if backwards else self.ordering
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        if not rows:
+            return CursorPage(rows, self, None, None)
+
+        if backwards:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+
+        return CursorPage(
+            rows,
+            self,
+            self.encode_cursor(rows[-1], False) if has_next else None,
+            self.encode_cursor(rows[0], True) if has_previous else None,
+        )
+
+    @property
+    def count(self) -> Optional[int]:
+        """Estimated amount of rows from the query plan, no COUNT(*) involved"""
+        connection = connections[self.queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        sql, params = self.queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def encode_cursor(self, obj: Any, backwards: bool) -> str:
+        position = []
+        for name in self.fields:
+            field = self._field(name)
+            position.append(field.value_to_string(obj) if field else getattr(obj, name))
+
+        return signing.dumps([int(backwards), position], salt=self.salt, compress=True)
+
+    def decode_cursor(self, cursor: str) -> Tuple[bool, List[Any]]:
+        try:
+            backwards, position = signing.loads(cursor, salt=self.salt)
+            values = []
+            for name, value in zip(self.fields, position):
+                field = self._field(name)
+                values.append(field.to_python(value) if field else value)
+        except (signing.BadSignature, ValidationError, TypeError, ValueError) as exc:
+            raise InvalidCursor(str(exc))
+
+        if len(values) != len(self.fields):
+            raise InvalidCursor('Cursor does not match the ordering')
+
+        return bool(backwards), values
+
+    def _field(self, name: str) -> Any:
+        """Model field of the ordering, None for annotations"""
+        try:
+            return self.queryset.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+    def _after(self, position: List[Any], backwards: bool) -> Q:
+        """Filter `(a, b, c) > (x, y, z)` spelled out for mixed directions"""
+        condition = Q()
+        for idx, name in enumerate(self.ordering):
+            descending = name.startswith('-') != backwards
+            lookup = f'{self.fields[idx]}__{"lt" if descending else "gt"}'
+            step = Q(**{lookup: position[idx]})
+            for prev_idx in range(idx):
+                step &= Q(**{self.fields[prev_idx]: position[prev_idx]})
+            condition |= step
+
+        return condition
+
+    @staticmethod
+    def _invert(name: str) -> str:
+        return name[1:] if name.startswith('-') else '-' + name
@@ -0,0 +1,119 @@
+"""Search
+
+Full-text search over the items.
+
+`ItemModel.search_vector` is maintained by a database trigger (see migration
+0017): `short_name` with weight A, `description` without HTML tags with weight B.
+
+Item name suggestions use the trigram GIN index on `short_name` (migration 0018).
+"""
+import time
+from functools import lru_cache
+from typing import List, Tuple
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import BooleanField, F, FloatField, Func, Value
+from django.db.models.functions import Cast
+
+from .models import ItemModel, ItemQuerySet
+
+# must match the configuration used by the trigger
+SEARCH_CONFIG = 'russian'
+
+AUTOCOMPLETE_SIZE = getattr(settings, 'AUTOCOMPLETE_SIZE', 10)
+AUTOCOMPLETE_MIN_LENGTH = getattr(settings, 'AUTOCOMPLETE_MIN_LENGTH', 2)
+AUTOCOMPLETE_CACHE_TTL = getattr(settings, 'AUTOCOMPLETE_CACHE_TTL', 60)
+AUTOCOMPLETE_LRU_SIZE = getattr(settings, 'AUTOCOMPLETE_LRU_SIZE', 1024)
+
+
+class StripTags(Func):
+    """HTML without tags, the same way the trigger does it"""
+    function = 'REGEXP_REPLACE'
+
+    def __init__(self, expression: str, **extra: dict) -> None:
+        super().__init__(F(expression), Value('<[^>]*>'), Value(' '), Value('g'), **extra)
+
+
+class ILike(Func):
+    """`expression ILIKE pattern`
+
+    `istartswith` compiles to UPPER(...) LIKE, the trigram index on the column can not serve it.
+    """
+    template = '%(expressions)s'
+    arg_joiner = ' ILIKE '
+    output_field = BooleanField()
+
+
+def like_prefix(text: str) -> str:
+    """LIKE pattern of the strings starting with the text"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def search_items(text: str) -> ItemQuerySet:
+    """Published items matching the search string, ranked
+
+    The string is parsed like in search engines: words, "quoted phrases", -excluded words, or.
+    :param text: search string
+    :type text: str
+    :return: listing queryset annotated with `rank` and highlighted `snippet`
+    """
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+
+    return (ItemModel.objects.listing()
+            .filter(search_vector=query)
+            # real is sent over the wire rounded, keyset pagination needs the exact value
+            .annotate(rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
+            .annotate(snippet=SearchHeadline(
+                StripTags('description'),
+                query,
+                config=SEARCH_CONFIG,
+                start_sel='<mark>',
+                stop_sel='</mark>',
+                max_words=35,
+                min_words=15,
+            )))
+
+
+def normalize_prefix(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+@lru_cache(maxsize=AUTOCOMPLETE_LRU_SIZE)
+def _suggest(prefix: str, limit: int, period: int) -> Tuple[str, ...]:
+    # `period` changes every AUTOCOMPLETE_CACHE_TTL seconds, older entries are never hit again
+    published = ItemModel.objects.published()
+    names = list(published
+                 .filter(ILike(F('short_name'), Value(like_prefix(prefix))))
+                 .order_by('short_name')
+                 .values_list('short_name', flat=True)
+                 .distinct()[:limit])
+    if len(names) < limit:
+        names += (published
+                  .filter(short_name__trigram_similar=prefix)
+                  .exclude(short_name__in=names)
+                  .annotate(similarity=TrigramSimilarity('short_name', prefix))
+                  .order_by('-similarity', 'short_name')
+                  .values_list('short_name', flat=True)
+                  .distinct()[:limit - len(names)])
+
+    return tuple(names)
+
+
+def suggest_names(text: str, limit: int = AUTOCOMPLETE_SIZE) -> List[str]:
+    """Names of published items for the typeahead of the search field
+
+    Names starting with the text go first, similar names (typos, other word order)
+    fill up the rest. Hot prefixes are kept in a small per-process LRU for
+    `AUTOCOMPLETE_CACHE_TTL` seconds.
+    :param text: what the user has typed so far
+    :type text: str
+    :param limit: amount of names
+    :type limit: int
+    :return: list of names
+    """
+    prefix = normalize_prefix(text)
+    if len(prefix) < AUTOCOMPLETE_MIN_LENGTH:
+        return []
+
+    return list(_suggest(prefix, limit, int(time.time() // AUTOCOMPLETE_CACHE_TTL)))
@@ -0,0 +1,157 @@
+"""SMS
+
+Texts are sent through an `SMSClient` chosen by the `SMS_CLIENT` setting:
+`TwilioClient` in production, `FakeClient` for the tests and the benchmark.
+
+`send_sms` runs the sends in a bounded pool of threads, a failed send is
+retried with exponential backoff. Only the calling thread touches the
+database: `SMSLog` rows are written with one INSERT per batch.
+"""
+import logging
+import threading
+from abc import ABC, abstractmethod
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import SMSLog
+
+SMS_CLIENT = getattr(settings, 'SMS_CLIENT', 'main.sms.TwilioClient')
+SMS_WORKERS = getattr(settings, 'SMS_WORKERS', 8)
+SMS_RETRIES = getattr(settings, 'SMS_RETRIES', 3)
+SMS_BACKOFF = getattr(settings, 'SMS_BACKOFF', 0.5)
+SMS_BATCH_SIZE = getattr(settings, 'SMS_BATCH_SIZE', 100)
+
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class SMSError(Exception):
+    """Sending failed, may succeed on retry"""
+
+
+class SMSClient(ABC):
+    """Interface of the SMS providers, must be safe to use from several threads"""
+
+    @abstractmethod
+    def send(self, to: str, body: str) -> str:
+        """Send a text
+
+        :param to: phone number
+        :type to: str
+        :param body: text
+        :type body: str
+        :return: status reported by the provider
+        :raise SMSError: if sending failed
+        """
+
+
+class TwilioClient(SMSClient):
+    """Twilio REST API"""
+
+    def __init__(self) -> None:
+        from twilio.rest import Client
+        self.client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+
+    def send(self, to: str, body: str) -> str:
+        from twilio.base.exceptions import TwilioException
+        try:
+            return self.client.messages.create(from_=settings.SMS_NUMBER_FROM, to=to, body=body).status
+        except (TwilioException, OSError) as error:
+            raise SMSError(str(error)) from error
+
+
+class FakeClient(SMSClient):
+    """Client without network access
+
+    :param latency: seconds every send takes
+    :type latency: float
+    :param failures: amount of the first sends to fail
+    :type failures: int
+    """
+
+    def __init__(self, latency: float = 0.0, failures: int = 0) -> None:
+        self.latency = latency
+        self.failures = failures
+        self.sent: List[Tuple[str, str]] = []
+        self.lock = threading.Lock()
+
+    def send(self, to: str, body: str) -> str:
+        time.sleep(self.latency)
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise SMSError('fake failure')
+            self.sent.append((to, body))
+
+        return 'queued'
+
+
+def get_client() -> SMSClient:
+    """Client of the `SMS_CLIENT` setting"""
+    return import_string(SMS_CLIENT)()
+
+
+def send_with_retries(client: SMSClient, to: str, body: str, retries: int = SMS_RETRIES,
+                      backoff: float = SMS_BACKOFF, sleep: Callable[[float], Any] = time.sleep) -> str:
+    """Send a text, retrying with exponential backoff
+
+    :param client: SMS client
+    :type client: SMSClient
+    :param to: phone number
+    :type to: str
+    :param body: text
+    :type body: str
+    :param retries: amount of retries
+    :type retries: int
+    :param backoff: delay before the first retry, doubled for every next one
+    :type backoff: float
+    :param sleep: waiting function
+    :type sleep: callable
+    :return: status reported by the provider or `FAILED`
+    """
+    for attempt in range(retries + 1):
+        try:
+            return client.send(to, body)
+        except SMSError:
+            if attempt == retries:
+                logger.exception('SMS to %s failed after %s attempts', to, attempt + 1)
+                return FAILED
+            sleep(backoff * 2 ** attempt)
+
+    return FAILED
+
+
+def send_sms(messages: Iterable[Tuple[int, str, str]], client: Optional[SMSClient] = None,
+             workers: int = SMS_WORKERS, batch_size: int = SMS_BATCH_SIZE, **retry: Any) -> Dict[str, int]:
+    """Send texts concurrently and log them
+
+    :param messages: triples of user id, phone number and text
+    :type messages: iterable
+    :param client: SMS client, the one of the settings by default
+    :type client: SMSClient
+    :param workers: amount of threads
+    :type workers: int
+    :param batch_size: texts per INSERT of the log
+    :type batch_size: int
+    :param retry: `retries` and `backoff` of `send_with_retries`
+    :return: dict with the amounts of `sent` and `failed` texts
+    """
+    client = client or get_client()
+    messages = list(messages)
+    result = {'sent': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start:start + batch_size]
+            statuses = pool.map(lambda message: send_with_retries(client, message[1], message[2], **retry), batch)
+            logs = [SMSLog(user_id=user_id, message=body, response=status)
+                    for (user_id, _, body), status in zip(batch, statuses)]
+            SMSLog.objects.bulk_create(logs)
+            for log in logs:
+                result['failed' if log.response == FAILED else 'sent'] += 1
+
+    return result
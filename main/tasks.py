@@ -1,25 +1,33 @@
+import logging
+import time
+from smtplib import SMTPException
+
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.core.mail import get_connection
 
-from celery import shared_task
+from celery import group, shared_task
 from celery.schedules import crontab
 
-from twilio.rest import Client
-
-from py_dev_user.utilities import send
+from py_dev_user.utilities import get_sender_email, send_batch
 from py_dev_user.celery import app
 
+from .models import CircularMessage
 from .models import Subscriber
-from .models import ItemReports
-from .models import SellerModel
-from .models import SMSLog
+from .models import ItemModel, ItemReports
+from .counters import flush_views
+from .digest import DIGEST_SIZE, DigestIndex, item_tags
+from . import circulars, outbox, sms, thumbnails
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
-def report():
-    html_table = """
+def report(chunk_size=1000):
+    html_greeting = """
 <h3>Здравствуйте {user_name},</h3>
+"""
 
+    html_table = """
 <p>Появился товар, который может Вас заинтересовать:</p>
 <table>
     <tr>
@@ -41,80 +49,149 @@ def report():
 <tr>
     """
 
+    html_more = """
+<tr>
+    <td colspan="4">И ещё {amount}: {link}</td>
+</tr>
+    """
+
     if settings.ALLOWED_HOSTS:
         host = 'http://' + settings.ALLOWED_HOSTS[0]
     else:
         host = 'http://localhost:8000'
 
-    subscribers = Subscriber.objects.all()
-    records = ItemReports.objects.filter(is_send=False)
-
-    if len(records) == 0:
-        return
-
-    content = list()
-
-    for record in records:
-        content.append(html_content.format(
-                title=record.item.short_name,
-                description=record.item.description,
-                price=record.item.price,
-                currency=record.item.currency,
-                link='{host}/main/item/{item_id}/'.format(
-                    host=host,
-                    item_id=record.item.id
+    started = time.perf_counter()
+    from_email = get_sender_email()
+    index = DigestIndex.build()
+    records = ItemReports.objects.filter(is_send=False).order_by('id').values_list('id', 'item_id', 'item__category_id')
+
+    # records are read by chunks in the order of ids, only ids are kept for all of them;
+    # every subscriber gets one digest of all the new items they follow, the first DIGEST_SIZE of them listed
+    record_ids, items, last_id = [], [], 0
+    while True:
+        chunk = list(records.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+
+        tags = item_tags(item_id for _, item_id, _ in chunk)
+        items += [(item_id, tags.get(item_id, ()), category_id) for _, item_id, category_id in chunk]
+        record_ids += [record_id for record_id, _, _ in chunk]
+        last_id = chunk[-1][0]
+
+    # rows of the listed items are rendered once, when a digest needs them first, with the short descriptions
+    rows = {}
+
+    def render_rows(item_ids):
+        missing = [item_id for item_id in item_ids if item_id not in rows]
+        for start in range(0, len(missing), chunk_size):
+            details = (ItemModel.objects.filter(id__in=missing[start:start + chunk_size])
+                       .values_list('id', 'short_name', 'description_preview', 'price', 'currency__short_name'))
+            for item_id, title, description, price, currency in details:
+                rows[item_id] = html_content.format(
+                    title=title,
+                    description=description,
+                    price=price,
+                    currency=currency,
+                    link='{host}/main/item/{item_id}/'.format(host=host, item_id=item_id),
                 )
-            )
-        )
-
-        record.is_send = True
-        record.save()
-
-    contents = '\n'.join(row for row in content)
-
-    for subscriber in subscribers:
-        message = html_table.format(
-            user_name=subscriber.user.last_name + ', ' + subscriber.user.first_name,
-            contents=contents
-        )
 
-        send('Новые поступления.', message, [subscriber.user.email, ])
+    counts = {'digests': 0}
+
+    def letters():
+        # the table of a digest is rendered once per distinct set of items in a range of subscribers;
+        # letters are made one by one while send_batch consumes them
+        for start, stop in index.shards():
+            groups = index.match(items, start, stop)
+            if not groups:
+                continue
+
+            contacts = (Subscriber.objects.filter(id__gte=start, id__lt=stop)
+                        .values_list('id', 'user__last_name', 'user__first_name', 'user__email'))
+            contacts = {subscriber_id: (last_name + ', ' + first_name, email)
+                        for subscriber_id, last_name, first_name, email in contacts}
+            for item_ids, subscriber_ids in groups.items():
+                listed = item_ids[:DIGEST_SIZE]
+                render_rows(listed)
+                contents = '\n'.join(rows[item_id] for item_id in listed if item_id in rows)
+                if len(item_ids) > len(listed):
+                    contents += html_more.format(amount=len(item_ids) - len(listed), link=f'{host}/main/')
+                table = html_table.format(contents=contents)
+                counts['digests'] += 1
+                for subscriber_id in subscriber_ids:
+                    if subscriber_id in contacts:
+                        user_name, email = contacts[subscriber_id]
+                        yield 'Новые поступления.', html_greeting.format(user_name=user_name) + table, [email, ]
+
+    # all the letters go over one connection of the mail backend
+    emails = 0
+    if from_email and items:
+        with get_connection(fail_silently=False) as connection:
+            emails = send_batch(letters(), from_email=from_email, connection=connection)
+
+    for start in range(0, len(record_ids), chunk_size):
+        ItemReports.objects.filter(id__in=record_ids[start:start + chunk_size]).update(is_send=True)
+    sent = len(record_ids)
+
+    metrics = {
+        'reports': sent,
+        'subscribers': index.size,
+        'digests': counts['digests'],
+        'emails': emails,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+    logger.info('report: %(reports)s reports, %(subscribers)s subscribers, %(digests)s digests, '
+                '%(emails)s emails in %(seconds)ss', metrics)
+    return metrics
 
 
 @app.task(name='send_circular_message')
-def send_circular_message(subj, body, is_seller):
-    if is_seller:
-        recipients = SellerModel.objects.filter(is_active=True).exclude(email='').values('email')
+def send_circular_message(message_id, chunk_size=circulars.CIRCULAR_CHUNK_SIZE):
+    """Split the recipients of the message into chunks and send the chunks not done yet in parallel"""
+    message = CircularMessage.objects.get(id=message_id)
+    circulars.plan_chunks(message, chunk_size)
+    chunks = circulars.pending_chunks(message)
+    if chunks:
+        group(send_circular_chunk.s(chunk_id) for chunk_id in chunks).apply_async()
     else:
-        recipients = (User.objects.filter(is_active=True).
-                      exclude(email='').exclude(is_staff=True).values('email'))
+        circulars.finish(message)
+
+    return len(chunks)
 
-    if len(recipients) > 0:
-        recipients = [element['email'] for element in recipients]
 
-    for email in recipients:
-        send(subj, body, [email, ])
+@app.task(bind=True, name='send_circular_chunk', acks_late=True, max_retries=circulars.CIRCULAR_RETRIES)
+def send_circular_chunk(self, chunk_id):
+    """Send a chunk of a circular message, a failed batch is retried with a growing delay"""
+    try:
+        circulars.send_chunk(chunk_id, give_up=self.request.retries >= self.max_retries)
+    except (SMTPException, OSError) as error:
+        raise self.retry(exc=error, countdown=60 * 2 ** self.request.retries)
 
 
 @shared_task(name='sms_sender')
 def sms_report():
     from random import randint
-    client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-    subscribers = Subscriber.objects.filter(user__profile__phone_number__isnull=False)
-    for subscriber in subscribers:
-        body = str(randint(1000, 9999))
-        phone_number = subscriber.user.profile.phone_number
-        message = client.messages.create(
-            from_=settings.SMS_NUMBER_FROM,
-            to=phone_number,
-            body=body
-        )
-
-        log = SMSLog()
-        log.user = subscriber.user
-        log.message = body
-        log.response = message.status
-        log.save()
+    subscribers = (Subscriber.objects.filter(user__profile__phone_number__isnull=False)
+                   .exclude(user__profile__phone_number='')
+                   .values_list('user_id', 'user__profile__phone_number'))
+    result = sms.send_sms((user_id, phone_number, str(randint(1000, 9999))) for user_id, phone_number in subscribers)
+    logger.info('sms_report: %(sent)s sent, %(failed)s failed', result)
+
+    return result
+
+
+@shared_task
+def flush_item_views():
+    return flush_views()
+
+
+@shared_task
+def drain_outbox():
+    return outbox.drain_outbox()
+
+
+@shared_task
+def generate_thumbnails(name):
+    return thumbnails.generate_thumbnails(name)
 
 
 app.conf.beat_schedule = {
@@ -123,6 +200,14 @@ app.conf.beat_schedule = {
         'schedule': crontab(minute='0', hour='9', day_of_week='mon')
         # 'schedule': crontab(minute='*/1')
     },
+    'task_drain_outbox': {
+        'task': 'main.tasks.drain_outbox',
+        'schedule': crontab(minute='*/1')
+    },
+    'task_flush_item_views': {
+        'task': 'main.tasks.flush_item_views',
+        'schedule': crontab(minute='*/1')
+    },
     'task_sms_sender': {
         'task': 'main.tasks.sms_report',
         'schedule': crontab(0, 0, day_of_month='11', month_of_year='5')
@@ -1,5 +1,7 @@
 from django import template
 
+from main.models import cut_description
+
 register = template.Library()
 
 
@@ -10,9 +12,4 @@ def revers_string(value):
 
 @register.filter(name='trunc_desc')
 def truncate_description(value):
-    idx = value.find('<hr />')
-    if idx < 0:
-        short_desc = value
-    else:
-        short_desc = value[: idx] + '<span class="h3">&#8230;</span>'
-    return short_desc
+    return cut_description(value)
@@ -1,4 +1,8 @@
 from django import template
+from django.templatetags.static import static
+
+from main.categories import category_tree
+from main.thumbnails import THUMBNAIL_PLACEHOLDER, thumbnail_url, thumbnail_variants
 
 register = template.Library()
 
@@ -7,3 +11,39 @@ register = template.Library()
 def get_current_time():
     from datetime import datetime
     return datetime.now().strftime('%H:%M:%S %d-%m-%Y')
+
+
+@register.simple_tag(takes_context=True)
+def query_string(context, **kwargs):
+    """Query string of the current request with the given parameters replaced, None removes a parameter"""
+    params = context['request'].GET.copy()
+    for key, value in kwargs.items():
+        if value is None:
+            params.pop(key, None)
+        else:
+            params[key] = value
+    return params.urlencode()
+
+
+@register.inclusion_tag('include/category_menu.html')
+def category_menu():
+    """Menu of the published categories, built from the cached tree without queries"""
+    return {'categories': category_tree()}
+
+
+@register.simple_tag
+def cached_thumbnail(image, alias):
+    """URL of the pre-generated thumbnail of an image, a placeholder until it is ready"""
+    return thumbnail_url(image.name if image else '', alias) or static(THUMBNAIL_PLACEHOLDER)
+
+
+@register.inclusion_tag('include/picture.html')
+def picture(image, alias, alt='', css_class=''):
+    """`<picture>` with WebP and 1x/2x `srcset` of the pre-generated thumbnails, `<img>` until they are ready"""
+    name = image.name if image else ''
+    return {
+        'variants': thumbnail_variants(name, alias),
+        'src': cached_thumbnail(image, alias),
+        'alt': alt,
+        'css_class': css_class,
+    }
@@ -1,3 +1,1430 @@
-# from django.test import TestCase
+import gzip
+import hashlib
+import io
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import types
+from contextlib import contextmanager
+from datetime import timedelta
+from smtplib import SMTPException
+from unittest import mock
+from urllib.parse import unquote
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Replace
+from django.http import QueryDict
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django_redis import get_redis_connection
+from PIL import Image
+
+from accounts.models import Sender
+from py_dev_user import db_metrics, metrics, profiling
+from py_dev_user.utilities import plain_text, send_batch
+
+from . import circulars, counters, sms, thumbnails
+from .cache import CATEGORY_TREE_KEY, LOCK_KEY, get_listing_stats, get_listing_version
+from .categories import CATEGORY_TREE_TTL, category_tree
+from .digest import DigestIndex, item_tags
+from .facets import ItemFilter, count_facets
+from .outbox import drain_batch, drain_outbox
+from .models import (AdditionalImage, CategoryModel, CircularChunk, CircularMessage, CurrencyModel, ItemModel,
+                     ItemReports, OutboxEvent, SellerModel, SMSLog, Subscriber, TagModel)
+from .paginators import CursorPaginator, InvalidCursor
+from .search import _suggest, search_items, suggest_names
+from .tasks import report, send_circular_message, sms_report
+from .views import ItemListView
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+def collect_letters(letters):
+    """Side effect of a mocked send_batch, the letters are added to the list"""
+    def send_batch(messages, **kwargs):
+        messages = list(messages)
+        letters.extend(messages)
+        return len(messages)
+
+    return send_batch
+
+
+@contextmanager
+def capture_on_commit_callbacks(execute=False):
+    """TestCase.captureOnCommitCallbacks of Django 3.2: on_commit callbacks of the block"""
+    callbacks = []
+    start = len(connection.run_on_commit)
+    try:
+        yield callbacks
+    finally:
+        callbacks[:] = [func for _, func in connection.run_on_commit[start:]]
+        if execute:
+            for callback in callbacks:
+                callback()
+
+
+class CatalogTestCase(TestCase):
+    """Catalog of 12 items with 1-3 tags each"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = SellerModel.objects.create(username='seller')
+        currency = CurrencyModel.objects.create(full_name='Hryvnia', short_name='грн.')
+        category = CategoryModel.objects.create(name='Socks')
+        cls.tags = [TagModel.objects.create(tag=f'tag{idx}') for idx in range(3)]
+
+        cls.items = []
+        for idx in range(12):
+            item = ItemModel.objects.create(
+                short_name=f'Item {idx}',
+                description=f'<p>Short {idx}</p><hr /><p>Long description {idx}</p>',
+                seller=seller,
+                category=category,
+                currency=currency,
+                price=idx,
+            )
+            item.tag.set(cls.tags[:idx % 3 + 1])
+            cls.items.append(item)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ItemQueryBudgetTest(CatalogTestCase):
+    """Fixed number of queries per page, whatever the number of items"""
+
+    def setUp(self):
+        cache.clear()
+        category_tree()
+
+    def test_item_list(self):
+        # count, items with related objects, tags, facet counts
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('item_list'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'грн.')
+        self.assertContains(response, '#tag2')
+
+    def test_item_list_next_page(self):
+        self.client.get(reverse('item_list'))
+
+        # facets are cached already
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('item_list'), {'page': 2})
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_items_by_tag(self):
+        # tag, count, items with related objects, tags, facet counts
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('items_by_tag', args=['tag0']))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_item_detail(self):
+        # item timestamp for the validators, item with related objects, additional images
+        with self.assertNumQueries(3), mock.patch('main.counters.record_view', return_value=1):
+            response = self.client.get(reverse('item_detail', args=[self.items[0].id]))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_listing_preview(self):
+        item = ItemModel.objects.listing().get(pk=self.items[0].pk)
+
+        self.assertEqual(item.description_preview, '<p>Short 0</p><span class="h3">&#8230;</span>')
+        self.assertIn('description', item.get_deferred_fields())
+
+    def test_preview_updates(self):
+        items = ItemModel.objects.filter(pk__in=[self.items[0].pk, self.items[1].pk])
+        items.update(description='<p>No cut</p>')
+        self.assertEqual(set(items.values_list('description_preview', flat=True)), {'<p>No cut</p>'})
+
+        ItemModel.objects.update(description_preview='')
+        out = io.StringIO()
+        call_command('backfill_description_preview', batch=5, stdout=out)
+
+        self.assertIn('Previews of 12 items filled', out.getvalue())
+        self.assertEqual(ItemModel.objects.get(pk=self.items[1].pk).description_preview, '<p>No cut</p>')
+        self.assertEqual(ItemModel.objects.get(pk=self.items[2].pk).description_preview,
+                         '<p>Short 2</p><span class="h3">&#8230;</span>')
+
+    def test_preview_expression_updates(self):
+        # the preview of the new description, not of the stored one
+        ItemModel.objects.filter(pk=self.items[0].pk).update(
+            description=Replace(F('description'), Value('Short'), Value('Brief')))
+        ItemModel.objects.filter(pk=self.items[1].pk).update(
+            description=Concat(Value('<p>Sale</p><hr />'), F('short_name')))
+
+        self.assertEqual(ItemModel.objects.get(pk=self.items[0].pk).description_preview,
+                         '<p>Brief 0</p><span class="h3">&#8230;</span>')
+        self.assertEqual(ItemModel.objects.get(pk=self.items[1].pk).description_preview,
+                         '<p>Sale</p><span class="h3">&#8230;</span>')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CursorPaginatorTest(CatalogTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.paginator = CursorPaginator(ItemModel.objects.listing(), 5)
+        self.expected = list(ItemModel.objects.order_by('-item_create', '-id').values_list('id', flat=True))
+
+    def test_walk_forward_and_back(self):
+        pages = [self.paginator.page()]
+        while pages[-1].has_next():
+            pages.append(self.paginator.page(pages[-1].next_cursor))
+
+        self.assertEqual([len(page) for page in pages], [5, 5, 2])
+        self.assertEqual([item.id for page in pages for item in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+
+        previous = self.paginator.page(pages[-1].previous_cursor)
+        self.assertEqual([item.id for item in previous], self.expected[5:10])
+        self.assertTrue(previous.has_next())
+        self.assertTrue(previous.has_previous())
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            self.paginator.page('garbage')
+
+    def test_item_list_view(self):
+        with mock.patch.object(ItemListView, 'pagination', 'cursor'):
+            first = self.client.get(reverse('item_list'))
+            second = self.client.get(reverse('item_list'), {'cursor': first.context['page_obj'].next_cursor})
+            broken = self.client.get(reverse('item_list'), {'cursor': 'garbage'})
+
+        self.assertEqual([item.id for item in second.context['object_list']], self.expected[5:10])
+        self.assertContains(second, '?cursor=')
+        self.assertEqual(broken.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ListingCacheTest(CatalogTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def assertCached(self, url, cached=True):
+        if cached:
+            with self.assertNumQueries(0):
+                return self.client.get(url)
+
+        response = self.client.get(url)
+        self.assertTrue(response.context is not None, 'Page was not rendered')
+        return response
+
+    def test_cached(self):
+        self.client.get(reverse('item_list'))
+        self.assertCached(reverse('item_list'))
+        self.assertCached(reverse('item_list') + '?page=2', cached=False)
+
+    def test_item_save(self):
+        self.client.get(reverse('item_list'))
+        self.client.get(reverse('items_by_tag', args=['tag1']))
+        self.client.get(reverse('items_by_tag', args=['tag2']))
+
+        with capture_on_commit_callbacks(execute=True):
+            item = ItemModel.objects.create(short_name='New item', description='', seller=self.items[0].seller)
+            item.tag.add(self.tags[1])
+
+        self.assertContains(self.assertCached(reverse('item_list'), cached=False), 'New item')
+        self.assertCached(reverse('items_by_tag', args=['tag1']), cached=False)
+        self.assertCached(reverse('items_by_tag', args=['tag2']))
+
+    def test_bulk_update(self):
+        self.client.get(reverse('item_list'))
+
+        with capture_on_commit_callbacks(execute=True):
+            ItemModel.objects.filter(pk=self.items[-1].pk).update(published=False)
+
+        response = self.assertCached(reverse('item_list'), cached=False)
+        self.assertNotContains(response, self.items[-1].short_name + '<')
+
+    def test_tag_bulk_update(self):
+        self.client.get(reverse('item_list'))
+        self.client.get(reverse('items_by_tag', args=['tag1']))
+
+        with capture_on_commit_callbacks(execute=True):
+            self.assertEqual(TagModel.objects.filter(tag='tag1').update(tag='wool'), 1)
+
+        self.assertContains(self.assertCached(reverse('item_list'), cached=False), 'wool')
+        self.assertCached(reverse('items_by_tag', args=['tag1']), cached=False)
+
+    def test_tags_changed(self):
+        self.client.get(reverse('items_by_tag', args=['tag2']))
+        self.client.get(reverse('items_by_tag', args=['tag1']))
+
+        with capture_on_commit_callbacks(execute=True):
+            self.items[-1].tag.remove(self.tags[2])
+        self.assertCached(reverse('items_by_tag', args=['tag2']), cached=False)
+        self.assertCached(reverse('items_by_tag', args=['tag1']))
+
+        self.tags[1].tag = 'renamed'
+        with capture_on_commit_callbacks(execute=True):
+            self.tags[1].save()
+        self.assertCached(reverse('items_by_tag', args=['tag0']), cached=False)
+
+    def test_bumped_on_commit(self):
+        url = reverse('item_list')
+        self.client.get(url)
+
+        with capture_on_commit_callbacks() as callbacks:
+            ItemModel.objects.filter(pk=self.items[-1].pk).update(short_name='Renamed')
+            # a request during the transaction caches the page under the old version
+            cache.clear()
+            self.client.get(url)
+            version = get_listing_version(['all'])
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertCached(url)
+        callbacks[0]()
+        self.assertNotEqual(get_listing_version(['all']), version)
+        self.assertCached(url, cached=False)
+
+    def test_stale_while_revalidate(self):
+        url = reverse('item_list')
+        self.client.get(url)
+        self.assertCached(url)
+
+        with capture_on_commit_callbacks(execute=True):
+            ItemModel.objects.filter(pk=self.items[-1].pk).update(price=100)
+
+        # another worker is rebuilding the page
+        lock_key = LOCK_KEY.format(url=hashlib.md5(f'http://testserver{url}'.encode()).hexdigest())
+        cache.set(lock_key, 1)
+        self.assertCached(url)
+
+        cache.delete(lock_key)
+        self.assertCached(url, cached=False)
+        self.assertCached(url)
+
+        self.assertEqual(get_listing_stats(), {'hit': 2, 'miss': 2, 'stale': 1})
+        with mock.patch.object(metrics, 'METRICS_ALLOWED_IPS', ('127.0.0.1',)):
+            self.assertContains(self.client.get(reverse('metrics')), 'listing_cache_requests_total{result="stale"} 1')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ConditionalGetTest(CatalogTestCase):
+
+    def setUp(self):
+        cache.clear()
+        category_tree()
+
+    def test_item_list(self):
+        url = reverse('items_by_tag', args=['tag1'])
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with capture_on_commit_callbacks(execute=True):
+            self.items[0].tag.add(self.tags[1])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+    def test_item_detail(self):
+        url = self.items[0].get_absolute_url()
+        with mock.patch('main.counters.record_view', return_value=1) as record_view:
+            response = self.client.get(url)
+            with self.assertNumQueries(1):
+                not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            since = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+
+        self.assertEqual((not_modified.status_code, since.status_code), (304, 304))
+        self.assertEqual(record_view.call_count, 3)
+
+        AdditionalImage.objects.create(item=self.items[0], image='extra.jpg')
+        with mock.patch('main.counters.record_view', return_value=1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FacetsTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.wool = CategoryModel.objects.create(name='Wool', parent=cls.items[0].category)
+        cls.hats = CategoryModel.objects.create(name='Hats')
+        cls.dollar = CurrencyModel.objects.create(full_name='Dollar', short_name='$')
+        ItemModel.objects.filter(pk__in=[item.pk for item in cls.items[:4]]).update(category=cls.wool)
+        ItemModel.objects.filter(pk__in=[item.pk for item in cls.items[:2]]).update(currency=cls.dollar)
+        ItemModel.objects.filter(pk=cls.items[-1].pk).update(category=cls.hats, in_stock=False)
+
+    def setUp(self):
+        cache.clear()
+
+    def counts(self, facets, facet):
+        return {value['label']: value['count'] for value in facets[facet]}
+
+    def test_one_query(self):
+        category_tree()
+        with self.assertNumQueries(1):
+            facets = count_facets(ItemModel.objects.published(), ItemFilter(QueryDict()))
+
+        self.assertEqual(self.counts(facets, 'category'), {'Socks': 11, 'Hats': 1})
+        self.assertEqual(self.counts(facets, 'currency'), {'грн.': 10, '$': 2})
+        self.assertEqual(self.counts(facets, 'in_stock'), {'In stock': 11, 'Out of stock': 1})
+        self.assertEqual(self.counts(facets, 'seller'), {'seller': 12})
+
+    def test_filtered(self):
+        response = self.client.get(reverse('item_list'), {'category': self.items[0].category.pk, 'in_stock': 1,
+                                                          'price_max': 5, 'page': 1})
+        facets = {facet['name']: facet['values'] for facet in response.context['facets']}
+
+        self.assertEqual(list(response.context['object_list']), self.items[5::-1][:5])
+        # counts of a facet ignore its own filter only
+        self.assertEqual(self.counts(facets, 'currency'), {'грн.': 4, '$': 2})
+        self.assertEqual(self.counts(facets, 'category'), {'Wool': 4})
+        self.assertEqual(self.counts(facets, 'in_stock'), {'In stock': 6})
+        self.assertTrue(facets['in_stock'][0]['active'])
+        self.assertEqual(facets['in_stock'][0]['query'], f'category={self.items[0].category.pk}&price_max=5')
+        self.assertEqual(facets['currency'][1]['query'],
+                         f'category={self.items[0].category.pk}&in_stock=1&price_max=5&currency={self.dollar.pk}')
+
+    def test_malformed(self):
+        item_filter = ItemFilter(QueryDict('currency=²&seller=-&category=x&price_min=²&price_max=5'))
+        self.assertEqual(item_filter.values, {'price_max': 5.0})
+        self.assertEqual(self.client.get(reverse('item_list'), {'price_min': '²', 'currency': '²'}).status_code, 200)
+
+    def test_invalidated(self):
+        self.client.get(reverse('item_list'))
+        self.hats.name = 'Caps'
+        with capture_on_commit_callbacks(execute=True):
+            self.hats.save()
+
+        self.assertContains(self.client.get(reverse('item_list')), 'Caps (1)')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CategoryListingTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.socks = cls.items[0].category
+        cls.wool = CategoryModel.objects.create(name='Wool', parent=cls.socks)
+        cls.hats = CategoryModel.objects.create(name='Hats')
+        cls.hidden = CategoryModel.objects.create(name='Hidden', published=False)
+        CategoryModel.objects.create(name='Under hidden', parent=cls.hidden)
+        ItemModel.objects.filter(pk__in=[item.pk for item in cls.items[:2]]).update(category=cls.wool)
+        ItemModel.objects.filter(pk=cls.items[2].pk).update(category=cls.hats)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_subtree(self):
+        socks = self.client.get(reverse('category_items', args=[self.socks.pk]), {'price_max': 5})
+        wool = self.client.get(self.wool.get_absolute_url())
+
+        self.assertCountEqual(socks.context['paginator'].object_list, self.items[:2] + self.items[3:6])
+        self.assertCountEqual(wool.context['object_list'], self.items[:2])
+        self.assertContains(wool, '<h1>Wool</h1>')
+        self.assertEqual(self.client.get(reverse('category_items', args=[self.hidden.pk])).status_code, 404)
+
+    def test_invalidated_on_commit(self):
+        category_tree()
+        with capture_on_commit_callbacks() as callbacks:
+            CategoryModel.objects.create(name='Gloves')
+            # a request during the transaction caches the tree it reads
+            self.assertNotIn('Gloves', [root.name for root in category_tree()])
+
+        for callback in callbacks:
+            callback()
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            self.assertIn('Gloves', [root.name for root in category_tree()])
+        cache_set.assert_called_once_with(CATEGORY_TREE_KEY, mock.ANY, CATEGORY_TREE_TTL)
+
+    def test_menu_from_cache(self):
+        tree = category_tree()
+        self.assertEqual([(root.name, [sub.name for sub in root.subcategories]) for root in tree],
+                         [('Socks', ['Wool']), ('Hats', [])])
+
+        with self.assertNumQueries(0):
+            menu = Template('{% load main_tags %}{% category_menu %}').render(Context())
+        self.assertIn(f'href="{self.wool.get_absolute_url()}"', menu)
+
+    def test_invalidated_on_move(self):
+        category_tree()
+        with capture_on_commit_callbacks(execute=True):
+            self.wool.move_to(self.hats)
+
+        self.assertEqual([sub.name for sub in category_tree()[1].subcategories], ['Wool'])
+        self.assertCountEqual(self.client.get(self.hats.get_absolute_url()).context['object_list'],
+                              self.items[:3])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ThumbnailsTest(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.settings = override_settings(MEDIA_ROOT=media_root)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        cache.clear()
+        thumbnails._lru.clear()
+
+        image = io.BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(image, 'JPEG')
+        self.name = default_storage.save('items/photo.jpg', ContentFile(image.getvalue()))
+        self.seller = SellerModel.objects.create(username='seller')
+
+    def test_queued_on_save(self):
+        with mock.patch('main.thumbnails.transaction.on_commit', lambda func: func()), \
+                mock.patch('main.tasks.generate_thumbnails.delay') as delay:
+            ItemModel.objects.create(short_name='Photo', description='', seller=self.seller, image=self.name)
+            ItemModel.objects.create(short_name='Same photo', description='', seller=self.seller, image=self.name)
+
+        delay.assert_called_once_with(self.name)
+
+    def test_urls_without_storage(self):
+        item = ItemModel.objects.create(short_name='Photo', description='', seller=self.seller, image=self.name)
+        self.assertContains(self.client.get(reverse('item_list')), 'src="/static/img/no_image.png"')
+
+        with capture_on_commit_callbacks(execute=True):
+            urls = thumbnails.generate_thumbnails(self.name)
+        self.assertEqual(set(urls), {'default', 'preview', 'image', 'avatar'})
+
+        with mock.patch('django.core.files.storage.FileSystemStorage.exists') as exists, \
+                mock.patch('main.counters.record_view', return_value=1):
+            listing = self.client.get(reverse('item_list'))
+            detail = self.client.get(item.get_absolute_url())
+
+        exists.assert_not_called()
+        self.assertContains(listing, f'src="{urls["default"]}"')
+        self.assertContains(detail, f'src="{urls["preview"]}"')
+
+        variants = thumbnails.thumbnail_variants(self.name, 'default')
+        self.assertTrue(variants['webp'][0].endswith('.webp'))
+        self.assertTrue(variants['webp'][1].endswith('%402x.webp'))
+        self.assertContains(listing, f'<source type="image/webp" srcset="{variants["webp"][0]} 1x, '
+                                     f'{variants["webp"][1]} 2x">')
+
+    def test_regenerated_on_miss(self):
+        thumbnails.generate_thumbnails(self.name)
+        cache.clear()
+        thumbnails._lru.clear()
+
+        with mock.patch('main.thumbnails.transaction.on_commit', lambda func: func()), \
+                mock.patch('main.tasks.generate_thumbnails.delay') as delay:
+            self.assertIsNone(thumbnails.thumbnail_variants(self.name, 'default'))
+            self.assertIsNone(thumbnails.thumbnail_variants(self.name, 'image'))
+
+        delay.assert_called_once_with(self.name)
+
+    def test_variants_command(self):
+        ItemModel.objects.create(short_name='Photo', description='', seller=self.seller, image=self.name)
+        other = default_storage.save('items/other.jpg', default_storage.open(self.name))
+        ItemModel.objects.create(short_name='Other', description='', seller=self.seller, image=other)
+        thumbnails.generate_thumbnails(self.name)
+
+        out = io.StringIO()
+        with mock.patch('main.management.commands.generate_image_variants.connections'):
+            call_command('generate_image_variants', workers=2, stdout=out)
+
+        self.assertIn('1 images, 2 workers', out.getvalue())
+        self.assertIn('1/1 images in', out.getvalue())
+        self.assertEqual(set(thumbnails.get_thumbnail_urls(other)), {'default', 'preview', 'image', 'avatar'})
+        path = unquote(thumbnails.thumbnail_variants(other, 'image')['webp'][1]).replace(settings.MEDIA_URL, '', 1)
+        self.assertTrue(default_storage.exists(path))
+
+
+class CreateDumpTest(CatalogTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def dump(self, *models, **options):
+        out = io.StringIO()
+        call_command('createdump', *models, output_file=f'{self.directory}/dump.tsv', stdout=out, **options)
+        return out.getvalue()
+
+    def test_copy_and_iterator(self):
+        output = self.dump('main.ItemModel', 'main.TagModel')
+        self.assertIn('main.ItemModel: 12 rows in', output)
+        self.assertIn('main.TagModel: 3 rows in', output)
+        self.assertIn('total: 15 rows in', output)
+        with open(f'{self.directory}/ItemModel_dump.tsv') as file:
+            copied = file.read()
+
+        self.dump('main.ItemModel', compress='gzip', no_copy=True, chunk_size=5)
+        with gzip.open(f'{self.directory}/ItemModel_dump.tsv.gz', 'rt') as file:
+            streamed = file.read()
+
+        lines = copied.splitlines()
+        self.assertEqual(len(lines), 13)
+        self.assertIn('<p>Short 0</p><hr /><p>Long description 0</p>', copied)
+
+        def values(content, names=('id', 'short_name', 'description', 'image', 'category', 'published')):
+            # floats and timestamps are formatted by the database with COPY
+            columns = content.splitlines()[0].split('\t')
+            return sorted([line.split('\t')[columns.index(name)] for name in names] for line in content.splitlines()[1:])
+
+        self.assertEqual(values(copied), values(streamed))
+
+    def test_unknown_model(self):
+        with self.assertRaises(CommandError):
+            self.dump('main.NoSuchModel')
+
+    def test_incremental(self):
+        state = f'{self.directory}/state.json'
+        self.assertIn('main.ItemModel: 12 rows in', self.dump('main.ItemModel', state_file=state))
+        # the rows saved within the margin are dumped again
+        self.assertIn('main.ItemModel: 12 rows in', self.dump('main.ItemModel', state_file=state))
+
+        self.dump('main.ItemModel', state_file=state, margin=0)
+        output = self.dump('main.ItemModel', state_file=state, m2m=True, margin=0)
+        self.assertIn('main.ItemModel: 0 rows in', output)
+        self.assertIn('main.ItemModel.tag: 0 rows in', output)
+
+        self.items[0].save()
+        self.items[1].tag.set(self.tags)
+        output = self.dump('main.ItemModel', state_file=state, m2m=True, no_copy=True, margin=0)
+        self.assertIn('main.ItemModel: 2 rows in', output)
+        self.assertIn('main.ItemModel.tag: 4 rows in', output)
+        with open(f'{self.directory}/ItemModel_tag_dump.tsv') as file:
+            self.assertEqual(file.readline(), 'id\titemmodel\ttagmodel\n')
+            self.assertEqual(sorted(line.split('\t')[1] for line in file),
+                             sorted([str(self.items[0].pk)] + [str(self.items[1].pk)] * 3))
+
+        self.assertIn('main.ItemModel: 0 rows in', self.dump('main.ItemModel', state_file=state, margin=0))
+        self.assertIn('main.ItemModel: 12 rows in', self.dump('main.ItemModel', since='2000-01-01'))
+
+    def test_incremental_bulk_update(self):
+        state = f'{self.directory}/state.json'
+        self.dump('main.ItemModel', state_file=state, margin=0)
+        ItemModel.objects.filter(pk=self.items[0].pk).update(published=False)
+
+        self.assertIn('main.ItemModel: 1 rows in', self.dump('main.ItemModel', state_file=state, margin=0))
+        with open(f'{self.directory}/ItemModel_dump.tsv') as file:
+            columns, row = file.readline().rstrip('\n').split('\t'), file.readline().split('\t')
+        self.assertEqual((row[columns.index('id')], row[columns.index('published')]), (str(self.items[0].pk), 'f'))
+
+    def test_incremental_errors(self):
+        with self.assertRaisesMessage(CommandError, 'main.TagModel has no auto_now field'):
+            self.dump('main.TagModel', since='2000-01-01')
+        with self.assertRaisesMessage(CommandError, 'yesterday is not a date and time'):
+            self.dump('main.ItemModel', since='yesterday')
+
+
+class ReportTaskTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        drain_outbox()
+        for name in ('ann', 'bob'):
+            user = User.objects.create(username=name, first_name=name, last_name='Smith', email=f'{name}@example.com')
+            Subscriber.objects.create(user=user)
+
+    def test_chunks(self):
+        # sender, 5 queries of the digest index, a select of the records and their tags per chunk, the last
+        # select finds nothing; then the items of the digest and the subscribers; an update per chunk
+        Sender.objects.create(name='sender', email='shop@example.com')
+        letters = []
+        with self.assertNumQueries(1 + 5 + 3 * 2 + 1 + 1 + 3 + 3), \
+                mock.patch('main.tasks.send_batch', side_effect=collect_letters(letters)) as send_batch:
+            metrics = report(chunk_size=5)
+
+        self.assertEqual({key: metrics[key] for key in ('reports', 'subscribers', 'digests', 'emails')},
+                         {'reports': 12, 'subscribers': 2, 'digests': 1, 'emails': 2})
+        self.assertFalse(ItemReports.objects.filter(is_send=False).exists())
+        # one letter per subscriber with the items of all the chunks, made while they are sent
+        self.assertIsInstance(send_batch.call_args[0][0], types.GeneratorType)
+        self.assertEqual(sorted(recipients for _, _, recipients in letters),
+                         [['ann@example.com'], ['bob@example.com']])
+        subject, message, recipients = letters[-1]
+        self.assertIn('Smith, ' + recipients[0].split('@')[0], message)
+        self.assertEqual(message.count('/main/item/'), 12)
+        self.assertIn(f'/main/item/{self.items[-1].id}/', message)
+        self.assertIn('грн.', message)
+        self.assertIn('Short 11', message)
+        self.assertNotIn('Long description', message)
+
+        with mock.patch('main.tasks.send_batch') as send_batch:
+            self.assertEqual(report()['reports'], 0)
+        send_batch.assert_not_called()
+
+    def test_digest_size(self):
+        Sender.objects.create(name='sender', email='shop@example.com')
+        letters = []
+        with mock.patch('main.tasks.send_batch', side_effect=collect_letters(letters)), \
+                mock.patch('main.tasks.DIGEST_SIZE', 5):
+            report(chunk_size=5)
+
+        subject, message, recipients = letters[0]
+        self.assertEqual(message.count('/main/item/'), 5)
+        self.assertIn('И ещё 7', message)
+
+
+class OutboxTest(CatalogTestCase):
+
+    def test_edits_coalesce(self):
+        item = self.items[0]
+        for name in ('Item 0 v2', 'Item 0 v3'):
+            item.short_name = name
+            item.save()
+
+        self.assertEqual(sorted(OutboxEvent.objects.filter(item=item).values_list('kind', flat=True)),
+                         [OutboxEvent.CREATED, OutboxEvent.UPDATED])
+        self.assertFalse(ItemReports.objects.exists())
+
+    def test_drain(self):
+        self.items[0].save()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(drain_outbox(batch_size=5), 13)
+        self.assertIn('FOR UPDATE SKIP LOCKED', queries[1]['sql'])
+
+        self.assertEqual(ItemReports.objects.count(), 12)
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(drain_outbox(), 0)
+
+        self.items[1].save()
+        drain_outbox()
+        self.assertEqual(ItemReports.objects.count(), 12)
+
+    def test_bulk_update(self):
+        drain_outbox()
+        ItemModel.objects.filter(pk=self.items[0].pk).update(published=False)
+        ItemModel.objects.filter(pk__in=[self.items[0].pk, self.items[1].pk]).update(price=10)
+        ItemModel.objects.filter(pk=self.items[2].pk).update(views=5)
+
+        self.assertEqual(sorted(OutboxEvent.objects.values_list('item_id', 'kind', 'seq')),
+                         [(self.items[0].pk, OutboxEvent.UPDATED, 2), (self.items[1].pk, OutboxEvent.UPDATED, 1)])
+
+    def test_neutral_save(self):
+        drain_outbox()
+        item = self.items[0]
+        item.views = 5
+        item.save(update_fields=['views'])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+        item.save(update_fields=['views', 'price'])
+        self.assertTrue(OutboxEvent.objects.filter(item=item, kind=OutboxEvent.UPDATED).exists())
+
+    def test_edited_while_drained(self):
+        item = self.items[0]
+        item.save()
+        self.assertEqual(OutboxEvent.objects.get(item=item, kind=OutboxEvent.UPDATED).seq, 1)
+        item.save()
+        self.assertEqual(OutboxEvent.objects.get(item=item, kind=OutboxEvent.UPDATED).seq, 2)
+
+        updated = []
+
+        def edit(item_ids):
+            # an edit recorded after the batch is read
+            updated.append(item_ids)
+            if len(updated) == 1:
+                item.save()
+
+        with mock.patch.dict('main.outbox._consumers', {OutboxEvent.UPDATED: [edit]}):
+            self.assertEqual(drain_batch(), 13)
+            self.assertEqual(list(OutboxEvent.objects.values_list('item_id', 'kind', 'seq')),
+                             [(item.id, OutboxEvent.UPDATED, 3)])
+            self.assertEqual(drain_outbox(), 1)
+
+        self.assertEqual(updated, [[item.id], [item.id]])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_failed_consumer(self):
+        with mock.patch.object(ItemReports.objects, 'bulk_create', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            drain_outbox()
+
+        self.assertEqual(OutboxEvent.objects.count(), 12)
+
+
+class DigestTest(CatalogTestCase):
+    """Items have tag0, every third from the second one tag1 too, every third from the third one all the tags"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        drain_outbox()
+        socks = CategoryModel.objects.get(name='Socks')
+        cls.wool = CategoryModel.objects.create(name='Wool', parent=socks)
+        ItemModel.objects.filter(id__in=[item.id for item in cls.items[:2]]).update(category=cls.wool)
+        follows = {'ann': ([cls.tags[2]], []), 'bob': ([], [socks]), 'carl': ([], []),
+                   'dan': ([cls.tags[1], cls.tags[2]], []), 'eve': ([], [cls.wool])}
+        cls.subscribers = {}
+        for name, (tags, categories) in follows.items():
+            user = User.objects.create(username=name, first_name=name, last_name='Smith', email=f'{name}@example.com')
+            subscriber = Subscriber.objects.create(user=user)
+            subscriber.tags.set(tags)
+            subscriber.categories.set(categories)
+            cls.subscribers[name] = subscriber.id
+
+    def test_match(self):
+        index = DigestIndex.build()
+        tags = item_tags(item.id for item in self.items)
+        items = [(item.id, tags[item.id], category_id)
+                 for item, category_id in zip(self.items, [self.wool.id] * 2 + [self.items[2].category_id] * 10)]
+        groups = index.match(items, 0, index.last_id + 1)
+        names = {subscriber_id: name for name, subscriber_id in self.subscribers.items()}
+        digests = {tuple(sorted(names[subscriber_id] for subscriber_id in subscriber_ids)): item_ids
+                   for item_ids, subscriber_ids in groups.items()}
+
+        ids = [item.id for item in self.items]
+        self.assertEqual(digests, {
+            ('bob', 'carl'): tuple(ids),
+            ('ann',): tuple(ids[2::3]),
+            ('dan',): tuple(item_id for idx, item_id in enumerate(ids) if idx % 3),
+            ('eve',): tuple(ids[:2]),
+        })
+
+        # a range of subscriber ids gets only its subscribers
+        groups = index.match(items, self.subscribers['carl'], self.subscribers['carl'] + 1)
+        self.assertEqual(groups, {tuple(ids): [self.subscribers['carl']]})
+
+    def test_report(self):
+        Sender.objects.create(name='sender', email='shop@example.com')
+        letters = []
+        with mock.patch('main.tasks.send_batch', side_effect=collect_letters(letters)):
+            metrics = report()
+
+        self.assertEqual((metrics['digests'], metrics['emails']), (4, 5))
+        letters = {recipients[0]: message for subject, message, recipients in letters}
+        self.assertEqual(letters['ann@example.com'].count('/main/item/'), 4)
+        self.assertEqual(letters['eve@example.com'].count('/main/item/'), 2)
+        self.assertEqual(letters['bob@example.com'].count('/main/item/'), 12)
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    """Just enough of SMTP for smtplib"""
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 stub')
+        data = None
+        for line in self.rfile:
+            line = line.decode().rstrip('\r\n')
+            if data is not None:
+                if line == '.':
+                    self.server.messages.append('\n'.join(data))
+                    data = None
+                    self.reply('250 OK')
+                else:
+                    data.append(line)
+                continue
+
+            command = line[:4].upper()
+            if command == 'DATA':
+                data = []
+                self.reply('354 go on')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('250 OK')
+
+    def reply(self, text):
+        self.wfile.write(f'{text}\r\n'.encode())
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPStubHandler)
+        self.connections = 0
+        self.messages = []
+
+
+class SMTPTestCase(TestCase):
+    """Letters go to a local SMTP stub"""
+
+    def setUp(self):
+        self.smtp = SMTPStub()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        self.addCleanup(self.smtp.server_close)
+        self.addCleanup(self.smtp.shutdown)
+        patcher = override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                    EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.smtp.server_address[1])
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        Sender.objects.create(name='sender', email='shop@example.com')
+
+
+class SendBatchTest(SMTPTestCase):
+
+    def test_one_connection(self):
+        messages = [('News', '<p>Hello</p>', [f'user{idx}@example.com']) for idx in range(250)]
+        with self.assertNumQueries(1):
+            # sender
+            self.assertEqual(send_batch(messages), 250)
+
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(len(self.smtp.messages), 250)
+        self.assertIn('Hello', self.smtp.messages[0])
+
+    def test_plain_texts_bounded(self):
+        plain_text.cache_clear()
+        send_batch([('News', f'<p>Hello {idx}</p>', ['ann@example.com']) for idx in range(100)] +
+                   [('News', '<p>Hello 99</p>', ['bob@example.com'])])
+
+        info = plain_text.cache_info()
+        self.assertEqual((info.hits, info.currsize), (1, info.maxsize))
+
+    def test_no_sender(self):
+        Sender.objects.all().delete()
+        self.assertEqual(send_batch([('News', '<p>Hello</p>', ['ann@example.com'])]), 0)
+        self.assertEqual(self.smtp.connections, 0)
+
+
+class CircularMessageTest(SMTPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = User.objects.create(username='staff', email='staff@example.com', is_staff=True)
+        User.objects.bulk_create(User(username=f'user{idx}', email=f'user{idx}@example.com') for idx in range(120))
+        self.message = CircularMessage.objects.create(author=self.author, subject='News', body='<p>Hello</p>')
+        self.bucket = circulars.TokenBucket(key='test:circular:rate', rate=1000, burst=1000)
+        self.addCleanup(get_redis_connection('default').delete, 'test:circular:rate')
+
+    def test_chunks(self):
+        self.assertEqual(circulars.plan_chunks(self.message, 50), 3)
+        self.assertEqual(circulars.plan_chunks(self.message, 50), 3)
+        self.assertEqual([chunk.size for chunk in self.message.chunks.order_by('number')], [50, 50, 20])
+
+        for chunk_id in circulars.pending_chunks(self.message):
+            circulars.send_chunk(chunk_id, bucket=self.bucket, batch_size=20)
+
+        # a connection per chunk
+        self.assertEqual(self.smtp.connections, 3)
+        self.assertEqual(len(self.smtp.messages), 120)
+        self.assertEqual(self.message.progress(), {'total': 120, 'sent': 120, 'failed': 0, 'remaining': 0})
+        self.message.refresh_from_db()
+        self.assertIsNotNone(self.message.finished)
+        self.assertIsNone(circulars.send_chunk(circulars.pending_chunks(self.message) or 0))
+
+    def test_resume(self):
+        circulars.plan_chunks(self.message, 50)
+        chunk = self.message.chunks.get(number=0)
+        calls = []
+
+        def crash(messages, **kwargs):
+            calls.append(messages)
+            if len(calls) == 2:
+                raise OSError('connection lost')
+            return send_batch(messages, **kwargs)
+
+        with mock.patch('main.circulars.send_batch', crash), self.assertRaises(OSError):
+            circulars.send_chunk(chunk.id, bucket=self.bucket, batch_size=20)
+        chunk.refresh_from_db()
+        self.assertEqual((chunk.sent, chunk.is_done), (20, False))
+
+        circulars.send_chunk(chunk.id, bucket=self.bucket, batch_size=20)
+        recipients = [line for message in self.smtp.messages for line in message.split('\n') if line.startswith('To:')]
+        self.assertEqual(len(recipients), 50)
+        self.assertEqual(len(set(recipients)), 50)
+        self.assertEqual(self.message.progress()['remaining'], 70)
+
+    def test_leased(self):
+        circulars.plan_chunks(self.message, 50)
+        chunk = self.message.chunks.get(number=0)
+        self.assertTrue(circulars.lease_chunk(chunk.id, 'other'))
+
+        # a resume skips the chunk sent by another worker
+        self.assertNotIn(chunk.id, circulars.pending_chunks(self.message))
+        self.assertIsNone(circulars.send_chunk(chunk.id, bucket=self.bucket))
+        self.assertEqual(self.smtp.messages, [])
+
+        # the lease of a crashed worker expires
+        self.message.chunks.filter(id=chunk.id).update(leased_until=timezone.now() - timedelta(seconds=1))
+        self.assertIn(chunk.id, circulars.pending_chunks(self.message))
+        circulars.send_chunk(chunk.id, bucket=self.bucket, batch_size=20)
+        chunk.refresh_from_db()
+        self.assertEqual((chunk.sent, chunk.is_done, chunk.lease, chunk.leased_until), (50, True, '', None))
+
+    def test_lease_lost(self):
+        circulars.plan_chunks(self.message, 50)
+        chunk = self.message.chunks.get(number=0)
+
+        def steal(messages, **kwargs):
+            CircularChunk.objects.filter(id=chunk.id).update(lease='other')
+            return send_batch(messages, **kwargs)
+
+        with mock.patch('main.circulars.send_batch', steal):
+            self.assertIsNone(circulars.send_chunk(chunk.id, bucket=self.bucket, batch_size=20))
+        chunk.refresh_from_db()
+        self.assertEqual((len(self.smtp.messages), chunk.sent, chunk.lease), (20, 0, 'other'))
+
+    def test_failed_within_batch(self):
+        circulars.plan_chunks(self.message, 50)
+        chunk = self.message.chunks.get(number=0)
+
+        def flaky(messages, **kwargs):
+            # the backend fails on the third letter of every batch
+            sent = 0
+            for idx, letter in enumerate(messages):
+                if idx == 2:
+                    raise SMTPException('refused')
+                sent += send_batch([letter], **kwargs)
+            return sent
+
+        with mock.patch('main.circulars.send_batch', flaky), self.assertRaises(SMTPException):
+            circulars.send_chunk(chunk.id, bucket=self.bucket, batch_size=20)
+        chunk.refresh_from_db()
+        self.assertEqual((chunk.sent, chunk.failed, chunk.is_done), (2, 0, False))
+
+        with mock.patch('main.circulars.send_batch', flaky):
+            circulars.send_chunk(chunk.id, give_up=True, bucket=self.bucket, batch_size=20)
+        chunk.refresh_from_db()
+        # batches of 20, 20 and 8 after the two sent, two letters of every one sent
+        self.assertEqual((chunk.sent, chunk.failed, chunk.is_done), (8, 42, True))
+        self.assertEqual(len(self.smtp.messages), 8)
+        self.assertEqual(self.message.progress()['sent'], 8)
+
+    def test_give_up(self):
+        circulars.plan_chunks(self.message, 50)
+        chunk = self.message.chunks.get(number=2)
+        with mock.patch('main.circulars.send_batch', side_effect=OSError('refused')):
+            circulars.send_chunk(chunk.id, give_up=True, bucket=self.bucket)
+
+        chunk.refresh_from_db()
+        self.assertEqual((chunk.sent, chunk.failed, chunk.is_done), (0, 20, True))
+
+    def test_task(self):
+        with mock.patch('main.tasks.group') as group:
+            self.assertEqual(send_circular_message(self.message.id, chunk_size=50), 3)
+        self.assertEqual(len(list(group.call_args[0][0])), 3)
+
+        self.message.chunks.filter(number__lt=2).update(is_done=True)
+        with mock.patch('main.tasks.group') as group:
+            self.assertEqual(send_circular_message(self.message.id, chunk_size=50), 1)
+
+    def test_rate_limit(self):
+        bucket = circulars.TokenBucket(key='test:circular:rate', rate=10, burst=20)
+        self.assertEqual(bucket.try_acquire(20), 0)
+        self.assertAlmostEqual(bucket.try_acquire(10), 1, delta=0.1)
+
+        sleep = mock.Mock(side_effect=lambda seconds: time.sleep(0.05))
+        bucket.acquire(1, sleep=sleep)
+        self.assertTrue(sleep.called)
+
+    def test_more_than_burst(self):
+        bucket = circulars.TokenBucket(key='test:circular:rate', rate=1000, burst=20)
+        with self.assertRaises(ValueError):
+            bucket.try_acquire(50)
+
+        # the batch is taken by parts, a wait repeats the part
+        with mock.patch.object(bucket, 'try_acquire', side_effect=[0, 0.01, 0, 0]) as try_acquire:
+            bucket.acquire(50, sleep=mock.Mock())
+        self.assertEqual([call[0][0] for call in try_acquire.call_args_list], [20, 20, 20, 10])
+
+    def test_progress_page(self):
+        circulars.plan_chunks(self.message, 50)
+        url = reverse('circular_message', args=[self.message.id])
+        self.client.force_login(self.author)
+        response = self.client.get(url)
+        self.assertEqual(response.context['progress']['remaining'], 120)
+
+        self.client.force_login(User.objects.create(username='stranger', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_form(self):
+        self.client.force_login(self.author)
+        with mock.patch('main.forms.send_circular_message') as task, \
+                mock.patch('django.db.transaction.on_commit', lambda callback: callback()):
+            response = self.client.post(reverse('send_msg'), {'subject': 'Sale', 'body': '<p>Sale</p>'})
+
+        message = CircularMessage.objects.get(subject='Sale')
+        self.assertRedirects(response, message.get_absolute_url())
+        task.delay.assert_called_once_with(message.id)
+
+
+class RequestMetricsTest(CatalogTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(metrics, METRICS_KEY='test:metrics:requests', histograms=metrics.Histograms(),
+                                      METRICS_ALLOWED_IPS=('127.0.0.1',))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_redis_connection('default').delete, 'test:metrics:requests')
+
+    def test_endpoint(self):
+        for url in (reverse('item_list'), reverse('item_list'), reverse('item_detail', args=[self.items[0].id]),
+                    '/main/nowhere/'):
+            self.client.get(url)
+
+        content = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_request_duration_seconds_count{view="item_list",method="GET",status="200"} 2', content)
+        self.assertIn('http_request_duration_seconds_count{view="item_detail",method="GET",status="200"} 1', content)
+        self.assertIn('http_request_duration_seconds_count{view="<unmatched>",method="GET",status="404"} 1', content)
+        self.assertIn('http_request_duration_seconds_bucket{view="item_list",method="GET",status="200",le="+Inf"} 2',
+                      content)
+        self.assertIn('http_request_duration_quantile_seconds{view="item_list",method="GET",status="200",'
+                      'quantile="0.99"}', content)
+        self.assertRegex(content, r'http_request_db_queries_total\{view="item_detail",method="GET",status="200"\} [1-9]')
+
+    def test_access(self):
+        url = reverse('metrics')
+        with mock.patch.multiple(metrics, METRICS_ALLOWED_IPS=(), METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertContains(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret'), 'listing_cache_requests_total')
+
+            self.client.force_login(User.objects.create(username='staff', is_staff=True))
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_server_timing(self):
+        url = reverse('item_detail', args=[self.items[0].id])
+        with mock.patch.object(db_metrics, 'SERVER_TIMING', False):
+            self.assertNotIn('Server-Timing', self.client.get(url))
+
+            self.client.force_login(User.objects.create(username='staff', is_staff=True))
+            response = self.client.get(url)
+        self.assertRegex(response['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries, \d+ duplicated", app;dur=[\d.]+$')
+        self.assertIn('Cookie', response['Vary'])
+
+        with mock.patch.object(db_metrics, 'SERVER_TIMING', True):
+            self.client.logout()
+            self.assertIn('Server-Timing', self.client.get(url))
+
+    def test_query_recorder(self):
+        with db_metrics.QueryRecorder() as recorder:
+            for item in self.items[:3]:
+                ItemModel.objects.get(id=item.id)
+            list(TagModel.objects.filter(tag__in=['tag0', 'tag1']))
+
+        self.assertEqual(recorder.count, 4)
+        self.assertEqual(list(recorder.duplicates().values()), [3])
+        self.assertEqual(recorder.slowest(1)[0][1], 3)
+        self.assertEqual(db_metrics.fingerprint("SELECT 1 FROM t WHERE id IN (%s, %s, %s) AND name = 'it''s' LIMIT 21"),
+                         'SELECT ? FROM t WHERE id IN (...) AND name = ? LIMIT ?')
+
+    def test_slow_request(self):
+        with mock.patch.object(db_metrics, 'SLOW_REQUEST_THRESHOLD', 0), \
+                self.assertLogs('py_dev_user.db_metrics', 'WARNING') as logs:
+            self.client.get(reverse('item_detail', args=[self.items[0].id]))
+
+        self.assertIn(f'Slow request GET /main/item/{self.items[0].id}/', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_workers_merge(self):
+        # histograms of two processes flushed into the shared hash
+        labels = ('item_list', 'GET', '200')
+        for seconds in (0.001, 0.2):
+            worker = metrics.Histograms()
+            worker.observe(labels, seconds)
+            worker.flush()
+
+        counts, totals = metrics.collect()[labels]
+        self.assertEqual(sum(counts), 2)
+        self.assertAlmostEqual(totals[0], 0.201)
+
+    def test_quantile(self):
+        self.assertAlmostEqual(metrics.quantile(0.5, [0, 10, 0], buckets=(0.1, 0.2)), 0.15)
+        self.assertAlmostEqual(metrics.quantile(0.99, [5, 0, 5], buckets=(0.1, 0.2)), 0.2)
+        self.assertIsNone(metrics.quantile(0.5, [0, 0, 0], buckets=(0.1, 0.2)))
+
+
+class ProfilingTest(CatalogTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = mock.patch.multiple(profiling, PROFILE_DIR=profiling.Path(directory), PROFILE_INTERVAL=0.0001)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.user = User.objects.create(username='user')
+
+    def get_items(self, user, token):
+        self.client.force_login(user)
+        return self.client.get(reverse('item_list'), HTTP_X_PROFILE=token)
+
+    def test_staff_token(self):
+        self.get_items(self.staff, profiling.make_token(self.staff.pk))
+
+        profiles = profiling.recent_profiles()
+        self.assertEqual(list(profiles), ['item_list'])
+        content = (profiling.PROFILE_DIR / profiles['item_list'][0]['name']).read_text()
+        self.assertRegex(content, r'^\S.* \d+\n')
+        self.assertIn('get_response', content)
+
+    def test_not_profiled(self):
+        self.get_items(self.user, profiling.make_token(self.user.pk))
+        self.get_items(self.staff, profiling.make_token(self.user.pk))
+        self.get_items(self.staff, profiling.make_token(self.staff.pk) + 'x')
+        self.get_items(self.staff, '')
+
+        self.assertEqual(profiling.recent_profiles(), {})
+
+    def test_sample_rate_rotation(self):
+        with mock.patch.multiple(profiling, PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2):
+            for _ in range(3):
+                self.client.get(reverse('item_list'))
+
+        self.assertEqual(len(profiling.recent_profiles()['item_list']), 2)
+
+    def test_admin_page(self):
+        self.get_items(self.staff, profiling.make_token(self.staff.pk))
+        name = profiling.recent_profiles()['item_list'][0]['name']
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('profiles')).status_code, 302)
+        self.assertEqual(self.client.get(reverse('profile_file', args=[name])).status_code, 302)
+
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('profiles'))
+        self.assertContains(response, name)
+        self.assertContains(response, f'X-Profile: {self.staff.pk}:')
+        self.assertEqual(self.client.get(reverse('profile_file', args=[name])).status_code, 200)
+        self.assertEqual(self.client.get(reverse('profile_file', args=['..settings.py'])).status_code, 404)
+
+
+class SMSReportTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for idx, phone_number in enumerate(('+380500000001', '+380500000002', None)):
+            user = User.objects.create(username=f'user{idx}')
+            user.profile.phone_number = phone_number
+            user.profile.save()
+            Subscriber.objects.create(user=user)
+
+    def test_report(self):
+        client = sms.FakeClient()
+        with mock.patch('main.sms.get_client', return_value=client), self.assertNumQueries(2):
+            # subscribers with phones, then the log
+            self.assertEqual(sms_report(), {'sent': 2, 'failed': 0})
+
+        self.assertEqual(sorted(to for to, _ in client.sent), ['+380500000001', '+380500000002'])
+        self.assertEqual(sorted(SMSLog.objects.values_list('message', flat=True)),
+                         sorted(body for _, body in client.sent))
+
+    def test_retries(self):
+        sleep = mock.Mock()
+        client = sms.FakeClient(failures=2)
+        self.assertEqual(sms.send_with_retries(client, '+380500000001', '1234', backoff=0.5, sleep=sleep), 'queued')
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.5, 1.0])
+
+        client = sms.FakeClient(failures=5)
+        with self.assertLogs('main.sms', 'ERROR'):
+            self.assertEqual(sms.send_with_retries(client, '+380500000001', '1234', retries=2, sleep=sleep), sms.FAILED)
+
+    def test_client_without_send(self):
+        class Client(sms.SMSClient):
+            pass
+
+        with self.assertRaises(TypeError):
+            Client()
+
+    def test_failed_logged(self):
+        user_id = User.objects.get(username='user0').id
+        result = sms.send_sms([(user_id, '+380500000001', str(idx)) for idx in range(5)],
+                              client=sms.FakeClient(failures=10), workers=2, batch_size=2, retries=1, backoff=0)
+        self.assertEqual(result, {'sent': 0, 'failed': 5})
+        self.assertEqual(SMSLog.objects.filter(response=sms.FAILED).count(), 5)
+
+
+class ItemViewCountersTest(CatalogTestCase):
+    """Counters live in Redis, see CACHES"""
+
+    def setUp(self):
+        patcher = mock.patch.multiple(counters, PENDING_KEY='test:item-views:pending',
+                                      FLUSHING_KEY='test:item-views:flushing',
+                                      FLUSH_ID_KEY='test:item-views:flush-id',
+                                      FLUSH_LOCK_KEY='test:item-views:flush-lock',
+                                      TRENDING_BUCKET_KEY='test:item-trending:{hour}',
+                                      TRENDING_KEY='test:item-trending:window',
+                                      TRENDING_MERGED_KEY='test:item-trending:merged')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.delete_keys)
+
+    def delete_keys(self):
+        keys = counters._redis().keys('test:item-*')
+        if keys:
+            counters._redis().delete(*keys)
+
+    def view(self, item, times=1):
+        for _ in range(times):
+            response = self.client.get(reverse('item_detail', args=[item.id]))
+        return response
+
+    def test_detail_views(self):
+        item = self.items[0]
+        for amount in (1, 2):
+            response = self.client.get(reverse('item_detail', args=[item.id]))
+            self.assertEqual(response.context['amount_views'], amount)
+
+        self.client.get(reverse('item_detail', args=[self.items[1].id]))
+        self.assertEqual(counters.pending_views(), {item.id: 2, self.items[1].id: 1})
+
+        with self.assertNumQueries(6):
+            # savepoint, flush id check, previous flush delete, flush insert, update, release savepoint
+            self.assertEqual(counters.flush_views(), 2)
+
+        self.assertEqual(counters.pending_views(), {})
+        self.assertEqual(ItemModel.objects.get(pk=item.pk).views, 2)
+        response = self.client.get(reverse('item_detail', args=[item.id]))
+        self.assertEqual(response.context['amount_views'], 3)
+
+    def test_flush_nothing(self):
+        self.assertEqual(counters.flush_views(), 0)
+
+    def test_flush_once(self):
+        self.view(self.items[0], times=2)
+        # a flush crashed after its commit, before the counters were deleted
+        with mock.patch.object(counters._redis().__class__, 'delete'):
+            self.assertEqual(counters.flush_views(), 1)
+        self.assertEqual(counters.flush_views(), 0)
+        self.assertEqual(ItemModel.objects.get(pk=self.items[0].pk).views, 2)
+
+        # another flush is running
+        lock = counters._redis().lock(counters.FLUSH_LOCK_KEY, timeout=10)
+        lock.acquire()
+        self.view(self.items[0])
+        self.assertEqual(counters.flush_views(), 0)
+        lock.release()
+        self.assertEqual(counters.flush_views(), 1)
+        self.assertEqual(ItemModel.objects.get(pk=self.items[0].pk).views, 3)
+
+    def test_trending(self):
+        self.view(self.items[3], times=3)
+        self.view(self.items[5], times=2)
+        self.view(self.items[1])
+
+        self.assertEqual(counters.trending_ids(2), [self.items[3].id, self.items[5].id])
+
+        with self.assertNumQueries(2):
+            # items, tags
+            response = self.client.get(reverse('trending_items'))
+        self.assertEqual(list(response.context['object_list']), [self.items[3], self.items[5], self.items[1]])
+
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, self.items[3].short_name)
+
+    def test_trending_decay(self):
+        with mock.patch.object(counters, '_current_hour', return_value=1000):
+            self.view(self.items[3], times=3)
+        with mock.patch.object(counters, '_current_hour', return_value=1000 + counters.TRENDING_HALF_LIFE * 2):
+            self.view(self.items[5], times=2)
+            counters.merge_trending()
+            self.assertEqual(counters.trending_ids(2), [self.items[5].id, self.items[3].id])
+
+    def test_rebuild_trending(self):
+        ItemModel.objects.filter(pk=self.items[2].pk).update(views=10)
+        ItemModel.objects.filter(pk=self.items[4].pk).update(views=5)
+        self.view(self.items[4], times=6)
+
+        call_command('rebuild_trending', stdout=io.StringIO())
+
+        self.assertEqual(counters.trending_ids(5), [self.items[4].id, self.items[2].id])
+
+    def test_rebuild_trending_published(self):
+        self.view(self.items[1], times=2)
+        self.view(self.items[3])
+        ItemModel.objects.filter(pk=self.items[1].pk).update(published=False)
+
+        call_command('rebuild_trending', stdout=io.StringIO())
+
+        self.assertEqual(counters.trending_ids(5), [self.items[3].id])
+
+    def test_trending_empty(self):
+        self.assertEqual(counters.trending_ids(5), [])
+        with mock.patch.object(counters, 'merge_trending') as merge_trending:
+            self.assertEqual(counters.trending_ids(5), [])
+        merge_trending.assert_not_called()
+
+
+class ItemSearchTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        seller = cls.items[0].seller
+        cls.socks = ItemModel.objects.create(short_name='Woolen socks', description='<p>Very warm</p>', seller=seller)
+        cls.hat = ItemModel.objects.create(short_name='Warm hat', description='<p>Goes well with socks</p>',
+                                           seller=seller)
+
+    def test_ranking(self):
+        response = self.client.get(reverse('item_search'), {'q': 'socks'})
+
+        self.assertEqual(list(response.context['object_list']), [self.socks, self.hat])
+        self.assertContains(response, 'Goes well with <mark>socks</mark>')
+
+    def test_trigger(self):
+        ItemModel.objects.filter(pk=self.hat.pk).update(description='<p>Knitted</p>')
+
+        self.assertQuerysetEqual(search_items('socks'), [self.socks], transform=lambda item: item)
+        self.assertQuerysetEqual(search_items('knit'), [self.hat], transform=lambda item: item)
+
+    def test_pagination(self):
+        first = self.client.get(reverse('item_search'), {'q': 'description'})
+        self.assertEqual(len(first.context['object_list']), 10)
+
+        second = self.client.get(reverse('item_search'), {'q': 'description',
+                                                          'cursor': first.context['page_obj'].next_cursor})
+        found = list(first.context['object_list']) + list(second.context['object_list'])
+        self.assertCountEqual(found, self.items)
+        self.assertContains(first, '?q=description&amp;cursor=')
+
+    def test_empty(self):
+        category_tree()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('item_search'), {'q': ' '})
+
+        self.assertEqual(list(response.context['object_list']), [])
+
+
+class ItemAutocompleteTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = SellerModel.objects.create(username='seller')
+        for name in ('Woolen socks', 'Warm hat', 'Warm gloves', 'Hidden warm scarf'):
+            ItemModel.objects.create(short_name=name, description='', seller=seller, published=name[0] != 'H')
+
+    def setUp(self):
+        _suggest.cache_clear()
+
+    def test_prefix_then_similar(self):
+        response = self.client.get(reverse('item_autocomplete'), {'q': ' WARM '})
+
+        self.assertEqual(response.json(), {'query': ' WARM ', 'names': ['Warm gloves', 'Warm hat']})
+        self.assertEqual(suggest_names('wolen socks'), ['Woolen socks'])
+
+    def test_prefix_lookup(self):
+        ItemModel.objects.create(short_name='100% wool', description='', seller=SellerModel.objects.get())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(suggest_names('100%'), ['100% wool'])
+            self.assertEqual(suggest_names('10_%'), [])
+
+        # served by the trigram index, unlike UPPER(short_name) LIKE
+        self.assertIn('"main_itemmodel"."short_name" ILIKE', queries[0]['sql'])
+        self.assertNotIn('UPPER', queries[0]['sql'])
+
+    def test_cacheable(self):
+        response = self.client.get(reverse('item_autocomplete'), {'q': 'woo'})
+
+        self.assertIn('public', response['Cache-Control'])
+        self.assertFalse(response.has_header('Vary'))
+        self.assertNotIn('sessionid', response.cookies)
+        with self.assertNumQueries(0):
+            self.client.get(reverse('item_autocomplete'), {'q': 'Woo'})
+
+    def test_too_short(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(suggest_names('w'), [])
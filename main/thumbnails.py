@@ -0,0 +1,214 @@
+"""Thumbnails
+
+Thumbnails of the item images are generated by the `generate_thumbnails` task
+for every alias of `THUMBNAIL_ALIASES` right after the upload. Their URLs are
+kept in the cache under the name of the source image, the templates take them
+from there without touching the storage and show a placeholder meanwhile.
+
+Every alias is generated in 1x and 2x sizes, in the format of the thumbnail
+settings and in WebP, for `<picture>` with `srcset`. Images uploaded earlier
+are processed by the `generate_image_variants` command.
+
+A new upload gets a new name (see `get_timestamp_path`), so the URLs of a name
+never change and are also kept in a small per-process LRU. The cache is not
+the source of truth: thumbnails missing from it, e.g. after a flush, are
+generated again by the first page showing them.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from easy_thumbnails.alias import aliases
+from easy_thumbnails.files import get_thumbnailer
+from kombu.exceptions import OperationalError
+
+from .cache import ALL_ITEMS, ALL_TAGS, bump_listing_version
+from .models import ItemModel
+
+THUMBNAILS_KEY = 'thumbnails:{name}'
+VARIANTS_KEY = 'thumbnails:variants:{name}'
+QUEUED_KEY = 'thumbnails:queued:{name}'
+
+THUMBNAIL_PLACEHOLDER = getattr(settings, 'THUMBNAIL_PLACEHOLDER', 'img/no_image.png')
+THUMBNAIL_LRU_SIZE = getattr(settings, 'THUMBNAIL_LRU_SIZE', 4096)
+# a lost task is queued again after this timeout
+THUMBNAIL_QUEUED_TIMEOUT = 60 * 10
+
+logger = logging.getLogger(__name__)
+
+FALLBACK = 'fallback'
+WEBP = 'webp'
+
+_lru: 'OrderedDict[str, Any]' = OrderedDict()
+# shared by the threads of a worker
+_lru_lock = threading.Lock()
+
+
+def render_variants(name: str) -> Dict[str, Dict[str, List[str]]]:
+    """Generate the thumbnails of an image for all the aliases, 1x and 2x, usual format and WebP
+
+    Only the storage is used, so images can be processed in a pool of processes.
+    :param name: name of the image in the default storage
+    :type name: str
+    :return: dict alias -> dict `fallback` or `webp` -> list of 1x and 2x URLs
+    """
+    variants: Dict[str, Dict[str, List[str]]] = {alias: {} for alias in aliases.all()}
+    for kind in (FALLBACK, WEBP):
+        thumbnailer = get_thumbnailer(name)
+        if kind == WEBP:
+            thumbnailer.thumbnail_extension = thumbnailer.thumbnail_transparency_extension = WEBP
+        storage = thumbnailer.thumbnail_storage
+        for alias, options in aliases.all().items():
+            for high_resolution in (False, True):
+                thumbnail = thumbnailer.generate_thumbnail(options, high_resolution=high_resolution)
+                # the storage would save under another name otherwise
+                storage.delete(thumbnail.name)
+                storage.save(thumbnail.name, thumbnail)
+                variants[alias].setdefault(kind, []).append(storage.url(thumbnail.name))
+
+    return variants
+
+
+def store_variants(name: str, variants: Dict[str, Dict[str, List[str]]]) -> None:
+    """Make the generated thumbnails available to the templates
+
+    :param name: name of the image in the default storage
+    :type name: str
+    :param variants: result of `render_variants`
+    :type variants: dict
+    :return: None
+    """
+    cache.set_many({
+        VARIANTS_KEY.format(name=name): variants,
+        THUMBNAILS_KEY.format(name=name): {alias: urls[FALLBACK][0] for alias, urls in variants.items()},
+    }, None)
+    cache.delete(QUEUED_KEY.format(name=name))
+
+
+def refresh_pages(names: Iterable[str]) -> None:
+    """Outdate the pages cached with placeholders instead of the thumbnails of the images
+
+    :param names: names of the images
+    :type names: list
+    :return: None
+    """
+    names = list(names)
+    ItemModel.objects.filter(Q(image__in=names) | Q(additionalimage__image__in=names)).update(
+        item_update=timezone.now())
+    if ItemModel.objects.filter(image__in=names).exists():
+        bump_listing_version(ALL_ITEMS, ALL_TAGS)
+
+
+def generate_thumbnails(name: str) -> Dict[str, str]:
+    """Generate the thumbnails of an image for all the aliases
+
+    :param name: name of the image in the default storage
+    :type name: str
+    :return: dict alias -> URL of the thumbnail
+    """
+    variants = render_variants(name)
+    store_variants(name, variants)
+    refresh_pages([name])
+
+    return {alias: urls[FALLBACK][0] for alias, urls in variants.items()}
+
+
+def _queue(name: str) -> None:
+    if not cache.add(QUEUED_KEY.format(name=name), 1, THUMBNAIL_QUEUED_TIMEOUT):
+        return
+
+    def send() -> None:
+        from .tasks import generate_thumbnails as task
+        try:
+            task.delay(name)
+        except OperationalError:
+            logger.exception('Thumbnails of %s are not queued', name)
+            cache.delete(QUEUED_KEY.format(name=name))
+
+    transaction.on_commit(send)
+
+
+def schedule_thumbnails(name: str) -> None:
+    """Queue the generation of the thumbnails after the current transaction
+
+    Does nothing if the thumbnails are ready or queued already.
+    :param name: name of the image in the default storage
+    :type name: str
+    :return: None
+    """
+    if name and get_thumbnail_urls(name) is None:
+        _queue(name)
+
+
+def _cached(key: str) -> Any:
+    with _lru_lock:
+        if key in _lru:
+            _lru.move_to_end(key)
+            return _lru[key]
+
+    value = cache.get(key)
+    if value is not None:
+        with _lru_lock:
+            _lru[key] = value
+            if len(_lru) > THUMBNAIL_LRU_SIZE:
+                _lru.popitem(last=False)
+
+    return value
+
+
+def get_thumbnail_urls(name: str) -> Optional[Dict[str, str]]:
+    """URLs of the generated thumbnails
+
+    :param name: name of the image in the default storage
+    :type name: str
+    :return: dict alias -> URL or None if the thumbnails are not ready
+    """
+    return _cached(THUMBNAILS_KEY.format(name=name))
+
+
+def thumbnail_variants(name: str, alias: str) -> Optional[Dict[str, List[str]]]:
+    """1x and 2x URLs of the thumbnail in the usual format and WebP, the generation is queued if they are not ready
+
+    :param name: name of the image in the default storage
+    :type name: str
+    :param alias: alias of `THUMBNAIL_ALIASES`
+    :type alias: str
+    :return: dict `fallback` or `webp` -> list of URLs or None if they are not ready
+    """
+    if not name:
+        return None
+
+    variants = _cached(VARIANTS_KEY.format(name=name))
+    if variants is None:
+        # lost by the cache or not generated yet
+        _queue(name)
+        return None
+
+    return variants.get(alias)
+
+
+def thumbnail_url(name: str, alias: str) -> Optional[str]:
+    """URL of the thumbnail, the generation is queued if it is not ready
+
+    :param name: name of the image in the default storage
+    :type name: str
+    :param alias: alias of `THUMBNAIL_ALIASES`
+    :type alias: str
+    :return: URL or None
+    """
+    if not name:
+        return None
+
+    urls = get_thumbnail_urls(name)
+    if urls is None:
+        # images uploaded before the thumbnails were generated in advance
+        _queue(name)
+        return None
+
+    return urls.get(alias)
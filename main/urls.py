@@ -1,18 +1,24 @@
 from django.urls import path
 
 from .views import index
-from .views import ItemListView
+from .views import item_autocomplete
+from .views import ItemListView, ItemSearchView, TrendingItemListView
 from .views import ItemDetailView
 from .views import ItemCreateView, ItemUpdateView
-from .views import send_message_to_email
+from .views import send_message_to_email, circular_message
 
 
 urlpatterns = [
     path('', index, name='index'),
     path('send_message/', send_message_to_email, name='send_msg'),
+    path('send_message/<int:pk>/', circular_message, name='circular_message'),
     path('item/create/', ItemCreateView.as_view(), name='create-item'),
     path('item/<int:pk>/update/', ItemUpdateView.as_view(), name='update-item'),
+    path('search/', ItemSearchView.as_view(), name='item_search'),
+    path('items/autocomplete/', item_autocomplete, name='item_autocomplete'),
+    path('items/trending/', TrendingItemListView.as_view(), name='trending_items'),
     path('items/<str:tag_name>/', ItemListView.as_view(), name='items_by_tag'),
+    path('category/<int:category_id>/', ItemListView.as_view(), name='category_items'),
     path('item/<int:pk>/', ItemDetailView.as_view(), name='item_detail'),
     path('items/', ItemListView.as_view(), name='item_list'),
 ]
@@ -1,49 +1,173 @@
+from datetime import datetime
+from typing import Any, Optional
+
 from django.http import HttpRequest
 from django.shortcuts import render
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
 from django.shortcuts import get_object_or_404
-from django.http.response import HttpResponseRedirect, HttpResponse
+from django.http import Http404
+from django.http.response import HttpResponseRedirect, HttpResponse, JsonResponse
 from django.urls import reverse
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_GET
 from django.conf import settings
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
-from django.core.cache import cache
 
-from .models import ItemModel, TagModel
+from .models import CircularMessage, ItemModel, ItemQuerySet, TagModel
 from .forms import SendMessage
+from .paginators import CursorPaginator, InvalidCursor
+from .search import AUTOCOMPLETE_CACHE_TTL, search_items, suggest_names
+from .cache import cache_listing, get_listing_version, listing_etag, listing_scopes
+from .categories import find_category
+from .facets import ItemFilter, get_facets, link_facets
+from .tasks import send_circular_message
+from . import counters
 
 CACHE_TTL = getattr(settings, 'CACHE_TTL', DEFAULT_TIMEOUT)
+LISTING_CACHE_TTL = getattr(settings, 'LISTING_CACHE_TTL', CACHE_TTL)
+ITEM_LIST_PAGINATION = getattr(settings, 'ITEM_LIST_PAGINATION', 'offset')
+
+
+TRENDING_BLOCK_SIZE = getattr(settings, 'TRENDING_BLOCK_SIZE', 5)
+TRENDING_LIST_SIZE = getattr(settings, 'TRENDING_LIST_SIZE', 50)
 
 
 def index(request: HttpRequest) -> HttpResponse:
     turn_on_block = True
-    return render(request, 'main/index.html', {'turn_on_block': turn_on_block})
+    return render(request, 'main/index.html', {
+        'turn_on_block': turn_on_block,
+        'trending_items': counters.trending_items(TRENDING_BLOCK_SIZE),
+    })
+
+
+@require_GET
+@cache_control(public=True, max_age=AUTOCOMPLETE_CACHE_TTL)
+def item_autocomplete(request: HttpRequest) -> JsonResponse:
+    # neither the session nor the user is touched here: no session lookup, no `Vary: Cookie`,
+    # so the answer is the same for everybody and may be cached by browsers and proxies
+    query = request.GET.get('q', '')
+    return JsonResponse({'query': query, 'names': suggest_names(query)})
+
+
+class CursorPaginationMixin:
+    """Keyset pagination for list views with `pagination = 'cursor'`"""
+    pagination = 'offset'
+    cursor_ordering = ('-item_create', '-id')
+
+    def paginate_queryset(self, queryset: ItemQuerySet, page_size: int) -> tuple:
+        if self.pagination != 'cursor':
+            return super().paginate_queryset(queryset, page_size)  # type: ignore
+
+        paginator = CursorPaginator(queryset, page_size, ordering=self.cursor_ordering)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))  # type: ignore
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+
+        return paginator, page, page.object_list, page.has_other_pages()
 
 
-@method_decorator(cache_page(CACHE_TTL), name='dispatch')
-class ItemListView(ListView):
+@method_decorator(condition(etag_func=listing_etag), name='dispatch')
+@method_decorator(cache_listing(LISTING_CACHE_TTL), name='dispatch')
+class ItemListView(CursorPaginationMixin, ListView):
     model = ItemModel
     paginate_by = 5
+    pagination = ITEM_LIST_PAGINATION
 
-    def get_queryset(self) -> ItemModel:
-        try:
+    def get_queryset(self) -> ItemQuerySet:
+        items = ItemModel.objects.all()
+        if 'tag_name' in self.kwargs:
             tag = get_object_or_404(TagModel, tag=self.kwargs['tag_name'])
-            return ItemModel.objects.filter(tag=tag.id, published=1)
-        except KeyError:
-            return ItemModel.objects.filter(published=1)
+            items = items.filter(tag=tag.id)
+        if 'category_id' in self.kwargs:
+            self.category = find_category(self.kwargs['category_id'])
+            if self.category is None:
+                raise Http404('No category found')
+            items = items.in_category(self.category)
+
+        self.item_filter = ItemFilter(self.request.GET)
+        scope = ':'.join(f'{name}={value}' for name, value in sorted(self.kwargs.items()))
+        version = get_listing_version(listing_scopes(self.kwargs))
+        self.facets = get_facets(items.published(), self.item_filter, scope, version)
+
+        return self.item_filter.apply(items.listing())
+
+    def get_context_data(self, **kwargs: dict) -> dict:
+        context = super().get_context_data(**kwargs)
+        context['facets'] = link_facets(self.facets, self.item_filter, self.request.GET)
+        context['filters'] = self.item_filter
+        if 'category_id' in self.kwargs:
+            context['list_title'] = self.category.name
+        return context
+
+
+class ItemSearchView(CursorPaginationMixin, ListView):
+    template_name = 'main/itemmodel_search.html'
+    paginate_by = 10
+    pagination = 'cursor'
+    cursor_ordering = ('-rank', '-id')
+
+    def get_queryset(self) -> ItemQuerySet:
+        self.query = self.request.GET.get('q', '').strip()
+        queryset = search_items(self.query)
+
+        return queryset if self.query else queryset.none()
+
+    def get_context_data(self, **kwargs: dict) -> dict:
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.query
+        return context
+
+
+class TrendingItemListView(ListView):
+    template_name = 'main/itemmodel_list.html'
+    extra_context = {'list_title': 'Trending items'}
+
+    def get_queryset(self) -> list:
+        return counters.trending_items(TRENDING_LIST_SIZE)
+
+
+def _item_update(request: HttpRequest, pk: int) -> Optional[datetime]:
+    # both validators come from one single-row query
+    if not hasattr(request, 'item_update'):
+        request.item_update = ItemModel.objects.filter(pk=pk).values_list('item_update', flat=True).first()
+    return request.item_update
+
+
+def item_etag(request: HttpRequest, pk: int) -> Optional[str]:
+    updated = _item_update(request, pk)
+    if updated is None:
+        return None
+
+    user = request.user.pk if request.user.is_authenticated else 'anonymous'
+    return f'item-{pk}-{updated.timestamp()}-{user}'
+
 
+def item_last_modified(request: HttpRequest, pk: int) -> Optional[datetime]:
+    return _item_update(request, pk)
 
+
+@method_decorator(condition(etag_func=item_etag, last_modified_func=item_last_modified), name='get')
 class ItemDetailView(DetailView):
     model = ItemModel
 
+    def dispatch(self, request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        response = super().dispatch(request, *args, **kwargs)
+        if response.status_code == 304:
+            # the browser shows its copy, it is a view still
+            counters.record_view(kwargs['pk'])
+
+        return response
+
+    def get_queryset(self) -> ItemQuerySet:
+        return ItemModel.objects.detail()
+
     def get_context_data(self, **kwargs: dict) -> dict:
         context = super(ItemDetailView, self).get_context_data(**kwargs)
-        amount_views = cache.get_or_set(key='amount_views', default=0, timeout=60)
-        cache.set(key='amount_views', value=amount_views+1, timeout=60)
-        context['amount_views'] = amount_views+1
+        context['amount_views'] = self.object.views + counters.record_view(self.object.id)
 
         return context
 
@@ -94,10 +218,28 @@ def send_message_to_email(request: HttpRequest) -> HttpResponse:
     if request.method == 'POST':
         form = SendMessage(request.POST)
         if form.is_valid():
-            form.send_messages()
+            message = form.send_messages(request.user)
+            if message is not None:
+                return HttpResponseRedirect(message.get_absolute_url())
 
             return HttpResponseRedirect(reverse('index'))
     else:
         form = SendMessage()
 
     return render(request, 'main/send_message.html', {'form': form})
+
+
+@login_required
+def circular_message(request: HttpRequest, pk: int) -> HttpResponse:
+    """Progress of a circular message, shown to its author only
+
+    POST resumes the sending from the chunks not done yet.
+    """
+    message = get_object_or_404(CircularMessage, pk=pk, author=request.user)
+    if request.method == 'POST':
+        if message.finished is None:
+            send_circular_message.delay(message.id)
+
+        return HttpResponseRedirect(message.get_absolute_url())
+
+    return render(request, 'main/circular_message.html', {'message': message, 'progress': message.progress()})
@@ -0,0 +1,144 @@
+"""Database metrics of the requests
+
+`QueryRecorder` is an execute wrapper (see `connection.execute_wrapper`) of
+all the database connections for the time of a request. It counts the
+queries, sums their time and groups them by fingerprint: the SQL with the lists of
+placeholders collapsed and the literals replaced, so the same query with other
+parameters gets the same fingerprint and N+1 patterns show up as duplicates.
+
+The results go to the `Server-Timing` header, to the request metrics and, for
+requests slower than `SLOW_REQUEST_THRESHOLD`, to the log with the slowest
+statements. The header tells the amount of the queries, so it is sent only to
+staff users unless `SERVER_TIMING` is set, by default in DEBUG.
+"""
+import logging
+import re
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpRequest, HttpResponse
+from django.utils.cache import patch_vary_headers
+
+SLOW_REQUEST_THRESHOLD = getattr(settings, 'SLOW_REQUEST_THRESHOLD', 1.0)
+SLOW_REQUEST_STATEMENTS = getattr(settings, 'SLOW_REQUEST_STATEMENTS', 5)
+SERVER_TIMING = getattr(settings, 'SERVER_TIMING', settings.DEBUG)
+
+logger = logging.getLogger(__name__)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r'\(\s*(?:(?:%s|\?)\s*,\s*)+(?:%s|\?)\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql: str) -> str:
+    """SQL without the values
+
+    :param sql: SQL with placeholders or literals
+    :type sql: str
+    :return: normalized SQL
+    """
+    sql = _LITERALS.sub('?', sql.replace('%s', '?'))
+    return _SPACES.sub(' ', _LISTS.sub('(...)', sql)).strip()
+
+
+class QueryRecorder:
+    """Queries of a request
+
+    `statements` maps the SQL, with placeholders, to the amount of its queries and their time,
+    fingerprints are made only when the request is reported.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: Dict[str, List[Any]] = {}
+
+    def __call__(self, execute: Callable[..., Any], sql: str, params: Any, many: bool, context: dict) -> Any:
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            statement = self.statements.get(sql)
+            if statement is None:
+                statement = self.statements[sql] = [0, 0.0]
+            statement[0] += 1
+            statement[1] += elapsed
+
+    def __enter__(self) -> 'QueryRecorder':
+        """Record the queries of all the connections inside the block
+
+        Same as nested `execute_wrapper` blocks, without their overhead.
+        """
+        self.connections = connections.all()
+        for connection in self.connections:
+            connection.execute_wrappers.append(self)
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        for connection in self.connections:
+            connection.execute_wrappers.remove(self)
+
+    def fingerprints(self) -> Dict[str, Tuple[int, float]]:
+        """Amount and time of the queries by fingerprint"""
+        grouped: Dict[str, Tuple[int, float]] = {}
+        for sql, (count, seconds) in self.statements.items():
+            key = fingerprint(sql)
+            total = grouped.get(key, (0, 0.0))
+            grouped[key] = (total[0] + count, total[1] + seconds)
+
+        return grouped
+
+    def duplicates(self) -> Dict[str, int]:
+        """Fingerprints run more than once"""
+        return {key: count for key, (count, _) in self.fingerprints().items() if count > 1}
+
+    def slowest(self, amount: int = SLOW_REQUEST_STATEMENTS) -> List[Tuple[str, int, float]]:
+        """Fingerprints that took the most time
+
+        :param amount: amount of the fingerprints
+        :type amount: int
+        :return: list of fingerprint, amount of queries and their time
+        """
+        ordered = sorted(self.fingerprints().items(), key=lambda item: -item[1][1])
+        return [(key, count, seconds) for key, (count, seconds) in ordered[:amount]]
+
+    def server_timing(self, seconds: float) -> str:
+        duplicates = sum(count - 1 for count in self.duplicates().values())
+        return (f'db;dur={self.seconds * 1000:.1f};desc="{self.count} queries, {duplicates} duplicated", '
+                f'app;dur={seconds * 1000:.1f}')
+
+
+def report(request: HttpRequest, response: HttpResponse, recorder: QueryRecorder, seconds: float) -> None:
+    """Add the `Server-Timing` header for staff or with `SERVER_TIMING`, log the request if it is slow
+
+    :param request: request
+    :type request: HttpRequest
+    :param response: response
+    :type response: HttpResponse
+    :param recorder: queries of the request
+    :type recorder: QueryRecorder
+    :param seconds: time of the request
+    :type seconds: float
+    :return: None
+    """
+    # the user of a request without a session is not loaded not to touch the session and vary on the cookie
+    user = getattr(request, 'user', None) if settings.SESSION_COOKIE_NAME in request.COOKIES else None
+    if SERVER_TIMING:
+        response['Server-Timing'] = recorder.server_timing(seconds)
+    elif user is not None and user.is_staff:
+        response['Server-Timing'] = recorder.server_timing(seconds)
+        # not to be served to others from a shared cache
+        patch_vary_headers(response, ('Cookie',))
+
+    if seconds >= SLOW_REQUEST_THRESHOLD:
+        statements = '\n'.join(f'  {total:.3f}s x{count} {sql}' for sql, count, total in recorder.slowest())
+        logger.warning('Slow request %s %s: %.3fs, %s queries in %.3fs, %s duplicated statements\n%s',
+                       request.method, request.get_full_path(), seconds, recorder.count, recorder.seconds,
+                       len(recorder.duplicates()), statements)
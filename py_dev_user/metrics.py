@@ -0,0 +1,274 @@
+"""Request metrics
+
+`metric_middleware` counts the latency of every request into a histogram
+labelled by the URL name, the method and the status code, along with the
+amount and the time of its database queries (see `db_metrics`). The counts are kept
+in the process and added to a Redis hash at most every `METRICS_FLUSH_INTERVAL`
+seconds, so `/metrics` shows the requests of all the gunicorn workers.
+
+The quantiles are estimated from the buckets, as `histogram_quantile` of
+Prometheus does. Apps add their own counters to `/metrics` by `collector`.
+
+`/metrics` is shown to staff users, to the addresses of `METRICS_ALLOWED_IPS`
+and to the requests with the `Authorization: Bearer <METRICS_TOKEN>` header.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpRequest, HttpResponse
+from django.utils.crypto import constant_time_compare
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+METRICS_KEY = 'metrics:requests'
+
+METRICS_FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+# seconds, the default buckets of the Prometheus clients
+METRICS_BUCKETS = tuple(getattr(settings, 'METRICS_BUCKETS', (
+    0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)))
+QUANTILES = (0.5, 0.95, 0.99)
+# token of the scraper, None to check only the address and the user
+METRICS_TOKEN = getattr(settings, 'METRICS_TOKEN', None)
+METRICS_ALLOWED_IPS = tuple(getattr(settings, 'METRICS_ALLOWED_IPS', ()))
+
+UNMATCHED = '<unmatched>'
+
+# view name, method, status code
+Labels = Tuple[str, str, str]
+# fields of the totals of a series in the Redis hash
+TOTALS = ('sum', 'db', 'queries')
+
+# lines of the Prometheus text format
+Collector = Callable[[], List[str]]
+
+logger = logging.getLogger(__name__)
+
+_collectors: List[Collector] = []
+
+
+def collector(func: Collector) -> Collector:
+    """Register a function returning more lines of `/metrics`, with their HELP and TYPE"""
+    _collectors.append(func)
+    return func
+
+
+def _redis() -> Any:
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        # the cache is not Redis, the counts stay in the process
+        return None
+
+
+class Histograms:
+    """Latency histograms of the process
+
+    Every series keeps the counts of its buckets, not cumulative, the last one
+    for the requests slower than all the buckets, and its totals: the sum of the
+    latencies, the time and the amount of the database queries.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts: Dict[Labels, List[int]] = {}
+        self.totals: Dict[Labels, List[float]] = {}
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def observe(self, labels: Labels, seconds: float, db_seconds: float = 0.0, queries: int = 0) -> None:
+        with self.lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.totals[labels] = [0.0, 0.0, 0]
+            counts[bisect_left(self.buckets, seconds)] += 1
+            totals = self.totals[labels]
+            totals[0] += seconds
+            totals[1] += db_seconds
+            totals[2] += queries
+
+    def take(self) -> Tuple[Dict[Labels, List[int]], Dict[Labels, List[float]]]:
+        """Counts observed since the last call"""
+        with self.lock:
+            counts, totals = self.counts, self.totals
+            self.counts, self.totals = {}, {}
+            self.flushed = time.monotonic()
+
+        return counts, totals
+
+    def merge(self, counts: Dict[Labels, List[int]], totals: Dict[Labels, List[float]]) -> None:
+        with self.lock:
+            for labels, series in counts.items():
+                own = self.counts.setdefault(labels, [0] * (len(self.buckets) + 1))
+                for idx, amount in enumerate(series):
+                    own[idx] += amount
+                own_totals = self.totals.setdefault(labels, [0.0, 0.0, 0])
+                for idx, amount in enumerate(totals[labels]):
+                    own_totals[idx] += amount
+
+    def due(self) -> bool:
+        return time.monotonic() - self.flushed >= METRICS_FLUSH_INTERVAL
+
+    def flush(self) -> None:
+        """Add the counts of the process to the shared ones"""
+        connection = _redis()
+        counts, totals = self.take()
+        if not counts:
+            return
+        if connection is None:
+            self.merge(counts, totals)
+            return
+
+        pipe = connection.pipeline(transaction=False)
+        for labels, series in counts.items():
+            field = '|'.join(labels)
+            for idx, amount in enumerate(series):
+                if amount:
+                    pipe.hincrby(METRICS_KEY, f'{field}|{idx}', amount)
+            sum_, db_seconds, queries = totals[labels]
+            pipe.hincrbyfloat(METRICS_KEY, f'{field}|sum', sum_)
+            pipe.hincrbyfloat(METRICS_KEY, f'{field}|db', db_seconds)
+            pipe.hincrby(METRICS_KEY, f'{field}|queries', int(queries))
+        try:
+            pipe.execute()
+        except RedisError:
+            logger.warning('Request metrics are not flushed', exc_info=True)
+            self.merge(counts, totals)
+
+
+histograms = Histograms()
+
+
+def observe(request: HttpRequest, response: HttpResponse, seconds: float, db_seconds: float = 0.0,
+            queries: int = 0) -> None:
+    """Count a request, flush the counts of the process if they are due"""
+    match = request.resolver_match
+    histograms.observe((match.view_name if match else UNMATCHED, request.method, str(response.status_code)),
+                       seconds, db_seconds, queries)
+    if histograms.due():
+        histograms.flush()
+
+
+def collect() -> Dict[Labels, Tuple[List[int], List[float]]]:
+    """Counts of all the workers
+
+    :return: dict labels -> bucket counts, not cumulative, and totals: sum of the latencies, time and amount of the
+        database queries
+    """
+    histograms.flush()
+    connection = _redis()
+    if connection is None:
+        with histograms.lock:
+            return {labels: (list(counts), list(histograms.totals[labels]))
+                    for labels, counts in histograms.counts.items()}
+
+    size = len(histograms.buckets) + 1
+    series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+    for field, value in connection.hgetall(METRICS_KEY).items():
+        *labels, idx = field.decode().split('|')
+        counts, totals = series.setdefault(tuple(labels), ([0] * size, [0.0, 0.0, 0]))
+        if idx in TOTALS:
+            totals[TOTALS.index(idx)] += float(value)
+        elif int(idx) < size:
+            counts[int(idx)] += int(value)
+
+    return series
+
+
+def quantile(q: float, counts: List[int], buckets: Tuple[float, ...] = METRICS_BUCKETS) -> Optional[float]:
+    """Estimate a quantile by linear interpolation inside its bucket
+
+    :param q: quantile, from 0 to 1
+    :type q: float
+    :param counts: bucket counts, not cumulative
+    :type counts: list
+    :param buckets: upper bounds of the buckets
+    :type buckets: tuple
+    :return: seconds or None if there are no requests
+    """
+    total = sum(counts)
+    if not total:
+        return None
+
+    rank = q * total
+    seen = 0
+    for idx, amount in enumerate(counts):
+        if amount and seen + amount >= rank:
+            if idx == len(buckets):
+                # slower than all the buckets
+                return buckets[-1]
+            lower = buckets[idx - 1] if idx else 0.0
+            return lower + (buckets[idx] - lower) * (rank - seen) / amount
+        seen += amount
+
+    return buckets[-1]
+
+
+def _labels(labels: Labels, **extra: str) -> str:
+    pairs = [('view', labels[0]), ('method', labels[1]), ('status', labels[2]), *extra.items()]
+    return ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+
+def render(series: Dict[Labels, Tuple[List[int], List[float]]], buckets: Iterable[float] = METRICS_BUCKETS) -> str:
+    """Prometheus text format of the histograms and their quantiles"""
+    bounds = [f'{bound:g}' for bound in buckets] + ['+Inf']
+    lines = [
+        '# HELP http_request_duration_seconds Latency of the requests by view, method and status',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for labels, (counts, totals) in sorted(series.items()):
+        cumulative = 0
+        for bound, amount in zip(bounds, counts):
+            cumulative += amount
+            lines.append(f'http_request_duration_seconds_bucket{{{_labels(labels, le=bound)}}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_sum{{{_labels(labels)}}} {totals[0]:.6f}')
+        lines.append(f'http_request_duration_seconds_count{{{_labels(labels)}}} {cumulative}')
+
+    lines += [
+        '# HELP http_request_duration_quantile_seconds Latency quantiles estimated from the histogram buckets',
+        '# TYPE http_request_duration_quantile_seconds gauge',
+    ]
+    for labels, (counts, _) in sorted(series.items()):
+        for q in QUANTILES:
+            value = quantile(q, counts)
+            if value is not None:
+                lines.append(f'http_request_duration_quantile_seconds{{{_labels(labels, quantile=str(q))}}} '
+                             f'{value:.6f}')
+
+    lines += [
+        '# HELP http_request_db_seconds_total Time of the database queries of the requests',
+        '# TYPE http_request_db_seconds_total counter',
+    ]
+    lines += [f'http_request_db_seconds_total{{{_labels(labels)}}} {totals[1]:.6f}'
+              for labels, (_, totals) in sorted(series.items())]
+    lines += [
+        '# HELP http_request_db_queries_total Database queries of the requests',
+        '# TYPE http_request_db_queries_total counter',
+    ]
+    lines += [f'http_request_db_queries_total{{{_labels(labels)}}} {int(totals[2])}'
+              for labels, (_, totals) in sorted(series.items())]
+
+    return '\n'.join(lines) + '\n'
+
+
+def allowed(request: HttpRequest) -> bool:
+    """Check if the request may read the metrics"""
+    if METRICS_TOKEN and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {METRICS_TOKEN}'):
+        return True
+    if request.META.get('REMOTE_ADDR') in METRICS_ALLOWED_IPS:
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user is not None and user.is_staff)
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    if not allowed(request):
+        raise PermissionDenied
+
+    content = render(collect()) + ''.join(f'{line}\n' for func in _collectors for line in func())
+    return HttpResponse(content, content_type='text/plain; version=0.0.4')
@@ -1,25 +1,34 @@
-import logging
 import time
 
+from . import db_metrics, profiling
+from .metrics import observe
+
 
 def metric_middleware(get_response):
     def middleware(request):
-        # Get beginning stats
+        recorder = db_metrics.QueryRecorder()
         start_time = time.perf_counter()
+        with recorder:
+            response = get_response(request)
+        total_time = time.perf_counter() - start_time
+
+        db_metrics.report(request, response, recorder, total_time)
+        observe(request, response, total_time, recorder.seconds, recorder.count)
 
-        # Process the request
-        response = get_response(request)
+        return response
 
-        # Get ending stats
-        end_time = time.perf_counter()
+    return middleware
 
-        # Calculate stats
-        total_time = end_time - start_time
 
-        # Log the results
-        logger = logging.getLogger('debug')
-        logger.info(f'Total time: {(total_time):.2f}s')
-        print(f'Total time: {(total_time):.2f}s')
+def profile_middleware(get_response):
+    def middleware(request):
+        if not profiling.requested(request):
+            return get_response(request)
+
+        start_time = time.perf_counter()
+        with profiling.StackSampler() as sampler:
+            response = get_response(request)
+        profiling.save(request, sampler, time.perf_counter() - start_time)
 
         return response
 
@@ -0,0 +1,169 @@
+"""Request profiler
+
+`profile_middleware` samples the Python stack of a request every
+`PROFILE_INTERVAL` seconds from a background thread and writes the samples in
+the collapsed format of flamegraph.pl and speedscope, one line per stack with
+the amount of its samples, into `PROFILE_DIR`. Only the newest `PROFILE_KEEP`
+files are kept.
+
+A request is profiled with the probability `PROFILE_SAMPLE_RATE` or on demand,
+when it carries the `X-Profile` header with the token of a staff user, shown on
+the admin page of the profiles.
+"""
+import os
+import random
+import re
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from types import FrameType
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core import signing
+from django.http import FileResponse, Http404, HttpRequest, HttpResponse
+from django.shortcuts import render
+
+PROFILE_SAMPLE_RATE = getattr(settings, 'PROFILE_SAMPLE_RATE', 0.0)
+PROFILE_DIR = Path(getattr(settings, 'PROFILE_DIR', settings.BASE_DIR / 'profiles'))
+PROFILE_KEEP = getattr(settings, 'PROFILE_KEEP', 200)
+PROFILE_INTERVAL = getattr(settings, 'PROFILE_INTERVAL', 0.001)
+# lifetime of the tokens of the X-Profile header, seconds
+PROFILE_TOKEN_AGE = getattr(settings, 'PROFILE_TOKEN_AGE', 60 * 60 * 24)
+
+HEADER = 'HTTP_X_PROFILE'
+SALT = 'py_dev_user.profiling'
+SUFFIX = '.collapsed'
+# time, view name, method, milliseconds
+NAME = re.compile(r'^(\d{8}-\d{6}-\d{6})_([\w.-]+)_([A-Z]+)_(\d+)ms' + re.escape(SUFFIX) + '$')
+
+
+class StackSampler:
+    """Sampler of the stack of the current thread
+
+    :param interval: seconds between the samples, `PROFILE_INTERVAL` by default
+    :type interval: float
+    """
+
+    def __init__(self, interval: Optional[float] = None) -> None:
+        self.interval = interval or PROFILE_INTERVAL
+        self.stacks: Counter = Counter()
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def __enter__(self) -> 'StackSampler':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self.collapse(frame)] += 1
+
+    @staticmethod
+    def collapse(frame: Optional[FrameType]) -> str:
+        """Stack from the outermost frame, the frames separated by semicolons"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+
+        return ';'.join(reversed(names))
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def make_token(user_id: int) -> str:
+    """Value of the `X-Profile` header for the user"""
+    return signing.TimestampSigner(salt=SALT).sign(str(user_id))
+
+
+def requested(request: HttpRequest) -> bool:
+    """Check if the request is to be profiled"""
+    token = request.META.get(HEADER)
+    if token:
+        try:
+            user_id = signing.TimestampSigner(salt=SALT).unsign(token, max_age=PROFILE_TOKEN_AGE)
+        except signing.BadSignature:
+            return False
+        user = getattr(request, 'user', None)
+        return bool(user is not None and user.is_staff and str(user.pk) == user_id)
+
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def save(request: HttpRequest, sampler: StackSampler, seconds: float) -> Optional[Path]:
+    """Write the samples of the request, delete the oldest profiles
+
+    :param request: profiled request
+    :type request: HttpRequest
+    :param sampler: sampler of the request
+    :type sampler: StackSampler
+    :param seconds: time of the request
+    :type seconds: float
+    :return: path of the profile or None if there are no samples
+    """
+    if not sampler.stacks:
+        return None
+
+    match = request.resolver_match
+    view = re.sub(r'[^\w.-]', '-', match.view_name if match else 'unmatched')
+    name = f'{datetime.now():%Y%m%d-%H%M%S-%f}_{view}_{request.method}_{int(seconds * 1000)}ms{SUFFIX}'
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = PROFILE_DIR / name
+    path.write_text(sampler.collapsed())
+
+    for old in sorted(PROFILE_DIR.glob('*' + SUFFIX), reverse=True)[PROFILE_KEEP:]:
+        old.unlink(missing_ok=True)
+
+    return path
+
+
+def recent_profiles() -> Dict[str, List[dict]]:
+    """Profiles in `PROFILE_DIR` by view name, the newest first"""
+    profiles: Dict[str, List[dict]] = {}
+    if not PROFILE_DIR.is_dir():
+        return profiles
+
+    for path in sorted(PROFILE_DIR.glob('*' + SUFFIX), reverse=True):
+        match = NAME.match(path.name)
+        if match:
+            created, view, method, milliseconds = match.groups()
+            profiles.setdefault(view, []).append({
+                'name': path.name,
+                'created': datetime.strptime(created, '%Y%m%d-%H%M%S-%f'),
+                'method': method,
+                'milliseconds': int(milliseconds),
+            })
+
+    return dict(sorted(profiles.items()))
+
+
+@staff_member_required
+def profiles(request: HttpRequest) -> HttpResponse:
+    return render(request, 'admin/profiles.html', {
+        'title': 'Request profiles',
+        'profiles': recent_profiles(),
+        'token': make_token(request.user.pk),
+        'sample_rate': PROFILE_SAMPLE_RATE,
+    })
+
+
+@staff_member_required
+def profile_file(request: HttpRequest, name: str) -> FileResponse:
+    path = PROFILE_DIR / name
+    if not NAME.match(name) or not path.is_file():
+        raise Http404
+
+    return FileResponse(path.open('rb'), as_attachment=True, content_type='text/plain')
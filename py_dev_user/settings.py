@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'main.apps.MainConfig',
     'accounts.apps.AccountsConfig',
     'django.contrib.sites',
@@ -68,6 +69,7 @@ MIDDLEWARE = [
     'django.contrib.flatpages.middleware.FlatpageFallbackMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'py_dev_user.middleware.metric_middleware',
+    'py_dev_user.middleware.profile_middleware',
 ]
 
 ROOT_URLCONF = 'py_dev_user.urls'
@@ -183,6 +185,8 @@ THUMBNAIL_ALIASES = {
         },
     },
 }
+# shown until the thumbnails are generated by the task, see main.thumbnails
+THUMBNAIL_PLACEHOLDER = 'img/no_image.png'
 
 # added number (identifier) of site
 SITE_ID = 1
@@ -228,8 +232,28 @@ TWILIO_AUTH_TOKEN = ''      # os.environ['TWILIO_AUTH_TOKEN']
 
 SMS_NUMBER_FROM = ''        # os.environ['SMS_NUMBER_FROM']
 
+# 'offset' - numbered pages, 'cursor' - keyset pagination without COUNT(*) for big catalogs
+ITEM_LIST_PAGINATION = 'offset'
+
+# trending items: hours in the rolling window, hours for the weight of a view to halve
+TRENDING_HOURS = 24
+TRENDING_HALF_LIFE = 6
+
 # caching
 CACHE_TTL = 60 * 5
+# item listings are invalidated on item and tag changes, see main.cache
+LISTING_CACHE_TTL = 60 * 60 * 6
+# outdated listing pages are served while one worker rebuilds them
+LISTING_CACHE_STALE_TTL = 60 * 60
+LISTING_CACHE_LOCK_TIMEOUT = 10
+# typeahead of the search field: Cache-Control max-age and the per-process LRU of hot prefixes
+AUTOCOMPLETE_CACHE_TTL = 60
+AUTOCOMPLETE_LRU_SIZE = 1024
+
+# profiling: share of the requests profiled at random, see py_dev_user.profiling
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_DIR = BASE_DIR / 'profiles'
+
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
@@ -21,9 +21,15 @@ from django.views.generic import RedirectView
 from django.conf.urls.static import static
 from django.conf import settings
 
+from .metrics import metrics
+from .profiling import profile_file, profiles
+
 
 urlpatterns = [
+    path('admin/profiles/', profiles, name='profiles'),
+    path('admin/profiles/<str:name>', profile_file, name='profile_file'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
     path('pages/', include('django.contrib.flatpages.urls')),
     path('ckeditor/', include('ckeditor_uploader.urls')),
     path('main/', include('main.urls')),
@@ -1,11 +1,16 @@
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.utils.html import strip_tags
 
+import logging
+import time
 from datetime import datetime
+from functools import lru_cache
 from os.path import splitext
 
 from accounts.models import Sender
 
+logger = logging.getLogger(__name__)
+
 
 def get_timestamp_path(instance, filename):
     return '{datetime_mark}{extension}'.format(
@@ -14,16 +19,68 @@ def get_timestamp_path(instance, filename):
     )
 
 
+def get_sender_email():
+    """Address of the sender of the letters, None if it is not configured"""
+    return Sender.objects.filter(name='sender').values_list('email', flat=True).first()
+
+
+@lru_cache(maxsize=32)
+def plain_text(html):
+    """Plain text alternative of a letter, the same bodies sent in a row are converted once"""
+    return strip_tags(html)
+
+
+def send_batch(messages, from_email=None, connection=None, batch_size=100):
+    """Send many letters over one connection of the mail backend
+
+    The sender is looked up once, the plain text of a body is made once for the
+    letters with that body sent close together (see `plain_text`). Letters are
+    passed to the backend by batches, the time of every batch is logged.
+    :param messages: triples of subject, HTML body and list of recipients
+    :type messages: iterable
+    :param from_email: sender address, looked up if not given
+    :type from_email: str
+    :param connection: open backend connection, a new one is opened and closed otherwise
+    :type connection: mail backend
+    :param batch_size: letters per `send_messages` call
+    :type batch_size: int
+    :return: amount of the sent letters
+    """
+    from_email = from_email or get_sender_email()
+    if from_email is None:
+        return 0
+
+    own_connection = connection is None
+    if own_connection:
+        connection = get_connection(fail_silently=False)
+        connection.open()
+
+    sent = 0
+    batch = []
+
+    def flush():
+        started = time.perf_counter()
+        amount = connection.send_messages(batch) or 0
+        logger.info('%s of %s letters sent in %.3fs', amount, len(batch), time.perf_counter() - started)
+        batch.clear()
+        return amount
+
+    try:
+        for subject, body, recipients in messages:
+            letter = EmailMultiAlternatives(subject, plain_text(body), from_email, recipients, connection=connection)
+            letter.attach_alternative(body, 'text/html')
+            batch.append(letter)
+            if len(batch) == batch_size:
+                sent += flush()
+
+        if batch:
+            sent += flush()
+    finally:
+        if own_connection:
+            connection.close()
+
+    return sent
+
+
 def send(subject, body, email):
-    sender = Sender.objects.filter(name='sender').values('email')
-    if len(sender) == 0:
-        return
-
-    send_mail(
-        from_email=sender[0]['email'],
-        subject=subject,
-        message=strip_tags(body),
-        html_message=body,
-        recipient_list=email,
-        fail_silently=False
-    )
+    return send_batch([(subject, body, email)])